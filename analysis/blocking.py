@@ -0,0 +1,134 @@
+import argparse
+import glob
+import json
+import os
+import sys
+
+from replay import load_capture, _parse_attributes
+from complex import adjust_for_farbling, calculate_similarities, find_best_match, find_best_candidate
+from farbling import test_farbling
+from fingerprint_store import FingerprintStore
+from lsh import MinHashIndex
+
+"""
+blocking.py: Measures the recall of candidate blocking (server/src/lsh.py) against exhaustive scoring
+of the complex algorithm on the captured datasets.
+
+All captures are replayed into one store, every capture being one user, with the rows of the captures
+interleaved. Before a row is added, it is matched against the store twice: by scoring every stored log and
+by scoring only the candidates of the blocking index. A query agrees if both give the same result; recall
+is the share of the exhaustive matches that blocking finds too. By default only rows with farbling detected
+are queried, as only they are scored by the complex algorithm.
+
+Usage:
+    python blocking.py
+    python blocking.py --bands 32 --rows 4 --all --output blocking_results.json
+"""
+
+DATA_DIR = "../data/browser_data/"
+
+def load_rows(files):
+    """
+    Reads the captures as (user ID, Log, fingerprint) tuples, interleaved across the captures. Rows whose
+    Attributes cannot be parsed or miss the screen size or CPU are skipped, as in the complex replay.
+    """
+    captures = []
+    for user_id, file_path in enumerate(files):
+        rows = []
+        for log, row in enumerate(load_capture(file_path).to_dict("records")):
+            try:
+                attributes = _parse_attributes(row["Attributes"])
+            except Exception:
+                continue
+            if not all(key in attributes for key in ["Screen Width", "Screen Height", "CPU"]):
+                continue
+            attributes["Screen Width"] = int(attributes["Screen Width"])
+            attributes["Screen Height"] = int(attributes["Screen Height"])
+            rows.append((user_id, log, dict(row, Attributes=attributes)))
+        captures.append(rows)
+
+    interleaved = []
+    for position in range(max((len(rows) for rows in captures), default=0)):
+        interleaved += [rows[position] for rows in captures if position < len(rows)]
+    return interleaved
+
+def measure(rows, files, bands, rows_per_band, query_all=False):
+    """
+    Replays the rows and compares blocked with exhaustive matching.
+
+    Returns:
+    - dict: The totals and the results of every capture.
+    """
+    store = FingerprintStore(order_by_key=False, blocking=MinHashIndex(bands, rows_per_band))
+    results = {user_id: {"file": os.path.basename(file_path), "queries": 0, "agree": 0, "matches": 0, "found": 0, "candidates": 0.0}
+               for user_id, file_path in enumerate(files)}
+
+    for user_id, log, user_data in rows:
+        farbling = test_farbling(user_data["Attributes"])
+        adjust_for_farbling(user_data["Attributes"], farbling)
+
+        if len(store) > 0 and (query_all or farbling[0]):
+            exhaustive = find_best_match(calculate_similarities(store, user_data), store)
+            candidates = store.candidates(user_data)
+            blocked = find_best_candidate(store, user_data, candidates)
+
+            result = results[user_id]
+            result["queries"] += 1
+            result["agree"] += exhaustive == blocked
+            result["matches"] += exhaustive[0]
+            result["found"] += exhaustive[0] and exhaustive == blocked
+            result["candidates"] += len(candidates) / len(store)
+
+        store.ingest(dict(user_data, ID=user_id, Log=log, Attributes=repr(user_data["Attributes"])))
+
+    files_results = [result for result in results.values() if result["queries"]]
+    for result in files_results:
+        result["candidates"] /= result["queries"]
+    queries = sum(result["queries"] for result in files_results)
+    matches = sum(result["matches"] for result in files_results)
+    return {
+        "bands": bands,
+        "rows": rows_per_band,
+        "logs": len(store),
+        "queries": queries,
+        "agreement": sum(result["agree"] for result in files_results) / queries if queries else None,
+        "recall": sum(result["found"] for result in files_results) / matches if matches else None,
+        "candidates": sum(result["candidates"] * result["queries"] for result in files_results) / queries if queries else None,
+        "files": files_results,
+    }
+
+def print_results(summary):
+    print(f"{'File':<45} {'Queries':>8} {'Agree':>8} {'Recall':>8} {'Scored':>8}")
+    print("-" * 81)
+    for result in summary["files"]:
+        recall = f"{result['found'] / result['matches']:.1%}" if result["matches"] else "-"
+        print(f"{result['file']:<45} {result['queries']:>8} {result['agree'] / result['queries']:>8.1%} {recall:>8} {result['candidates']:>8.1%}")
+    print("-" * 81)
+    if summary["queries"]:
+        recall = f"{summary['recall']:.1%}" if summary["recall"] is not None else "-"
+        print(f"{'Total':<45} {summary['queries']:>8} {summary['agreement']:>8.1%} {recall:>8} {summary['candidates']:>8.1%}")
+    print(f"\n{summary['bands']} bands x {summary['rows']} rows, {summary['logs']} logs. "
+          "Scored is the average share of the stored logs scored per query.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the recall of candidate blocking against exhaustive scoring.")
+    parser.add_argument("--files", nargs="*", help="Capture files or glob patterns (default: data/browser_data)")
+    parser.add_argument("--bands", type=int, default=16)
+    parser.add_argument("--rows", type=int, default=4, help="Rows per band")
+    parser.add_argument("--all", action="store_true", help="Query every row, not only rows with farbling detected")
+    parser.add_argument("--output", help="JSON file the results are written to")
+    args = parser.parse_args()
+
+    files = []
+    for pattern in args.files or [os.path.join(DATA_DIR, "*.csv")]:
+        files += sorted(glob.glob(pattern))
+    if not files:
+        sys.exit("No capture files found")
+
+    summary = measure(load_rows(files), files, args.bands, args.rows, args.all)
+    print_results(summary)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(summary, file, indent=2)
+        print(f"Results written to {args.output}")
@@ -0,0 +1,141 @@
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from replay import load_capture, seed_store, replay_naive, replay_complex, print_summary
+
+"""
+evaluate.py: Evaluation runner for the naive and complex algorithms over the captured datasets.
+
+Every capture is replayed in its own process (see replay.py), so all cores are used. Each CSV file is parsed
+once in the main process and handed to the worker processes, however many experiments use it.
+The printed tables are the ones of test_naive.py and test_complex.py; the results are also written as JSON and CSV.
+
+Cross-file experiments replay one capture against a store seeded with another one, e.g. Brave Profile B
+against Profile A. A replayed row matched to the seeded capture is a false positive.
+
+Usage:
+    python evaluate.py                                   # Both algorithms over data/browser_data
+    python evaluate.py --algorithm naive --files "../data/browser_data/*Brave*.csv"
+    python evaluate.py --profiles                        # Profile A vs B (both ways) in data/profile_data
+    python evaluate.py --cross A.csv B.csv               # Replay B against a store seeded with A
+"""
+
+DATA_DIR = "../data/browser_data/"
+PROFILE_DIR = "../data/profile_data/"
+
+replays = {"naive": replay_naive, "complex": replay_complex}
+
+# Parsed captures of a worker process, set by the pool initializer
+_captures = {}
+
+def _init_worker(captures, verbose):
+    global _captures
+    _captures = captures
+    if not verbose:
+        # The replays print every skipped row, which would interleave between the processes
+        sys.stdout = open(os.devnull, "w")
+
+def run_experiment(experiment):
+    """
+    Runs a single experiment in a worker process.
+
+    Parameters:
+    - experiment (tuple): The algorithm, the capture to replay and the capture to seed the store with (or None).
+
+    Returns:
+    - dict: The experiment and its TP, TN, FP and FN counts.
+    """
+    algorithm, file_path, seed_path = experiment
+    if seed_path is None:
+        counts = replays[algorithm](_captures[file_path])
+    else:
+        known_users = seed_store(_captures[seed_path], algorithm)
+        counts = replays[algorithm](_captures[file_path], known_users, user_id=1)
+
+    label = os.path.basename(file_path)
+    if seed_path is not None:
+        label = f"{label} vs {os.path.basename(seed_path)}"
+    return {"algorithm": algorithm, "file": label, "seed": seed_path, **counts}
+
+def profile_pairs(profile_dir=PROFILE_DIR):
+    """
+    Returns the (replayed, seeded) pairs of the profile experiment: every ProfileB capture against
+    its ProfileA capture and the other way round.
+    """
+    pairs = []
+    for profile_a in sorted(glob.glob(os.path.join(profile_dir, "*_ProfileA.csv"))):
+        profile_b = profile_a.replace("_ProfileA.csv", "_ProfileB.csv")
+        if os.path.exists(profile_b):
+            pairs += [(profile_b, profile_a), (profile_a, profile_b)]
+    return pairs
+
+def evaluate(experiments, workers=None, verbose=False):
+    """
+    Runs experiments in a process pool.
+
+    Parameters:
+    - experiments (list): Tuples of the algorithm, the capture to replay and the capture to seed with (or None).
+    - workers (int): Number of processes, all cores by default.
+    - verbose (bool): Keep the output of the algorithms.
+
+    Returns:
+    - list: The results in the order of the experiments.
+    """
+    # Every capture is parsed once, however many experiments use it
+    paths = {path for _, file_path, seed_path in experiments for path in (file_path, seed_path) if path}
+    captures = {path: load_capture(path) for path in sorted(paths)}
+
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(captures, verbose)) as pool:
+        return list(pool.map(run_experiment, experiments))
+
+def write_results(results, output):
+    """
+    Writes the results to `<output>.json` and `<output>.csv`.
+    """
+    with open(output + ".json", "w") as file:
+        json.dump(results, file, indent=2)
+
+    with open(output + ".csv", "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=["algorithm", "file", "seed", "TP", "FP", "TN", "FN"])
+        writer.writeheader()
+        writer.writerows(results)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate the matching algorithms over the captured datasets.")
+    parser.add_argument("--algorithm", choices=["naive", "complex", "both"], default="both")
+    parser.add_argument("--files", nargs="*", help="Capture files or glob patterns (default: data/browser_data)")
+    parser.add_argument("--cross", nargs=2, action="append", metavar=("SEED", "REPLAY"), default=[],
+                        help="Replay a capture against a store seeded with another capture, can be repeated")
+    parser.add_argument("--profiles", action="store_true", help="Profile A vs Profile B experiments of data/profile_data")
+    parser.add_argument("--workers", type=int, help="Number of processes (default: all cores)")
+    parser.add_argument("--output", default="evaluation_results", help="Path of the result files without extension")
+    parser.add_argument("--verbose", action="store_true", help="Print the decisions of the algorithms")
+    args = parser.parse_args()
+
+    algorithms = ["naive", "complex"] if args.algorithm == "both" else [args.algorithm]
+
+    pairs = [(replayed, seeded) for seeded, replayed in args.cross]
+    if args.profiles:
+        pairs += profile_pairs()
+
+    files = []
+    if args.files is not None or not pairs:
+        for pattern in args.files or [os.path.join(DATA_DIR, "*.csv")]:
+            files += sorted(glob.glob(pattern))
+
+    experiments = [(algorithm, file_path, None) for algorithm in algorithms for file_path in files]
+    experiments += [(algorithm, replayed, seeded) for algorithm in algorithms for replayed, seeded in pairs]
+
+    results = evaluate(experiments, args.workers, args.verbose)
+    write_results(results, args.output)
+
+    for algorithm in algorithms:
+        print(f"\n===== {algorithm.upper()} =====")
+        print_summary([result for result in results if result["algorithm"] == algorithm])
+
+    print(f"\nResults written to {args.output}.json and {args.output}.csv")
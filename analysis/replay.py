@@ -0,0 +1,276 @@
+import sys
+import os
+import ast
+import re
+import pandas as pd
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../server/src')))
+from naive import naive
+from complex import complex
+from farbling import test_farbling
+from fingerprint_store import FingerprintStore
+
+"""
+replay.py: Replay engine for the simulation scripts (test_naive.py, test_complex.py).
+
+A capture file is replayed row by row: every row is matched against the rows replayed before it and then
+added to them. The replayed rows are kept in a FingerprintStore that is updated incrementally, so adding a row
+is O(1) and its Attributes are parsed only once, instead of rebuilding a DataFrame and re-parsing every stored
+row for every match. The decisions are the same as matching against the growing DataFrame, because the store
+keeps the rows in the order they were added.
+
+For cross-file experiments (e.g. Brave Profile A vs Profile B) the store can be seeded with another capture
+first (`seed_store`). The seeded rows are user 0 and the replayed capture is user 1, so every replayed row
+matched to the seeded capture counts as a false positive.
+
+Functions:
+- load_capture: Reads a capture file without its ID and Log columns.
+- seed_store: Builds a store holding all rows of a capture as one known user.
+- replay_naive: Replays a capture through the naive algorithm.
+- replay_complex: Replays a capture through the complex algorithm.
+- print_summary: Prints the summary tables for the results of several files.
+"""
+
+def load_capture(file_path):
+    """
+    Reads a capture file. ID and Log are dropped, the replay assigns them.
+    """
+    data = pd.read_csv(file_path)
+    return data.drop(columns=[col for col in ['ID', 'Log'] if col in data.columns])
+
+def _parse_attributes(attr_str):
+    # Replace 'null' with 'None' for ast.literal_eval
+    return ast.literal_eval(re.sub(r"\bnull\b", "None", attr_str))
+
+def _known_user(row, user_id, log, parse_attributes):
+    """
+    Prepares a row stored without being matched. With `parse_attributes`, the Attributes are
+    normalised as the complex replay does for its first user.
+    """
+    known_user = dict(row, ID=user_id, Log=log)
+    if parse_attributes and "Attributes" in known_user and isinstance(known_user["Attributes"], str):
+        try:
+            known_user["Attributes"] = repr(_parse_attributes(known_user["Attributes"]))
+        except Exception as e:
+            print(f"Error parsing Attributes for first user: {e}")
+            known_user["Attributes"] = repr({})
+    return known_user
+
+def seed_store(data, algorithm="naive", user_id=0):
+    """
+    Builds a store holding every row of a capture as logs of one known user.
+
+    Parameters:
+    - data (pd.DataFrame): The capture, see `load_capture`.
+    - algorithm (str): "naive" or "complex", the replay the store is seeded for.
+    - user_id (int): The ID of the known user.
+
+    Returns:
+    - FingerprintStore: The seeded store.
+    """
+    known_users = FingerprintStore(order_by_key=False)
+    for log, row in enumerate(data.to_dict("records")):
+        known_users.ingest(_known_user(row, user_id, log, algorithm == "complex"))
+    return known_users
+
+def replay_naive(data, known_users=None, user_id=0):
+    """
+    Replays a capture through the naive algorithm. The first row is user `user_id`, every other row is
+    added with the ID and Log the naive algorithm returned for it.
+
+    Parameters:
+    - data (pd.DataFrame): The capture, see `load_capture`.
+    - known_users (FingerprintStore): Store seeded with another capture, see `seed_store`. Empty by default.
+    - user_id (int): The ID of the replayed user, it must differ from the seeded user.
+
+    Returns:
+    - dict: The TP, TN, FP and FN counts.
+    """
+    rows = data.to_dict("records")
+    if known_users is None:
+        known_users = FingerprintStore(order_by_key=False)
+
+    # Take out the first user, assign ID=user_id, Log=0
+    known_users.ingest(_known_user(rows[0], user_id, 0, False))
+    tp = 1  # First user is always true positive
+    fp = 0
+    fn = 0
+
+    for test_user in rows[1:]:
+        result = naive(known_users, test_user)
+
+        # Add the test user to known_users with returned ID and Log, a new user keeps the replayed ID
+        test_user['ID'] = result[2] if result[0] else user_id
+        test_user['Log'] = result[3]
+        known_users.ingest(test_user)
+
+        if result[0]:  # Predicted as known
+            if result[2] == user_id:
+                tp += 1
+            else:
+                fp += 1
+        else:
+            fn += 1
+
+    return {"TP": tp, "TN": 0, "FP": fp, "FN": fn}
+
+def replay_complex(data, known_users=None, user_id=0):
+    """
+    Replays a capture through the complex algorithm. The first row is user `user_id`, every other row is
+    added with the ID the complex algorithm returned for it, a new user keeps the replayed ID. Rows whose Attributes cannot be parsed
+    or miss the screen size or CPU are skipped.
+
+    Parameters:
+    - data (pd.DataFrame): The capture, see `load_capture`.
+    - known_users (FingerprintStore): Store seeded with another capture, see `seed_store`. Empty by default.
+    - user_id (int): The ID of the replayed user, it must differ from the seeded user.
+
+    Returns:
+    - dict: The TP, TN, FP and FN counts.
+    """
+    rows = data.to_dict("records")
+    if known_users is None:
+        known_users = FingerprintStore(order_by_key=False)
+
+    known_users.ingest(_known_user(rows[0], user_id, 0, True))
+
+    tp = 1  # First user is always true positive
+    fp = 0
+    fn = 0
+
+    for i, test_user in enumerate(rows[1:]):
+        # Robustly parse Attributes
+        if "Attributes" in test_user and isinstance(test_user["Attributes"], str):
+            try:
+                test_user["Attributes"] = _parse_attributes(test_user["Attributes"])
+            except Exception as e:
+                print(f"Error parsing Attributes for entry {i}: {e}")
+                continue  # Skip this entry
+
+        # Now check for required keys
+        if not all(k in test_user["Attributes"] for k in ["Screen Width", "Screen Height", "CPU"]):
+            print(f"Skipping entry {i}: missing required keys in Attributes")
+            continue
+
+        test_user["Attributes"]["Screen Width"] = int(test_user["Attributes"].get("Screen Width", 0))
+        test_user["Attributes"]["Screen Height"] = int(test_user["Attributes"].get("Screen Height", 0))
+
+        farbling_result = test_farbling(test_user["Attributes"])
+        result = complex(known_users, test_user, farbling_result)
+
+        # A new user keeps the replayed ID, as in replay_naive, so a later match to it is not a false positive
+        test_user['ID'] = result[1] if result[0] else user_id
+        test_user['Log'] = 0
+
+        # Convert Attributes back to string before storing
+        test_user["Attributes"] = repr(test_user["Attributes"])
+        known_users.ingest(test_user)
+
+        if result[0]:  # Predicted as known
+            if result[1] == user_id:
+                tp += 1
+            else:
+                fp += 1
+        else:
+            fn += 1
+
+    return {"TP": tp, "TN": 0, "FP": fp, "FN": fn}
+
+def print_summary(stats):
+    """
+    Prints the counts, percentages and averages for the results of several files.
+
+    Parameters:
+    - stats (list): One dict per file with the file name and its TP, FP, TN and FN counts.
+    """
+    print("\nSummary for all files (counts):")
+    print(f"{'File':<40} {'TP':<6} {'FP':<6} {'TN':<6} {'FN':<6}")
+    print("-" * 60)
+
+    total_tp = total_fp = total_tn = total_fn = 0
+    total_samples = 0
+
+    # For percentage summary
+    percentages = []
+
+    for stat in stats:
+        tp = stat['TP']
+        fp = stat['FP']
+        tn = stat.get('TN', 0)
+        fn = stat['FN']
+        total = tp + fp + tn + fn
+        total_tp += tp
+        total_fp += fp
+        total_tn += tn
+        total_fn += fn
+        total_samples += total
+
+        # Calculate percentages for this file
+        if total > 0:
+            tp_pct = tp / total * 100
+            fp_pct = fp / total * 100
+            tn_pct = tn / total * 100
+            fn_pct = fn / total * 100
+        else:
+            tp_pct = fp_pct = tn_pct = fn_pct = 0.0
+
+        percentages.append({
+            "file": stat['file'],
+            "TP%": tp_pct,
+            "FP%": fp_pct,
+            "TN%": tn_pct,
+            "FN%": fn_pct,
+            "count": total
+        })
+
+        print(f"{stat['file']:<40} {tp:<6} {fp:<6} {tn:<6} {fn:<6}")
+
+    print("\nSummary for all files (percentages):")
+    print(f"{'File':<40} {'TP%':<7} {'FP%':<7} {'TN%':<7} {'FN%':<7}")
+    print("-" * 60)
+
+    weighted_tp_pct = weighted_fp_pct = weighted_tn_pct = weighted_fn_pct = 0.0
+
+    for pct in percentages:
+        print(f"{pct['file']:<40} {pct['TP%']:<7.2f} {pct['FP%']:<7.2f} {pct['TN%']:<7.2f} {pct['FN%']:<7.2f}")
+        weighted_tp_pct += pct['TP%'] * pct['count']
+        weighted_fp_pct += pct['FP%'] * pct['count']
+        weighted_tn_pct += pct['TN%'] * pct['count']
+        weighted_fn_pct += pct['FN%'] * pct['count']
+
+    if total_samples > 0:
+        weighted_tp_pct /= total_samples
+        weighted_fp_pct /= total_samples
+        weighted_tn_pct /= total_samples
+        weighted_fn_pct /= total_samples
+        print("-" * 60)
+        print(f"{'WEIGHTED AVG':<40} {weighted_tp_pct:<7.2f} {weighted_fp_pct:<7.2f} {weighted_tn_pct:<7.2f} {weighted_fn_pct:<7.2f}")
+
+    # Weighted averages for counts
+    if total_samples > 0:
+        avg_tp = total_tp / total_samples
+        avg_fp = total_fp / total_samples
+        avg_tn = total_tn / total_samples
+        avg_fn = total_fn / total_samples
+        print("-" * 60)
+        print(f"{'WEIGHTED AVG (counts)':<40} {avg_tp:<6.4f} {avg_fp:<6.4f} {avg_tn:<6.4f} {avg_fn:<6.4f}")
+
+    # Calculate per-file averages
+    num_files = len(stats)
+    avg_tp_val = total_tp / num_files if num_files else 0
+    avg_fp_val = total_fp / num_files if num_files else 0
+    avg_tn_val = total_tn / num_files if num_files else 0
+    avg_fn_val = total_fn / num_files if num_files else 0
+
+    avg_tp_pct = sum(p['TP%'] for p in percentages) / num_files if num_files else 0
+    avg_fp_pct = sum(p['FP%'] for p in percentages) / num_files if num_files else 0
+    avg_tn_pct = sum(p['TN%'] for p in percentages) / num_files if num_files else 0
+    avg_fn_pct = sum(p['FN%'] for p in percentages) / num_files if num_files else 0
+
+    # Table header
+    print("\nSummary Table (Averages):")
+    print(f"{'Metric':<10} {'Avg Value':<12} {'Avg %':<12} {'Weighted Avg %':<18}")
+    print("-" * 52)
+    print(f"{'TP':<10} {avg_tp_val:<12.2f} {avg_tp_pct:<12.2f} {weighted_tp_pct:<18.2f}")
+    print(f"{'FP':<10} {avg_fp_val:<12.2f} {avg_fp_pct:<12.2f} {weighted_fp_pct:<18.2f}")
+    print(f"{'TN':<10} {avg_tn_val:<12.2f} {avg_tn_pct:<12.2f} {weighted_tn_pct:<18.2f}")
+    print(f"{'FN':<10} {avg_fn_val:<12.2f} {avg_fn_pct:<12.2f} {weighted_fn_pct:<18.2f}")
@@ -0,0 +1,82 @@
+import argparse
+import gc
+import glob
+import json
+import os
+import sys
+import tracemalloc
+
+from replay import load_capture
+from fingerprint_store import FingerprintStore
+from lsh import MinHashIndex
+
+"""
+store_memory.py: Measures the memory the fingerprint store (server/src/fingerprint_store.py) uses per stored log
+on the captured datasets.
+
+All captures are loaded into one store, every capture being one user. The memory allocated while the logs are
+ingested and still held afterwards (tracemalloc) is divided by the number of logs, once for the store alone and
+once with the candidate blocking index (lsh.py). With `--copies`, the captures are loaded several times under
+new user IDs, as a store with many users of the same browsers, whose values are interned only once.
+
+Usage:
+    python store_memory.py
+    python store_memory.py --copies 10 --output store_memory.json
+"""
+
+DATA_DIR = "../data/browser_data/"
+
+def load_rows(files):
+    """
+    Reads the captures as stored rows, every capture being one user.
+    """
+    rows = []
+    for user_id, file_path in enumerate(files):
+        for log, row in enumerate(load_capture(file_path).to_dict("records")):
+            rows.append(dict(row, ID=user_id, Log=log))
+    return rows
+
+def measure(rows, copies=1, blocking=None):
+    """
+    Ingests the rows `copies` times into a new store and measures the memory it holds.
+
+    Returns:
+    - dict: The number of logs and the bytes per log.
+    """
+    users = max((row["ID"] for row in rows), default=-1) + 1
+    gc.collect()
+    tracemalloc.start()
+    store = FingerprintStore(blocking=blocking)
+    for copy in range(copies):
+        for row in rows:
+            store.ingest(dict(row, ID=row["ID"] + copy * users))
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"logs": len(store), "bytes_per_log": size / len(store) if len(store) else None}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the memory used per stored log.")
+    parser.add_argument("--files", nargs="*", help="Capture files or glob patterns (default: data/browser_data)")
+    parser.add_argument("--copies", type=int, default=1, help="Number of times the captures are loaded")
+    parser.add_argument("--output", help="JSON file the results are written to")
+    args = parser.parse_args()
+
+    files = []
+    for pattern in args.files or [os.path.join(DATA_DIR, "*.csv")]:
+        files += sorted(glob.glob(pattern))
+    if not files:
+        sys.exit("No capture files found")
+
+    rows = load_rows(files)
+    summary = {
+        "store": measure(rows, args.copies),
+        "store_with_blocking": measure(rows, args.copies, MinHashIndex()),
+    }
+    for name, result in summary.items():
+        print(f"{name:<22} {result['logs']:>9} logs {result['bytes_per_log']:>10.0f} bytes/log")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(summary, file, indent=2)
+        print(f"Results written to {args.output}")
@@ -0,0 +1,264 @@
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import math
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from complex import check_attributes, check_hashes, find_audio_and_canvas_match
+from data_manager import CsvBackend, fieldnames, load_users
+from farbling import test_farbling
+from farbling_resolution import test_resolution
+from fingerprint_store import FingerprintStore
+from naive import naive_search
+from user_manager import get_next_log
+import snapshot
+
+"""
+benchmark.py: Microbenchmarks of the server hot path.
+
+Every benchmark is measured at several store sizes. The stores are built from synthetic logs in the
+schema of `data_manager.fieldnames`; a synthetic user visits several times, so lookups find real matches.
+For every benchmark and size the suite reports ops/sec, latency percentiles (p50, p95, p99) and the peak
+memory allocated by one call (measured separately with tracemalloc, so it does not distort the timings).
+`load_snapshot` is the startup of the server: loading the store from its snapshot and the CSV file behind it.
+
+Results are written to a JSON file. Given the results of an earlier run (`--compare`), every benchmark whose
+p50 latency grew by more than the threshold is flagged as a regression and the script exits with status 1.
+The scaling exponent column is the slope of the p50 latency between two sizes on a log-log scale
+(0 is constant time, 1 is linear).
+
+Usage:
+    python benchmark.py
+    python benchmark.py --sizes 100 1000 10000 --output before.json
+    python benchmark.py --output after.json --compare before.json --threshold 0.2
+"""
+
+DEFAULT_SIZES = [100, 1_000, 10_000, 100_000, 1_000_000]
+
+# Number of logs of every synthetic user
+VISITS = 3
+
+attribute_names = [
+    "IP", "CPU", "Memory", "Screen Width", "Screen Height",
+    "Usable Screen Width", "Usable Screen Height", "Color Depth", "Touch Screen", "Browser name",
+    "Browser core", "Navigator properties", "Browser permissions", "IndexedDB", "Open database",
+    "Local storage", "Session storage", "Global Storage", "PDF Viewer", "Cookies Enabled",
+    "Do not track", "AdBlock", "Encryption methods", "Navigator Vendor", "Vendor",
+    "Unmasked Vendor", "Renderer", "Unmasked Renderer", "Shading Langueage Versions"
+]
+
+def _hash(*parts):
+    return hashlib.sha256("-".join(str(part) for part in parts).encode()).hexdigest()
+
+def synthetic_user(user_id, seed=0):
+    """
+    Returns a synthetic fingerprint in the /check JSON shape (Attributes as a dict).
+    The values depend only on the user ID and the seed, so every visit of a user has the same fingerprint.
+    """
+    rng = random.Random(f"{seed}-{user_id}")
+    attributes = {
+        "IP": f"10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)}",
+        "CPU": rng.choice([2, 4, 8, 12, 16]),
+        "Memory": rng.choice(["2 GB", "4 GB", "8 GB"]),
+        "Screen Width": rng.choice([1366, 1920, 2560]),
+        "Screen Height": rng.choice([768, 1080, 1440]),
+    }
+    attributes["Usable Screen Width"] = attributes["Screen Width"]
+    attributes["Usable Screen Height"] = attributes["Screen Height"]
+    for name in attribute_names[len(attributes):]:
+        attributes[name] = rng.choice([f"{name} {value}" for value in range(4)])
+
+    user = {name: _hash(seed, name, user_id) for name in ["AttributesHash", "Audio", "Geom Canvas", "TXT Canvas", "Fonts", "MediaHash", "PluginsHash"]}
+    user.update({
+        "Attributes": attributes,
+        "Media Capabilities": repr({"0": ["audioinput", "No label defined"]}),
+        "Plugins": repr({"PDF Viewer": _hash("plugin", user_id % 97)[:32]}),
+        "Name": "Not available",
+    })
+    return user
+
+def stored_log(user, user_id, log):
+    """
+    Returns a synthetic fingerprint as it is stored (Attributes as a string, with ID and Log).
+    """
+    row = dict(user, ID=user_id, Log=log, Attributes=repr(user["Attributes"]))
+    return {key: row.get(key) for key in fieldnames}
+
+def build_store(size, seed=0):
+    """
+    Builds a store of `size` synthetic logs, VISITS logs per user.
+    """
+    store = FingerprintStore()
+    for position in range(size):
+        user_id = position // VISITS
+        store.ingest(stored_log(synthetic_user(user_id, seed), user_id, position % VISITS))
+    return store
+
+def probes(size, seed=0):
+    """
+    Returns the users the benchmarks are called with: a returning user and a new one.
+    """
+    return [synthetic_user((size // VISITS) // 2, seed), synthetic_user(size, seed)]
+
+def measure(function, min_time=0.5, min_calls=5, max_calls=1000):
+    """
+    Calls a function repeatedly and measures its latency and memory.
+
+    Returns:
+    - dict: ops/sec, p50/p95/p99 latency in microseconds and the peak memory of one call in KiB.
+    """
+    latencies = []
+    start = time.perf_counter()
+    while len(latencies) < max_calls and (len(latencies) < min_calls or time.perf_counter() - start < min_time):
+        call_start = time.perf_counter_ns()
+        function()
+        latencies.append(time.perf_counter_ns() - call_start)
+    total = sum(latencies) / 1e9
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies.sort()
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] / 1e3
+
+    return {
+        "calls": len(latencies),
+        "ops_per_sec": len(latencies) / total if total else float("inf"),
+        "p50_us": percentile(50),
+        "p95_us": percentile(95),
+        "p99_us": percentile(99),
+        "peak_kib": peak / 1024,
+    }
+
+def benchmarks(store, users_file, snapshot_file, probes):
+    """
+    Returns the benchmarked calls for one store. Each probe is used in turn.
+    """
+    turn = {"value": 0}
+    def probe():
+        turn["value"] += 1
+        return probes[turn["value"] % len(probes)]
+
+    return {
+        "test_farbling": lambda: test_farbling(probe()["Attributes"]),
+        "test_resolution": lambda: test_resolution(probe()["Attributes"]["Screen Width"] + 7, 1080),
+        "naive_search": lambda: naive_search(store, probe()),
+        "check_attributes": lambda: check_attributes(store, probe()),
+        "check_hashes": lambda: check_hashes(store, probe()),
+        "find_repeat": lambda: store.find_repeat(probe()),
+        "find_audio_and_canvas_match": lambda: find_audio_and_canvas_match(store, probe()),
+        "get_next_log": lambda: get_next_log(store, probe(), (len(store) // VISITS) // 2),
+        "load_users": lambda: load_users(users_file),
+        "load_snapshot": lambda: FingerprintStore(CsvBackend(users_file), snapshot_path=snapshot_file).load(),
+    }
+
+# Benchmarks that do not depend on the store, they are only measured at the first size
+store_independent = {"test_farbling", "test_resolution"}
+
+def run(sizes, seed=0, only=None):
+    """
+    Runs all benchmarks at all sizes.
+
+    Parameters:
+    - sizes (list): Store sizes.
+    - seed (int): Seed of the synthetic data.
+    - only (list): Names of the benchmarks to run, all by default.
+
+    Returns:
+    - list: One result per benchmark and size.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for index, size in enumerate(sizes):
+            print(f"[BENCHMARK] Building store of {size} logs", file=sys.stderr)
+            store = build_store(size, seed)
+            users_file = os.path.join(directory, f"fp_data_{size}.csv")
+            CsvBackend(users_file).write_many(store.rows)
+            snapshot_file = os.path.join(directory, f"fp_snapshot_{size}.bin")
+            snapshot.save(store, snapshot_file, CsvBackend(users_file).checkpoint())
+
+            for name, function in benchmarks(store, users_file, snapshot_file, probes(size, seed)).items():
+                if only and name not in only:
+                    continue
+                if name in store_independent and index > 0:
+                    continue
+                # The algorithms print every decision, which would dominate the timings
+                with contextlib.redirect_stdout(io.StringIO()):
+                    result = measure(function)
+                results.append({"benchmark": name, "size": size, **result})
+                print(f"[BENCHMARK] {name:<28} {size:>9} {result['p50_us']:>12.1f} us", file=sys.stderr)
+    return results
+
+def print_results(results):
+    """
+    Prints the results as a table per benchmark, with the scaling exponent between consecutive sizes.
+    """
+    print(f"{'Benchmark':<28} {'Size':>9} {'ops/sec':>12} {'p50 us':>12} {'p95 us':>12} {'p99 us':>12} {'peak KiB':>10} {'scaling':>8}")
+    print("-" * 110)
+    previous = None
+    for result in sorted(results, key=lambda result: (result["benchmark"], result["size"])):
+        scaling = ""
+        if previous and previous["benchmark"] == result["benchmark"] and previous["p50_us"] > 0:
+            scaling = f"{math.log(result['p50_us'] / previous['p50_us']) / math.log(result['size'] / previous['size']):.2f}"
+        print(f"{result['benchmark']:<28} {result['size']:>9} {result['ops_per_sec']:>12.1f} {result['p50_us']:>12.1f} "
+              f"{result['p95_us']:>12.1f} {result['p99_us']:>12.1f} {result['peak_kib']:>10.1f} {scaling:>8}")
+        previous = result
+
+def compare(results, baseline, threshold):
+    """
+    Compares the results with the results of an earlier run.
+
+    Parameters:
+    - results (list): The current results.
+    - baseline (list): The earlier results.
+    - threshold (float): Allowed relative growth of the p50 latency.
+
+    Returns:
+    - list: The regressed results, each with its baseline p50 latency.
+    """
+    earlier = {(result["benchmark"], result["size"]): result for result in baseline}
+    regressions = []
+    for result in results:
+        before = earlier.get((result["benchmark"], result["size"]))
+        if before and result["p50_us"] > before["p50_us"] * (1 + threshold):
+            regressions.append(dict(result, baseline_p50_us=before["p50_us"]))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the server hot path at several store sizes.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--only", nargs="+", help="Names of the benchmarks to run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.json", help="File the results are written to")
+    parser.add_argument("--compare", help="Results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed relative growth of the p50 latency")
+    args = parser.parse_args()
+
+    results = run(sorted(args.sizes), args.seed, args.only)
+    print_results(results)
+
+    with open(args.output, "w") as file:
+        json.dump({"python": platform.python_version(), "machine": platform.machine(), "results": results}, file, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for result in regressions:
+            print(f"[REGRESSION] {result['benchmark']} at {result['size']} logs: "
+                  f"p50 {result['baseline_p50_us']:.1f} us -> {result['p50_us']:.1f} us")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.compare}")
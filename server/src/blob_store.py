@@ -0,0 +1,265 @@
+import argparse
+import csv
+import hashlib
+import os
+import tempfile
+import time
+
+"""
+blob_store.py: This script stores the large nested payloads of the fingerprint logs once, keyed by their content.
+
+Media Capabilities and Plugins are written on every log next to their MediaHash / PluginsHash, although only
+a few hundred distinct payloads occur. With blobs enabled, every payload is written once to the blob directory,
+named by the SHA-256 of its text, and the log only holds a reference ("blob:" and the SHA-256). Two references
+are equal exactly when the payloads are, and writing a payload that is already stored writes nothing.
+Fonts is stored as its hash only, so there is no payload to move.
+
+Payloads shorter than a reference (e.g. "Not available") stay in the log.
+
+The storage backend resolves the references when the server loads its logs, reading every distinct blob once,
+so the fingerprint store holds the same rows as without blobs. Analysis reading fp_data.csv directly
+(`data_manager.load_users`) gets the references, and loads only the payloads it needs, with `BlobStore.get`
+or `resolve_blobs`.
+
+Configuration (environment variables):
+- FP_BLOBS: Blob directory. Blobs are disabled if it is not set.
+
+Classes:
+- BlobStore: Directory of payloads named by the SHA-256 of their text.
+- BlobBackend: Storage backend that moves the payloads of every log to a BlobStore.
+
+Functions:
+- is_reference: Tells whether a stored value is a blob reference.
+- resolve_blobs: Replaces the blob references of a DataFrame of logs by their payloads.
+- from_env: Wraps a storage backend in a BlobBackend if FP_BLOBS is set.
+
+Usage:
+    python blob_store.py pack ../fp_data.csv
+    python blob_store.py unpack ../fp_data.csv
+"""
+
+BLOB_DIR = "../fp_blobs"
+
+PREFIX = "blob:"
+
+# Columns whose payloads are stored as blobs
+blob_fieldnames = ["Media Capabilities", "Plugins"]
+
+# Payloads shorter than a reference stay in the log
+MIN_SIZE = len(PREFIX) + 64
+
+def is_reference(value):
+    """
+    Tells whether a stored value is a blob reference.
+    """
+    return isinstance(value, str) and value.startswith(PREFIX) and len(value) == MIN_SIZE
+
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and value != value) or value == ""
+
+class BlobStore:
+    """
+    Directory of payloads, every payload in a file named by the SHA-256 of its text.
+    Payloads that were read or written are cached, so every blob is read at most once.
+    """
+
+    def __init__(self, directory=BLOB_DIR):
+        """
+        Parameters:
+        - directory (str): The blob directory, created if it does not exist.
+        """
+        self.directory = directory
+        self._cache = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def __contains__(self, key):
+        return key in self._cache or os.path.isfile(self._path(key))
+
+    def __len__(self):
+        return sum(1 for name in os.listdir(self.directory) if not name.endswith(".tmp"))
+
+    def put(self, text):
+        """
+        Stores a payload if it is not stored yet. The blob is on disk before this returns, so a log referencing
+        it can never be written before the blob.
+
+        Parameters:
+        - text (str): The payload as it is written to the CSV file.
+
+        Returns:
+        - str: The SHA-256 of the payload.
+        """
+        key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        if key in self:
+            self._cache.setdefault(key, text)
+            return key
+        descriptor, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(descriptor, "w", encoding="utf-8", newline="") as file:
+            file.write(text)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self._path(key))
+        self._cache[key] = text
+        return key
+
+    def get(self, key):
+        """
+        Returns the payload of a key, reading its file on first use.
+        """
+        text = self._cache.get(key)
+        if text is None:
+            with open(self._path(key), encoding="utf-8", newline="") as file:
+                text = self._cache[key] = file.read()
+        return text
+
+    def reference(self, value):
+        """
+        Returns the value to store for a payload: a reference to its blob, or the value itself
+        if it is missing or shorter than a reference.
+        """
+        if _is_missing(value) or is_reference(value):
+            return value
+        text = value if isinstance(value, str) else str(value)
+        if len(text) <= MIN_SIZE:
+            return value
+        return PREFIX + self.put(text)
+
+    def resolve(self, value):
+        """
+        Returns the payload of a stored value: the blob of a reference, any other value unchanged.
+        """
+        return self.get(value[len(PREFIX):]) if is_reference(value) else value
+
+class BlobBackend:
+    """
+    Storage backend whose logs reference their payloads in a BlobStore. Logs are written with references
+    and read with payloads. Other attributes (e.g. `start_compaction`) are those of the wrapped backend.
+    """
+
+    def __init__(self, backend, blobs):
+        """
+        Parameters:
+        - backend: Storage backend from `data_manager.open_backend`.
+        - blobs (BlobStore): The blob store.
+        """
+        self.backend = backend
+        self.blobs = blobs
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def _pack(self, user_data):
+        packed = dict(user_data)
+        for key in blob_fieldnames:
+            if key in packed:
+                packed[key] = self.blobs.reference(packed[key])
+        return packed
+
+    def _resolve(self, users):
+        for user_data in users:
+            for key in blob_fieldnames:
+                value = user_data.get(key)
+                if is_reference(value):
+                    user_data[key] = self.blobs.resolve(value)
+        return users
+
+    def read(self):
+        """
+        Returns all stored logs with their payloads.
+        """
+        return self._resolve(self.backend.read())
+
+    def read_since(self, marker):
+        """
+        Returns the logs stored after a checkpoint with their payloads, or None if the backend has no checkpoints
+        or does not match the marker.
+        """
+        if not hasattr(self.backend, "read_since"):
+            return None
+        users = self.backend.read_since(marker)
+        return None if users is None else self._resolve(users)
+
+    def write(self, user_data):
+        """
+        Stores the payloads of a log and appends the log with references.
+        """
+        self.backend.write(self._pack(user_data))
+
+    def write_many(self, users):
+        """
+        Stores the payloads of several logs and appends the logs with references.
+        """
+        packed = [self._pack(user_data) for user_data in users]
+        if hasattr(self.backend, "write_many"):
+            self.backend.write_many(packed)
+        else:
+            for user_data in packed:
+                self.backend.write(user_data)
+
+    def close(self):
+        self.backend.close()
+
+def resolve_blobs(users, blobs=None):
+    """
+    Replaces the blob references of a DataFrame of logs by their payloads, for analysis.
+
+    Parameters:
+    - users (pd.DataFrame): Logs as read by `data_manager.load_users`.
+    - blobs (BlobStore): The blob store, the one of FP_BLOBS (or BLOB_DIR) by default.
+
+    Returns:
+    - pd.DataFrame: A copy of the logs with the payloads.
+    """
+    if blobs is None:
+        blobs = BlobStore(os.environ.get("FP_BLOBS") or BLOB_DIR)
+    users = users.copy()
+    for key in blob_fieldnames:
+        if key in users.columns:
+            users[key] = users[key].map(blobs.resolve)
+    return users
+
+def from_env(backend):
+    """
+    Wraps a backend in a BlobBackend if FP_BLOBS is set, otherwise returns it unchanged.
+    """
+    directory = os.environ.get("FP_BLOBS")
+    return BlobBackend(backend, BlobStore(directory)) if directory else backend
+
+def _rewrite(file_path, convert):
+    """
+    Rewrites a CSV file with the payload columns converted, keeping the order of the logs and every other value as it is.
+
+    Returns:
+    - int: The number of rewritten logs.
+    """
+    tmp_path = file_path + ".tmp"
+    count = 0
+    with open(file_path, newline="", encoding="utf-8") as source, open(tmp_path, "w", newline="", encoding="utf-8") as target:
+        reader = csv.DictReader(source)
+        writer = csv.DictWriter(target, fieldnames=reader.fieldnames)
+        writer.writeheader()
+        for user_data in reader:
+            for key in blob_fieldnames:
+                if key in user_data:
+                    user_data[key] = convert(user_data[key])
+            writer.writerow(user_data)
+            count += 1
+    os.replace(tmp_path, file_path)
+    return count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move the payloads of a CSV file of logs to the blob store, or back.")
+    parser.add_argument("command", choices=["pack", "unpack"])
+    parser.add_argument("csv", nargs="?", default="../fp_data.csv", help="CSV file in the fp_data.csv schema")
+    parser.add_argument("--dir", default=os.environ.get("FP_BLOBS") or BLOB_DIR, help="Blob directory")
+    args = parser.parse_args()
+
+    blobs = BlobStore(args.dir)
+    size = os.path.getsize(args.csv)
+    start = time.perf_counter()
+    count = _rewrite(args.csv, blobs.reference if args.command == "pack" else blobs.resolve)
+    print(f"{args.command.capitalize()}ed {count} logs in {time.perf_counter() - start:.2f} s: "
+          f"{size} -> {os.path.getsize(args.csv)} bytes, {len(blobs)} blobs in {args.dir}")
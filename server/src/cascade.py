@@ -0,0 +1,257 @@
+import math
+import os
+import time
+import numpy as np
+
+from comparison import ComparisonContext
+from complex import adjust_for_farbling, calculate_similarities, complex_exhaustive, find_audio_and_canvas_match, find_best_candidate
+from naive import naive_search
+import metrics
+from log import get_logger
+
+"""
+cascade.py: This script runs the matching of a fingerprint as a cascade of tiers, from the cheapest to the most
+expensive, within a latency budget per request.
+
+Tiers:
+- exact: The repeat index of the store. An exact repeat of a stored fingerprint is a returning user.
+- hash_index: The canvas and audio hash indexes, the complex algorithm when farbling is not detected.
+- candidates: Scoring the candidates of candidate blocking (lsh.py), the complex algorithm when farbling is detected.
+- exhaustive: Scoring every stored log: the naive algorithm, and the complex algorithm when farbling is detected
+  and the candidates did not give a match.
+
+A tier that finds a match decides; otherwise the next tier runs. Once the budget is spent, the remaining
+stages are skipped and the exhaustive complex scan, which scores the store in chunks when a budget is set,
+is cut short, keeping the best match found so far. The hash index tier is a few lookups and always runs.
+The response tells which tier decided, and every skipped or cut short stage is counted on /metrics, so the
+share of degraded requests under load is visible.
+
+A fingerprint that no tier matched after stages were skipped is not known to be new: the skipped stages might
+have matched it. Such a Match is not conclusive, no tier decided it and it must not be saved as a new user.
+
+With all tiers enabled and no budget, the results are those of running the naive and complex algorithms
+in full, except that a fingerprint the candidates do not match is scored exhaustively as well.
+
+Configuration (environment variables):
+- FP_TIERS: Enabled tiers, "exact,hash_index,candidates,exhaustive" by default.
+- FP_BUDGET_MS: Latency budget of a request in milliseconds, 0 (no budget) by default.
+
+Classes:
+- Budget: Deadline of a request.
+- Match: The result of the cascade for one fingerprint.
+- Cascade: The configured tiers and budget.
+"""
+
+logger = get_logger(__name__)
+
+TIERS = ["exact", "hash_index", "candidates", "exhaustive"]
+
+# Number of logs scored at a time by the exhaustive complex scan when a budget is set
+SCAN_CHUNK = 65536
+
+class Budget:
+    """
+    Deadline of a request.
+    """
+
+    def __init__(self, seconds=None, start=None):
+        """
+        Parameters:
+        - seconds (float): Length of the budget, None for no budget.
+        - start (float): `time.perf_counter()` when the request started, now by default.
+        """
+        self.limited = seconds is not None
+        self.deadline = (time.perf_counter() if start is None else start) + seconds if self.limited else math.inf
+
+    def remaining(self):
+        """
+        Returns the remaining time in seconds.
+        """
+        return self.deadline - time.perf_counter()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+class Match:
+    """
+    The result of the cascade for one fingerprint.
+    """
+    __slots__ = ("repeat", "naive", "complex", "tier", "context", "exhausted")
+
+    def __init__(self):
+        self.repeat = None
+        self.naive = [False]
+        self.complex = [False]
+        self.tier = None
+        self.context = None
+        # Whether a stage was skipped or cut short because the budget was spent
+        self.exhausted = False
+
+    @property
+    def found_naive(self):
+        return self.repeat is not None or bool(self.naive[0])
+
+    @property
+    def found_complex(self):
+        return self.repeat is not None or bool(self.complex[0])
+
+    @property
+    def conclusive(self):
+        """
+        Whether the result can be saved: a match was found, or every stage ran in full.
+        """
+        return self.found_naive or self.found_complex or not self.exhausted
+
+class Cascade:
+    """
+    The configured tiers and budget of the matching cascade.
+    """
+
+    def __init__(self, tiers=None, budget_ms=None):
+        """
+        Parameters:
+        - tiers (list): Enabled tiers, FP_TIERS or all tiers by default.
+        - budget_ms (float): Latency budget of a request in milliseconds, FP_BUDGET_MS by default. 0 means no budget.
+        """
+        if tiers is None:
+            tiers = [tier.strip() for tier in os.environ.get("FP_TIERS", ",".join(TIERS)).split(",") if tier.strip()]
+        unknown = set(tiers) - set(TIERS)
+        if unknown:
+            raise ValueError(f"Unknown tiers: {', '.join(sorted(unknown))}")
+        self.tiers = [tier for tier in TIERS if tier in tiers]
+        if budget_ms is None:
+            budget_ms = float(os.environ.get("FP_BUDGET_MS", 0))
+        self.budget_seconds = budget_ms / 1000 if budget_ms > 0 else None
+
+    def budget(self, start=None):
+        """
+        Returns the budget of a request started at `start`, now by default.
+        """
+        return Budget(self.budget_seconds, start)
+
+    def _skip(self, budget, stage, result):
+        """
+        Tells whether a stage has to be skipped because the budget is spent, and counts it.
+        """
+        if budget.expired():
+            metrics.budget_exhausted_total.inc(stage, "skipped")
+            logger.info("Budget spent, skipping %s", stage)
+            result.exhausted = True
+            return True
+        return False
+
+    def match(self, store, user_data, farbling, budget=None, naive_user=None, naive_scores=None, complex_scores=None):
+        """
+        Matches a fingerprint against the store. The attributes of the user data are adjusted for farbling,
+        as the complex algorithm does.
+
+        Parameters:
+        - store (FingerprintStore): The store with all stored user records.
+        - user_data (dict): The submitted fingerprint, without Name.
+        - farbling (list): The result of `test_farbling` for the fingerprint.
+        - budget (Budget): The budget of the request, a new one by default.
+        - naive_user (dict): The fingerprint as the naive algorithm sees it (before the farbling adjustment), optional.
+        - naive_scores, complex_scores (np.array): Scores precomputed for a batch, optional.
+
+        Returns:
+        - Match: The results of both algorithms and the tier that decided. See `Match.conclusive` before saving it.
+        """
+        if budget is None:
+            budget = self.budget()
+        result = Match()
+        if len(store) == 0:
+            return result
+
+        # Tiers that ran and tiers that found a match
+        ran = []
+        found = []
+
+        # Tier 1: exact repeat of a stored fingerprint
+        if "exact" in self.tiers:
+            with metrics.stage("repeat"):
+                result.repeat = store.find_repeat(user_data)
+            metrics.repeats_total.inc("miss" if result.repeat is None else "hit")
+            ran.append("exact")
+            if result.repeat is not None:
+                adjust_for_farbling(user_data["Attributes"], farbling)
+                return self._decided(result, ran, ["exact"])
+
+        # Naive sees the attributes before the farbling adjustment made for complex
+        if naive_user is None:
+            naive_user = dict(user_data, Attributes=dict(user_data["Attributes"]))
+        adjust_for_farbling(user_data["Attributes"], farbling)
+        result.context = ComparisonContext(store)
+
+        # Tier 2: canvas and audio hash indexes, run even when the budget is spent as it only takes a few lookups
+        if not farbling[0] and "hash_index" in self.tiers:
+            with metrics.stage("hash_index"):
+                match = find_audio_and_canvas_match(store, user_data)
+            result.complex = [True, int(match[1]['ID'])] if match[0] else [False, -1]
+            ran.append("hash_index")
+            if match[0]:
+                found.append("hash_index")
+
+        # Tier 3: scoring the candidates of candidate blocking
+        if farbling[0] and complex_scores is None and "candidates" in self.tiers:
+            candidates = store.candidates(user_data)
+            if candidates is not None and not self._skip(budget, "candidates", result):
+                with metrics.stage("candidates"):
+                    result.complex = find_best_candidate(store, user_data, candidates, result.context)
+                ran.append("candidates")
+                if result.complex[0]:
+                    found.append("candidates")
+
+        # Tier 4: scoring every stored log
+        if "exhaustive" in self.tiers:
+            if not self._skip(budget, "naive", result):
+                with metrics.stage("naive"):
+                    result.naive = naive_search(store, naive_user, naive_scores, result.context)
+                ran.append("exhaustive")
+
+            if farbling[0] and not result.complex[0] and not self._skip(budget, "exhaustive", result):
+                with metrics.stage("exhaustive"):
+                    result.complex = self._scan(store, user_data, budget, complex_scores, result)
+                ran.append("exhaustive")
+
+            if result.naive[0] or ("exhaustive" in ran and result.complex[0] and not found):
+                found.append("exhaustive")
+
+        return self._decided(result, ran, found)
+
+    def _scan(self, store, user_data, budget, similarities, result):
+        """
+        The exhaustive complex scan. With a budget, the store is scored in chunks and the scan is cut short
+        when the budget is spent; the best match is then searched among the scored logs.
+        """
+        context = result.context
+        if not budget.limited or similarities is not None:
+            return complex_exhaustive(store, user_data, similarities, context)
+
+        scores = []
+        scored = 0
+        while scored < len(store):
+            if budget.expired():
+                metrics.budget_exhausted_total.inc("exhaustive", "cut_short")
+                logger.info("Budget spent, exhaustive scan cut short after %s of %s logs", scored, len(store))
+                result.exhausted = True
+                break
+            positions = np.arange(scored, min(scored + SCAN_CHUNK, len(store)))
+            scores.append(calculate_similarities(store, user_data, positions=positions, context=context))
+            scored += len(positions)
+
+        if scored == 0:
+            return [False, -1]
+        return find_best_candidate(store, user_data, np.arange(scored), similarities=np.concatenate(scores))
+
+    def _decided(self, result, ran, found):
+        """
+        Sets the deciding tier: the cheapest tier that found a match, or the last tier that ran.
+        No tier decided a result that is not conclusive.
+        """
+        if not result.conclusive:
+            result.tier = None
+            return result
+        result.tier = found[0] if found else (ran[-1] if ran else None)
+        if result.tier is not None:
+            metrics.tier_decisions_total.inc(result.tier)
+        return result
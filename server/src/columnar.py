@@ -0,0 +1,792 @@
+import hashlib
+import marshal
+import numpy as np
+from log import get_logger
+
+"""
+columnar.py: This script provides the columnar building blocks used by the fingerprint store.
+Stored values are dictionary-encoded: every distinct value of a column gets an integer code, and rows
+are kept as arrays of codes. Comparing a user against all stored logs is then a vectorised equality
+between an array of codes and the code of the user's value.
+
+Values are encoded through `freeze`, which turns lists and dicts into hashable values that are equal
+exactly when the original values are equal with `==`, so encoded comparison gives the same result
+as comparing the parsed values directly. Every distinct value is held once, in the dictionary of its column,
+and can be decoded back from its code; hex digests are held as their raw bytes, half the size of the string.
+
+Every structure can be saved as NumPy arrays (`arrays`) and restored from them (`restore`), which is how
+snapshot.py writes the store to disk and maps it back. A restored dictionary does not rebuild its Python dict:
+the values of the snapshot stay serialised in the arrays, found by binary search over `stable_hash` of their keys.
+
+Classes:
+- GrowableArray: NumPy array with amortised O(1) appends.
+- Dictionary: Codes of the distinct values of a column.
+- EncodedColumn: One dictionary-encoded column of the stored logs.
+- AttributeMatrix: Parsed Attributes of all stored logs, one code column per attribute name.
+- HashIndex: Inverted index from the codes of a column to the positions of the rows that have them.
+
+Functions:
+- freeze: Converts a value to a hashable value with the same equality.
+- intern_key: Returns the dictionary key of a value.
+- stable_hash: Returns a 64-bit hash of a dictionary key that is the same in every process.
+"""
+
+logger = get_logger(__name__)
+
+# Code of a stored row that does not contain the attribute
+MISSING = -1
+
+# Code of a user value that does not occur in the store (never equal to a stored code)
+UNKNOWN = -2
+
+# Marker for encoding a user without a default value for absent attributes
+ABSENT = object()
+
+# No row, in the arrays of positions of a HashIndex
+NONE = -1
+
+# Number of rows of a value from which HashIndex.lookup scans the codes instead of walking the chain
+WALK_LIMIT = 256
+
+# Length of a hex encoded SHA-256 digest
+HEX_DIGEST_LENGTH = 64
+
+# stable_hash of None and NaN, whose built-in hash differs between processes
+_CONSTANT_HASH = 0x9E3779B97F4A7C15
+
+_HASH_MASK = 2 ** 64 - 1
+
+class _Unmatchable:
+    """
+    Placeholder for values that cannot be hashed. It is only equal to itself, so it never matches.
+    """
+
+def freeze(value):
+    """
+    Converts a value to a hashable value that compares equal to another frozen value
+    exactly when the original values are equal.
+
+    Parameters:
+    - value: The value to convert (str, number, bool, None, list, tuple, dict or set).
+
+    Returns:
+    - A hashable representation of the value.
+    """
+    if isinstance(value, list):
+        return (list, tuple(freeze(item) for item in value))
+    if isinstance(value, tuple):
+        return (tuple, tuple(freeze(item) for item in value))
+    if isinstance(value, dict):
+        return (dict, frozenset((key, freeze(item)) for key, item in value.items()))
+    if isinstance(value, (set, frozenset)):
+        return frozenset(freeze(item) for item in value)
+    try:
+        hash(value)
+    except TypeError:
+        return _Unmatchable()
+    return value
+
+def intern_key(value):
+    """
+    Returns the key of a value in the dictionary of an EncodedColumn: the raw bytes of a lowercase hex digest,
+    the frozen value otherwise. The bytes of a digest are only equal to the bytes of the same digest, so keys
+    compare exactly as the values do.
+    """
+    if isinstance(value, str) and len(value) == HEX_DIGEST_LENGTH:
+        try:
+            digest = bytes.fromhex(value)
+        except ValueError:
+            return value
+        if digest.hex() == value:
+            return digest
+        return value
+    return freeze(value)
+
+def _digest(tag, data):
+    return int.from_bytes(hashlib.blake2b(tag + data, digest_size=8).digest(), "little")
+
+def stable_hash(key):
+    """
+    Returns a 64-bit hash of a dictionary key (a frozen value or an interned digest). Unlike `hash`,
+    it does not depend on the process (string hashing is salted per process), so it can be saved
+    in a snapshot. Keys that are equal have the same hash, e.g. 1, 1.0 and True.
+
+    Parameters:
+    - key: A key as returned by `freeze` or `intern_key`.
+
+    Returns:
+    - int: The hash, between 0 and 2^64 - 1.
+    """
+    if isinstance(key, str):
+        return _digest(b"s", key.encode("utf-8", "surrogatepass"))
+    if isinstance(key, bytes):
+        return _digest(b"b", key)
+    if isinstance(key, tuple):
+        return _digest(b"t", b"".join(stable_hash(item).to_bytes(8, "little") for item in key))
+    if isinstance(key, frozenset):
+        return _digest(b"f", b"".join(value.to_bytes(8, "little") for value in sorted(stable_hash(item) for item in key)))
+    if isinstance(key, type):
+        return _digest(b"y", key.__qualname__.encode())
+    if key is None or (isinstance(key, float) and key != key):
+        return _CONSTANT_HASH
+    # Numbers hash by value and without salt, other objects are never equal to a key of another process
+    return hash(key) & _HASH_MASK
+
+class GrowableArray:
+    """
+    One-dimensional NumPy array that doubles its capacity when full.
+    """
+
+    def __init__(self, dtype, fill=0, capacity=1024):
+        """
+        Parameters:
+        - dtype: NumPy dtype of the array.
+        - fill: Value used for unused capacity.
+        - capacity (int): Initial capacity.
+        """
+        self.fill = fill
+        self.size = 0
+        self._data = np.full(capacity, fill, dtype=dtype)
+
+    @classmethod
+    def restore(cls, values, fill=0):
+        """
+        Returns an array holding the given values without copying them, e.g. an array mapped from a snapshot.
+        They are copied to new memory when the array first grows.
+        """
+        array = cls.__new__(cls)
+        array.fill = fill
+        array._data = values
+        array.size = len(values)
+        return array
+
+    def __len__(self):
+        return self.size
+
+    def _reserve(self, size):
+        if size > len(self._data):
+            capacity = max(size, 2 * len(self._data))
+            data = np.full(capacity, self.fill, dtype=self._data.dtype)
+            data[:self.size] = self._data[:self.size]
+            self._data = data
+
+    def append(self, value):
+        """
+        Appends a single value.
+        """
+        self._reserve(self.size + 1)
+        self._data[self.size] = value
+        self.size += 1
+
+    def extend_fill(self, count):
+        """
+        Appends `count` copies of the fill value.
+        """
+        self._reserve(self.size + count)
+        self.size += count
+
+    @property
+    def values(self):
+        """
+        View of the used part of the array.
+        """
+        return self._data[:self.size]
+
+class Dictionary:
+    """
+    Codes of the distinct values of a column, numbered from 0 in the order the values are added.
+    Values are looked up by their key (`key(value)`), and the first value added for a key is kept.
+
+    A dictionary restored from a snapshot keeps the values of the snapshot serialised in arrays: `hashes` holds
+    the stable hashes of their keys in ascending order with the code of each in `order`, and value `code` is
+    `data[offsets[code]:offsets[code + 1]]`. Such values are found by binary search and deserialised on use;
+    values added later, and the snapshot values found since, are kept in a dict as usual.
+    """
+
+    def __init__(self, key=freeze):
+        """
+        Parameters:
+        - key (callable): Returns the key of a value.
+        """
+        self.key = key
+        self.codes = {}
+        self.added = []
+        self.base_size = 0
+        self.hashes = None
+        self.order = None
+        self.offsets = None
+        self.data = None
+
+    def __len__(self):
+        return self.base_size + len(self.added)
+
+    def get(self, key, default=None):
+        """
+        Returns the code of a key, or the default if no value has the key.
+        """
+        code = self.codes.get(key)
+        if code is None and self.base_size:
+            code = self._find(key)
+        return default if code is None else code
+
+    def _find(self, key):
+        target = stable_hash(key)
+        index = int(np.searchsorted(self.hashes, np.uint64(target)))
+        while index < len(self.hashes) and int(self.hashes[index]) == target:
+            code = int(self.order[index])
+            if self.key(self.value(code)) == key:
+                self.codes[key] = code
+                return code
+            index += 1
+        return None
+
+    def add(self, key, value):
+        """
+        Returns the code of a key, adding the value under a new code if no value has the key.
+        """
+        code = self.get(key)
+        if code is None:
+            code = self.codes[key] = len(self)
+            self.added.append(value)
+        return code
+
+    def value(self, code):
+        """
+        Returns the value of a code.
+        """
+        if code < self.base_size:
+            return marshal.loads(self.data[self.offsets[code]:self.offsets[code + 1]])
+        return self.added[code - self.base_size]
+
+    def arrays(self):
+        """
+        Returns the dictionary as arrays for a snapshot (see the class description).
+        Only the values added since the last restore are hashed and serialised.
+
+        Raises:
+        - ValueError: If a value cannot be serialised.
+        """
+        hashes = np.fromiter((stable_hash(self.key(value)) for value in self.added), dtype=np.uint64, count=len(self.added))
+        codes = np.arange(self.base_size, len(self), dtype=np.int32)
+        serialised = [marshal.dumps(value) for value in self.added]
+        sizes = np.fromiter((len(data) for data in serialised), dtype=np.int64, count=len(serialised))
+        if self.base_size:
+            hashes = np.concatenate([self.hashes, hashes])
+            codes = np.concatenate([self.order, codes])
+            data = np.concatenate([self.data, np.frombuffer(b"".join(serialised), dtype=np.uint8)])
+            offsets = np.concatenate([self.offsets, self.offsets[-1] + np.cumsum(sizes)])
+        else:
+            data = np.frombuffer(b"".join(serialised), dtype=np.uint8)
+            offsets = np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(sizes)])
+        by_hash = np.argsort(hashes, kind="stable")
+        return {"hashes": hashes[by_hash], "order": codes[by_hash], "offsets": offsets, "data": data}
+
+    def restore(self, arrays):
+        """
+        Replaces the content of the dictionary by the arrays of a snapshot.
+        """
+        self.codes = {}
+        self.added = []
+        self.hashes = arrays["hashes"]
+        self.order = arrays["order"]
+        self.offsets = arrays["offsets"]
+        self.data = arrays["data"]
+        self.base_size = len(self.offsets) - 1
+
+class EncodedColumn:
+    """
+    One column of the stored logs, dictionary-encoded to integer codes.
+    Missing values (NaN) get the MISSING code and never match.
+    Every distinct value is kept once in the dictionary, by code, so rows can be decoded.
+    """
+
+    def __init__(self):
+        self.dictionary = Dictionary(intern_key)
+        self.codes = GrowableArray(np.int32, fill=MISSING)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def append(self, value):
+        """
+        Encodes a value and appends it as a new row.
+
+        Returns:
+        - int: The code of the value.
+        """
+        if isinstance(value, float) and value != value:
+            code = MISSING
+        else:
+            key = intern_key(value)
+            code = self.dictionary.add(key, key if isinstance(key, bytes) else value)
+        self.codes.append(code)
+        return code
+
+    def encode(self, value):
+        """
+        Returns the code of a user's value, UNKNOWN if the value does not occur in the column.
+        """
+        return self.dictionary.get(intern_key(value), UNKNOWN)
+
+    def decode(self, code):
+        """
+        Returns the value of a code, NaN for MISSING.
+        """
+        if code < 0:
+            return float("nan")
+        value = self.dictionary.value(code)
+        return value.hex() if isinstance(value, bytes) else value
+
+    def value(self, position):
+        """
+        Returns the value of the row at a position.
+        """
+        return self.decode(self.codes.values[position])
+
+    def decode_all(self):
+        """
+        Returns the values of all rows as an object array, NaN where they are missing.
+        """
+        # The last entry is the value of MISSING (-1)
+        values = np.empty(len(self.dictionary) + 1, dtype=object)
+        for code in range(len(self.dictionary)):
+            values[code] = self.decode(code)
+        values[MISSING] = float("nan")
+        return values[self.codes.values]
+
+    def equal(self, value, start=0, positions=None):
+        """
+        Returns a boolean array telling which stored rows, from position `start` on
+        or at the given positions, are equal to the value.
+        """
+        rows = self.codes.values[start:] if positions is None else self.codes.values[positions]
+        code = self.encode(value)
+        if code == UNKNOWN:
+            return np.zeros(len(rows), dtype=bool)
+        return rows == code
+
+    def equal_many(self, values):
+        """
+        Compares several values with all stored rows in one pass.
+
+        Parameters:
+        - values (list): The users' values.
+
+        Returns:
+        - np.array: Boolean matrix with one row per value and one column per stored row.
+        """
+        codes = np.array([self.encode(value) for value in values], dtype=np.int32)
+        return codes[:, None] == self.codes.values[None, :]
+
+    def arrays(self):
+        """
+        Returns the column as arrays for a snapshot.
+        """
+        arrays = {"codes": self.codes.values}
+        arrays.update({"dictionary." + name: array for name, array in self.dictionary.arrays().items()})
+        return arrays
+
+    def restore(self, arrays):
+        """
+        Replaces the content of the column by the arrays of a snapshot.
+        """
+        self.codes = GrowableArray.restore(arrays["codes"], MISSING)
+        self.dictionary.restore({name.split(".", 1)[1]: array for name, array in arrays.items() if name != "codes"})
+
+class AttributeMatrix:
+    """
+    Parsed Attributes of all stored logs. Each attribute name has its own column of integer codes
+    and its own dictionary of values. The order of keys of each stored dict (its layout) is kept too,
+    because the complex algorithm weights attributes by their position in the stored dict.
+    For every layout, the number of rows with each code of a column is counted, so the sum of
+    the weighted scores over all rows is known without scoring them.
+    The first value seen for every code is kept, so the attributes of a row can be decoded.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.index = {}
+        self.dictionaries = []
+        self.columns = []
+        self.layouts = []
+        self._layout_ids = {}
+        self.row_layout = GrowableArray(np.int32)
+        self.code_counts = []
+        self._weights = {}
+
+    def __len__(self):
+        return len(self.row_layout)
+
+    def _column(self, name):
+        """
+        Returns the index of the column for an attribute, creating it if needed.
+        """
+        column = self.index.get(name)
+        if column is None:
+            column = len(self.names)
+            self.names.append(name)
+            self.index[name] = column
+            self.dictionaries.append(Dictionary())
+            self.code_counts.append({})
+            codes = GrowableArray(np.int32, fill=MISSING)
+            codes.extend_fill(len(self))
+            self.columns.append(codes)
+        return column
+
+    def append(self, attributes):
+        """
+        Encodes the attributes of one stored log and appends them as a new row.
+
+        Parameters:
+        - attributes (dict): The parsed Attributes of the log.
+
+        Returns:
+        - int: The position of the new row.
+        """
+        layout = tuple(attributes)
+        layout_id = self._layout_ids.get(layout)
+        if layout_id is None:
+            layout_id = len(self.layouts)
+            self.layouts.append(layout)
+            self._layout_ids[layout] = layout_id
+
+        row = [MISSING] * len(self.names)
+        for name, value in attributes.items():
+            column = self._column(name)
+            if column == len(row):
+                row.append(MISSING)
+            code = self.dictionaries[column].add(freeze(value), value)
+            row[column] = code
+
+            counts = self.code_counts[column].get(layout_id)
+            if counts is None:
+                counts = self.code_counts[column][layout_id] = GrowableArray(np.int64, capacity=16)
+            if len(counts) <= code:
+                counts.extend_fill(code + 1 - len(counts))
+            counts.values[code] += 1
+
+        for column, code in enumerate(row):
+            self.columns[column].append(code)
+        self.row_layout.append(layout_id)
+        return len(self) - 1
+
+    def decode(self, position):
+        """
+        Returns the attributes of the row at a position, with the keys in the order of its layout.
+        Values equal to an earlier value (1 and 1.0, for example) decode to the earlier value.
+        """
+        layout = self.layouts[self.row_layout.values[position]]
+        return {
+            name: self.dictionaries[self.index[name]].value(self.columns[self.index[name]].values[position])
+            for name in layout
+        }
+
+    def encode(self, attributes, default=ABSENT):
+        """
+        Encodes the attributes of a user with the dictionaries of the store.
+
+        Parameters:
+        - attributes (dict): The user's attributes.
+        - default: Value used for attributes the user does not have. By default such attributes never match.
+
+        Returns:
+        - np.array: One code per column, UNKNOWN where the user's value does not occur in the store.
+        """
+        codes = np.full(len(self.names), UNKNOWN, dtype=np.int32)
+        for column, name in enumerate(self.names):
+            if name in attributes:
+                value = attributes[name]
+            elif default is not ABSENT:
+                value = default
+            else:
+                continue
+            codes[column] = self.dictionaries[column].get(freeze(value), UNKNOWN)
+        return codes
+
+    def encode_many(self, attributes_list, default=ABSENT):
+        """
+        Encodes the attributes of several users, see `encode`.
+
+        Returns:
+        - np.array: Matrix of codes with one row per user and one column per attribute.
+        """
+        codes = np.full((len(attributes_list), len(self.names)), UNKNOWN, dtype=np.int32)
+        for row, attributes in enumerate(attributes_list):
+            codes[row] = self.encode(attributes, default)
+        return codes
+
+    def match_count(self, attributes, start=0):
+        """
+        Counts for every stored log how many of its attributes are equal to the user's attributes.
+
+        Parameters:
+        - attributes (dict): The user's attributes.
+        - start (int): Only logs from this position on are counted.
+
+        Returns:
+        - np.array: Number of equal attributes per stored log.
+        """
+        counts = np.zeros(len(self) - start, dtype=np.int64)
+        for column, code in enumerate(self.encode(attributes)):
+            if code != UNKNOWN:
+                counts += self.columns[column].values[start:] == code
+        return counts
+
+    def match_count_many(self, attributes_list):
+        """
+        Counts the equal attributes of several users against all stored logs in one pass over the columns.
+
+        Parameters:
+        - attributes_list (list): The attributes of every user.
+
+        Returns:
+        - np.array: Matrix with one row per user and one column per stored log.
+        """
+        codes = self.encode_many(attributes_list)
+        counts = np.zeros((len(attributes_list), len(self)), dtype=np.int64)
+        for column in range(len(self.names)):
+            user_codes = codes[:, column]
+            if (user_codes != UNKNOWN).any():
+                counts += user_codes[:, None] == self.columns[column].values[None, :]
+        return counts
+
+    def layout_weights(self, weights):
+        """
+        Builds the weight of every column for every layout, where an attribute gets the weight
+        at its position in the stored dict.
+
+        Parameters:
+        - weights (list): Weights by position in the stored dict.
+
+        Returns:
+        - np.array: Matrix of weights with one row per layout and one column per attribute.
+        """
+        key = (tuple(weights), len(self.layouts), len(self.names))
+        matrix = self._weights.get(key)
+        if matrix is None:
+            matrix = np.zeros((len(self.layouts), len(self.names)))
+            for layout_id, layout in enumerate(self.layouts):
+                for position, name in enumerate(layout):
+                    if position >= len(weights):
+                        logger.warning("attribute_weights index %s out of range for attribute '%s'", position, name)
+                        continue
+                    matrix[layout_id, self.index[name]] = weights[position]
+            self._weights = {key: matrix}
+        return matrix
+
+    def weighted_score(self, attributes, weights, default=ABSENT, start=0, positions=None):
+        """
+        Sums for every stored log the weights of its attributes that are equal to the user's attributes.
+
+        Parameters:
+        - attributes (dict): The user's attributes.
+        - weights (list): Weights by position in the stored dict.
+        - default: Value used for attributes the user does not have.
+        - start (int): Only logs from this position on are scored.
+        - positions (np.array): Only the logs at these positions are scored, optional.
+
+        Returns:
+        - np.array: Weighted similarity per stored log.
+        """
+        rows = slice(start, None) if positions is None else positions
+        matrix = self.layout_weights(weights)
+        row_layout = self.row_layout.values[rows]
+        scores = np.zeros(len(row_layout))
+        for column, code in enumerate(self.encode(attributes, default)):
+            if code == UNKNOWN:
+                continue
+            hits = self.columns[column].values[rows] == code
+            scores[hits] += matrix[row_layout[hits], column]
+        return scores
+
+    def weighted_score_sum(self, attributes, weights, default=ABSENT):
+        """
+        Returns the sum of `weighted_score` over all stored logs, computed from the code counts
+        in time independent of the number of logs.
+        """
+        matrix = self.layout_weights(weights)
+        total = 0.0
+        for column, code in enumerate(self.encode(attributes, default)):
+            if code == UNKNOWN:
+                continue
+            for layout_id, counts in self.code_counts[column].items():
+                if code < len(counts):
+                    total += counts.values[code] * matrix[layout_id, column]
+        return total
+
+    def weighted_score_many(self, attributes_list, weights, default=ABSENT):
+        """
+        Weighted similarity of several users against all stored logs in one pass over the columns, see `weighted_score`.
+
+        Returns:
+        - np.array: Matrix with one row per user and one column per stored log.
+        """
+        matrix = self.layout_weights(weights)
+        row_layout = self.row_layout.values
+        codes = self.encode_many(attributes_list, default)
+        scores = np.zeros((len(attributes_list), len(self)))
+        for column in range(len(self.names)):
+            user_codes = codes[:, column]
+            if (user_codes == UNKNOWN).all():
+                continue
+            column_weights = matrix[row_layout, column]
+            scores += (user_codes[:, None] == self.columns[column].values[None, :]) * column_weights[None, :]
+        return scores
+
+    def arrays(self):
+        """
+        Returns the matrix as arrays for a snapshot. Names and layouts are serialised, and the code counts
+        of all columns and layouts are concatenated, with their column, layout and length in `code_counts.index`.
+        """
+        arrays = {
+            "names": np.frombuffer(marshal.dumps(self.names), dtype=np.uint8),
+            "layouts": np.frombuffer(marshal.dumps(self.layouts), dtype=np.uint8),
+            "row_layout": self.row_layout.values,
+        }
+        counts = []
+        index = []
+        for column, dictionary in enumerate(self.dictionaries):
+            arrays[f"columns.{column}"] = self.columns[column].values
+            for name, array in dictionary.arrays().items():
+                arrays[f"dictionaries.{column}.{name}"] = array
+            for layout_id, layout_counts in self.code_counts[column].items():
+                counts.append(layout_counts.values)
+                index += [column, layout_id, len(layout_counts)]
+        arrays["code_counts"] = np.concatenate(counts) if counts else np.zeros(0, dtype=np.int64)
+        arrays["code_counts.index"] = np.array(index, dtype=np.int64)
+        return arrays
+
+    def restore(self, arrays):
+        """
+        Replaces the content of the matrix by the arrays of a snapshot.
+        """
+        self.__init__()
+        dictionaries = {}
+        for key, array in arrays.items():
+            if key.startswith("dictionaries."):
+                _, column, name = key.split(".", 2)
+                dictionaries.setdefault(int(column), {})[name] = array
+        for name in marshal.loads(arrays["names"]):
+            column = self._column(name)
+            self.columns[column] = GrowableArray.restore(arrays[f"columns.{column}"], MISSING)
+            self.dictionaries[column].restore(dictionaries[column])
+        self.layouts = [tuple(layout) for layout in marshal.loads(arrays["layouts"])]
+        self._layout_ids = {layout: layout_id for layout_id, layout in enumerate(self.layouts)}
+        self.row_layout = GrowableArray.restore(arrays["row_layout"])
+        offset = 0
+        for column, layout_id, length in arrays["code_counts.index"].reshape(-1, 3).tolist():
+            self.code_counts[column][layout_id] = GrowableArray.restore(arrays["code_counts"][offset:offset + length])
+            offset += length
+
+class HashIndex:
+    """
+    Inverted index from the codes of an EncodedColumn to the positions of the rows that have them.
+    The rows with the same code are chained in ingest order through an array of next positions,
+    so the index costs one integer per row and four per distinct value instead of a list per value.
+    The first row of every code by sort key and the number of rows of every code are kept too, so the first
+    match and the count are returned without walking the chain. The rows of a value shared by many rows
+    are found by a vectorised scan of the codes, which is faster than walking a long chain.
+    """
+
+    def __init__(self, column, sort_key):
+        """
+        Parameters:
+        - column (EncodedColumn): The indexed column.
+        - sort_key (callable): Returns the sort key of the row at a position, the row with the smallest key is the first one.
+        """
+        self.column = column
+        self.sort_key = sort_key
+        self.heads = GrowableArray(np.int32, fill=NONE)
+        self.starts = GrowableArray(np.int32, fill=NONE)
+        self.tails = GrowableArray(np.int32, fill=NONE)
+        self.counts = GrowableArray(np.int32)
+        self.next = GrowableArray(np.int32, fill=NONE)
+
+    def add(self, position, key):
+        """
+        Adds a row to the index, after its value has been appended to the column.
+        Missing values are not indexed, as they never match.
+
+        Parameters:
+        - position (int): The position of the row.
+        - key (tuple): Sort key of the row.
+        """
+        if len(self.next) <= position:
+            self.next.extend_fill(position + 1 - len(self.next))
+        code = self.column.codes.values[position]
+        if code < 0:
+            return
+        if len(self.starts) <= code:
+            for array in (self.heads, self.starts, self.tails, self.counts):
+                array.extend_fill(code + 1 - len(array))
+        self.counts.values[code] += 1
+        tail = self.tails.values[code]
+        self.tails.values[code] = position
+        if tail == NONE:
+            self.starts.values[code] = position
+            self.heads.values[code] = position
+            return
+        self.next.values[tail] = position
+        if key < self.sort_key(self.heads.values[code]):
+            self.heads.values[code] = position
+
+    def _code(self, value):
+        code = self.column.encode(value)
+        return code if 0 <= code < len(self.starts) else None
+
+    def lookup(self, value):
+        """
+        Returns the positions of all rows with the given value.
+
+        Returns:
+        - np.array: The positions in ingest order.
+        """
+        code = self._code(value)
+        if code is None:
+            return np.zeros(0, dtype=np.int64)
+        return self.positions(code)
+
+    def positions(self, code):
+        """
+        Returns the positions of all rows with a code, in ingest order.
+        """
+        count = self.counts.values[code]
+        if count > WALK_LIMIT:
+            return np.flatnonzero(self.column.codes.values == code)
+        positions = np.empty(count, dtype=np.int64)
+        following = self.next.values
+        position = self.starts.values[code]
+        for index in range(count):
+            positions[index] = position
+            position = following[position]
+        return positions
+
+    def count(self, value):
+        """
+        Returns the number of rows with the given value.
+        """
+        code = self._code(value)
+        return 0 if code is None else int(self.counts.values[code])
+
+    def first(self, value):
+        """
+        Returns the position of the first row with the given value, or None if there is no such row.
+        """
+        code = self._code(value)
+        if code is None or self.heads.values[code] == NONE:
+            return None
+        return int(self.heads.values[code])
+
+    def arrays(self):
+        """
+        Returns the index as arrays for a snapshot.
+        """
+        return {name: getattr(self, name).values for name in ("heads", "starts", "tails", "counts", "next")}
+
+    def restore(self, arrays):
+        """
+        Replaces the content of the index by the arrays of a snapshot.
+        """
+        for name in ("heads", "starts", "tails", "next"):
+            setattr(self, name, GrowableArray.restore(arrays[name], NONE))
+        self.counts = GrowableArray.restore(arrays["counts"])
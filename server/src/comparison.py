@@ -0,0 +1,102 @@
+import numpy as np
+
+from columnar import UNKNOWN
+
+"""
+comparison.py: This script provides the comparison context of a request. For one /check the fingerprint is
+compared with the store by the naive algorithm, by the complex algorithm and, when the two disagree,
+by the user manager. The context compares every column and every attribute with the store once and
+all three derive their scores from the same equality arrays.
+
+Equality arrays are cached by column and code of the compared value, so the complex algorithm, which compares
+the attributes adjusted for farbling, only compares again the attributes the adjustment changed.
+The context covers the logs stored when it was created; logs saved later are not part of it.
+
+Classes:
+- ComparisonContext: Cached equality of the values of one request with all stored logs.
+"""
+
+class ComparisonContext:
+    """
+    Cached equality of the values of one request with all stored logs.
+    """
+
+    def __init__(self, store):
+        """
+        Parameters:
+        - store (FingerprintStore): The store compared with.
+        """
+        self.store = store
+        self.size = len(store)
+        self._columns = {}
+        self._attributes = {}
+
+    def __len__(self):
+        return self.size
+
+    def column_equal(self, column, value):
+        """
+        Returns a boolean array telling which stored logs have the value in a column.
+
+        Parameters:
+        - column (str): The column name.
+        - value: The compared value.
+        """
+        code = self.store.columns[column].encode(value)
+        key = (column, code)
+        equal = self._columns.get(key)
+        if equal is None:
+            if code == UNKNOWN:
+                equal = np.zeros(self.size, dtype=bool)
+            else:
+                equal = self.store.columns[column].codes.values[:self.size] == code
+            self._columns[key] = equal
+        return equal
+
+    def attribute_equal(self, column, code):
+        """
+        Returns a boolean array telling which stored logs have the encoded value of an attribute.
+
+        Parameters:
+        - column (int): The column of the attribute in the attribute matrix.
+        - code (int): The code of the compared value, see `AttributeMatrix.encode`.
+        """
+        key = (column, code)
+        equal = self._attributes.get(key)
+        if equal is None:
+            equal = self.store.attributes.columns[column].values[:self.size] == code
+            self._attributes[key] = equal
+        return equal
+
+    def match_count(self, attributes):
+        """
+        Counts for every stored log how many of its attributes are equal to the attributes,
+        see `AttributeMatrix.match_count`.
+        """
+        counts = np.zeros(self.size, dtype=np.int64)
+        for column, code in enumerate(self.store.attributes.encode(attributes)):
+            if code != UNKNOWN:
+                counts += self.attribute_equal(column, code)
+        return counts
+
+    def weighted_score(self, attributes, weights, default, positions=None):
+        """
+        Sums for every stored log the weights of its attributes that are equal to the attributes,
+        see `AttributeMatrix.weighted_score`.
+
+        Parameters:
+        - positions (np.array): Only the logs at these positions are scored, optional.
+        """
+        matrix = self.store.attributes.layout_weights(weights)
+        row_layout = self.store.attributes.row_layout.values[:self.size]
+        if positions is not None:
+            row_layout = row_layout[positions]
+        scores = np.zeros(len(row_layout))
+        for column, code in enumerate(self.store.attributes.encode(attributes, default)):
+            if code == UNKNOWN:
+                continue
+            hits = self.attribute_equal(column, code)
+            if positions is not None:
+                hits = hits[positions]
+            scores[hits] += matrix[row_layout[hits], column]
+        return scores
@@ -1,13 +1,20 @@
 import numpy as np
-import ast
 from data_manager import *
+from fingerprint_store import as_store
+from log import get_logger
+
+logger = get_logger(__name__)
 
 
 # Hash weights: These weights are used to score how similar the user's hash attributes are with the data.
-# Attr, Audio, Fonts, Geom, MediaHash, Name, PluginsHash, TXT
-hash_weights = [
-    0, 10, 2, 10, 4, 0, 4, 10
-]
+# Keyed by column name. Columns without a weight are not scored.
+# These are the weights the old positional list actually applied. They do not match its removed comment
+# "Attr, Audio, Fonts, Geom, MediaHash, Name, PluginsHash, TXT", which would give Audio 10, Fonts 2,
+# PluginsHash 4 and TXT Canvas 10. Using those changes the complex results.
+hash_weights = {
+    "Audio": 0, "Geom Canvas": 10, "TXT Canvas": 2,
+    "Fonts": 10, "MediaHash": 4, "PluginsHash": 0
+}
 
 # Attribute weights: These weights are used to score how similar the user's attributes are with the data.
 # IP, CPU, Memory, Screen Width, Screen Height
@@ -25,150 +32,128 @@ attribute_weights = [
     2, 2, 2, 2, 2
 ]
 
-def compare_attribute(curr_attr_value, user_attr_value, weight):
-    """
-    Compares the attribute value from the dataset with the user's attribute value and 
-    returns the weight if they match.
-    
-    Parameters:
-    curr_attr_value (str): The current attribute value from the dataset.
-    user_attr_value (str): The user's attribute value to compare against.
-    weight (int): The weight for this attribute match.
-
-    Returns:
-    int: The weight if values match, 0 otherwise.
+def find_audio_and_canvas_match(users, user_data):
     """
-    if curr_attr_value == user_attr_value:
-        return weight
-    return 0
+    Checks for matches based on audio, geometry canvas, and text canvas. Returns the first match found.
+    Each check is a single lookup in the hash index of the store.
 
-def find_similar_value(users, user_data, key):
-    """
-    Finds users that have the same value for the specified key.
-    This is a more efficient approach than iterating manually.
-    
     Parameters:
-    users (DataFrame): The DataFrame containing all the users.
+    users (FingerprintStore or DataFrame): All the stored users.
     user_data (dict): The data of the user to compare against.
-    key (str): The key (attribute) to search for in the dataset.
 
     Returns:
-    DataFrame: A filtered DataFrame containing users with the same value for the specified key.
+    list: A list containing a boolean indicating if a match was found and the matching user data if found.
     """
-    return users[users[key] == user_data[key]]
+    store = as_store(users)
 
-def find_similar_hashes(users, user_data):
-    """
-    Finds users who have matching values for specific attributes (audio, geom, txt canvas, etc.)
-    This returns a list of DataFrames containing matches for each key.
+    for key in ["Audio", "Geom Canvas", "TXT Canvas"]:
+        position = store.first_match(key, user_data[key])
+        if position is not None:
+            return [True, store.row(position)]
     
-    Parameters:
-    users (DataFrame): The DataFrame containing all the users.
-    user_data (dict): The data of the user to compare against.
+    return [False, None]
 
-    Returns:
-    list: A list of DataFrames containing users who have matching hash values for various keys.
+def check_hashes(users, user_data, start=0, positions=None, context=None):
     """
-    
-    # List of keys for the attributes to check
-    keys = ["Audio", "Geom Canvas", "TXT Canvas", "Fonts", "MediaHash", "PluginsHash"]
-    matches = []
-
-    # For each key, find matching users and append them to the matches list
-    for key in keys:
-        matches.append(find_similar_value(users, user_data, key))
-
-    return matches
-
-def find_audio_and_canvas_match(users, user_data):
-    """
-    Checks for matches based on audio, geometry canvas, and text canvas. Returns the first match found.
+    Checks how similar the user data is to others based on various hash attributes (audio, fonts, plugins, etc.).
+    The score is a weighted sum of the equality vectors of the encoded hash columns of the store.
 
     Parameters:
-    users (DataFrame): The DataFrame containing all the users.
+    users (FingerprintStore or DataFrame): All the stored users.
     user_data (dict): The data of the user to compare against.
+    start (int): Only users from this position on are scored.
+    positions (np.array): Only the users at these positions are scored, optional.
+    context (ComparisonContext): Comparison context of the request, optional. It is used if it covers all users.
 
     Returns:
-    list: A list containing a boolean indicating if a match was found and the matching user data if found.
+    np.array: An array of similarity scores for each user based on hash attributes.
     """
-    audio_matches = users[users["Audio"] == user_data["Audio"]]
-    geom_matches = users[users["Geom Canvas"] == user_data["Geom Canvas"]]
-    txt_matches = users[users["TXT Canvas"] == user_data["TXT Canvas"]]
+    store = as_store(users)
+    if context is not None and start == 0 and len(context) == len(store):
+        similarities = np.zeros(len(store) if positions is None else len(positions))
+        for key, weight in hash_weights.items():
+            if weight:
+                equal = context.column_equal(key, user_data.get(key))
+                similarities += weight * (equal if positions is None else equal[positions])
+        return similarities
 
-    total_matches = len(audio_matches) + len(geom_matches) + len(txt_matches)
-    
-    if total_matches > 0:
-        if len(audio_matches) > 0:
-            return [True, audio_matches.iloc[0]]
-        if len(geom_matches) > 0:
-            return [True, geom_matches.iloc[0]]
-        return [True, txt_matches.iloc[0]]
-    
-    return [False, None]
+    similarities = np.zeros(len(store) - start if positions is None else len(positions))
+
+    for key, weight in hash_weights.items():
+        if weight:
+            similarities += weight * store.columns[key].equal(user_data.get(key), start=start, positions=positions)
+
+    return similarities
 
-def check_hashes(users, user_data):
+def check_hashes_many(users, users_data):
     """
-    Checks how similar the user data is to others based on various hash attributes (audio, fonts, plugins, etc.).
+    `check_hashes` for several users, comparing each hash column of the store once for all of them.
 
     Parameters:
-    users (DataFrame): The DataFrame containing all the users.
-    user_data (dict): The data of the user to compare against.
+    users (FingerprintStore or DataFrame): All the stored users.
+    users_data (list): The data of the users to compare against.
 
     Returns:
-    np.array: An array of similarity scores for each user based on hash attributes.
+    np.array: Matrix of similarity scores with one row per user and one column per stored user.
     """
-    similarities = np.zeros(len(users))
-    dfs = find_similar_hashes(users, user_data)
+    store = as_store(users)
+    similarities = np.zeros((len(users_data), len(store)))
 
-    # Skipping attribute 5 (Name of device - for debugging purposes only)
-    for df, curr_df in enumerate(dfs):
-        if df == 5:
-            continue
-        if len(curr_df) > 0:
-            matched_users = curr_df[curr_df['ID'].isin(users['ID'])]
-            for u, user in matched_users.iterrows():
-                similarities[u] += hash_weights[df]
+    for key, weight in hash_weights.items():
+        if weight:
+            similarities += weight * store.columns[key].equal_many([user_data.get(key) for user_data in users_data])
 
     return similarities
 
-def check_attributes(users, user_data):
+def check_attributes(users, user_data, start=0, positions=None, context=None):
     """
     Checks how similar the user's attributes are to the attributes of other users and scores them.
+    The stored attributes are pre-parsed in the attribute matrix of the store, and each attribute
+    is weighted by its position in the stored dict. Attributes the user does not have are compared as None.
 
     Parameters:
-    users (DataFrame): The DataFrame containing all the users.
+    users (FingerprintStore or DataFrame): All the stored users.
     user_data (dict): The data of the user to compare against.
+    start (int): Only users from this position on are scored.
+    positions (np.array): Only the users at these positions are scored, optional.
+    context (ComparisonContext): Comparison context of the request, optional. It is used if it covers all users.
 
     Returns:
     np.array: An array of similarity scores for each user based on their attributes.
     """
-    similarities = np.zeros(len(users))
+    store = as_store(users)
+    if context is not None and start == 0 and len(context) == len(store):
+        return context.weighted_score(user_data["Attributes"], attribute_weights, default=None, positions=positions)
+    return store.attributes.weighted_score(user_data["Attributes"], attribute_weights, default=None, start=start, positions=positions)
 
-    for u, user in users.iterrows():
-        attr_counter = 0
-        curr_attrs = ast.literal_eval(user["Attributes"])
+def check_attributes_many(users, users_data):
+    """
+    `check_attributes` for several users, comparing each attribute column of the store once for all of them.
 
-        # Compare attributes using the helper function
-        for attr, value in curr_attrs.items():
-            if attr_counter >= len(attribute_weights):
-                print(f"[WARNING] attribute_weights index {attr_counter} out of range for attribute '{attr}'")
-                continue
-            similarities[u] += compare_attribute(value, user_data["Attributes"].get(attr), attribute_weights[attr_counter])
-            attr_counter += 1
+    Parameters:
+    users (FingerprintStore or DataFrame): All the stored users.
+    users_data (list): The data of the users to compare against.
 
-    return similarities
+    Returns:
+    np.array: Matrix of similarity scores with one row per user and one column per stored user.
+    """
+    store = as_store(users)
+    attributes = [user_data["Attributes"] for user_data in users_data]
+    return store.attributes.weighted_score_many(attributes, attribute_weights, default=None)
 
-def dynamic_threshold(similarity_scores):
+def dynamic_threshold(similarity_scores, mean_similarity=None):
     """
     Dynamically calculates the threshold for determining a valid match based on the average similarity score.
 
     Parameters:
     similarity_scores (np.array): The array of similarity scores.
+    mean_similarity (float): The average similarity score over all users, if the scores are not of all users.
 
     Returns:
     int: The dynamically calculated threshold value for determining a match.
     """
-    mean_similarity = np.mean(similarity_scores)
+    if mean_similarity is None:
+        mean_similarity = np.mean(similarity_scores)
     return max(mean_similarity + 5, 70)
 
 def adjust_for_farbling(user_attributes, farbling):
@@ -183,67 +168,143 @@ def adjust_for_farbling(user_attributes, farbling):
     dict: Adjusted user attributes.
     """
     if farbling[0]:  # If farbling is detected
-        print("[COMPLEX] User is modifying its values")
+        logger.debug("User is modifying its values")
         user_attributes["Screen Width"], user_attributes["Screen Height"] = farbling[1][1]
     else:
-        print("[COMPLEX] User is not modifying its values")
+        logger.debug("User is not modifying its values")
     return user_attributes
 
-def calculate_similarities(users, user_data):
+def calculate_similarities(users, user_data, start=0, positions=None, context=None):
     """
     Calculates combined similarity scores based on hashes and attributes.
 
     Parameters:
-    users (DataFrame): The DataFrame containing all the users.
+    users (FingerprintStore or DataFrame): All the stored users.
     user_data (dict): The data of the user to compare against.
+    start (int): Only users from this position on are scored.
+    positions (np.array): Only the users at these positions are scored, optional.
+    context (ComparisonContext): Comparison context of the request, optional.
 
     Returns:
     np.array: Combined similarity scores.
     """
-    hash_similarities = check_hashes(users, user_data)
-    attr_similarities = check_attributes(users, user_data)
+    hash_similarities = check_hashes(users, user_data, start, positions, context)
+    attr_similarities = check_attributes(users, user_data, start, positions, context)
     return hash_similarities + attr_similarities
 
+def mean_similarity(users, user_data):
+    """
+    Calculates the average of the combined similarity scores over all users without scoring them:
+    hash matches are counted by the hash indexes and attribute matches by the attribute matrix of the store.
+
+    Parameters:
+    users (FingerprintStore or DataFrame): All the stored users.
+    user_data (dict): The data of the user to compare against.
+
+    Returns:
+    float: The average similarity score, equal to the mean of `calculate_similarities`.
+    """
+    store = as_store(users)
+    total = sum(weight * store.count(key, user_data.get(key)) for key, weight in hash_weights.items() if weight)
+    total += store.attributes.weighted_score_sum(user_data["Attributes"], attribute_weights, default=None)
+    return total / len(store)
+
+def calculate_similarities_many(users, users_data):
+    """
+    Calculates combined similarity scores of several users in one pass over the store.
+
+    Parameters:
+    users (FingerprintStore or DataFrame): All the stored users.
+    users_data (list): The data of the users to compare against, with attributes already adjusted for farbling.
+
+    Returns:
+    np.array: Matrix of combined similarity scores with one row per user.
+    """
+    return check_hashes_many(users, users_data) + check_attributes_many(users, users_data)
+
 def find_best_match(similarities, users):
     """
     Finds the best match based on similarity scores and a dynamic threshold.
 
     Parameters:
     similarities (np.array): Array of similarity scores.
-    users (DataFrame): The DataFrame containing all the users.
+    users (FingerprintStore or DataFrame): All the stored users.
 
     Returns:
     list: A list containing a boolean indicating if a match was found and the matching user ID.
     """
-    res = np.argmax(similarities)
+    store = as_store(users)
+    res = store.best(similarities)
     threshold = dynamic_threshold(similarities)
+    user_id = int(store.ids.values[res])
 
     if similarities[res] >= threshold:
-        print(f"[COMPLEX] Match with {int(users.iloc[res]['ID'])} with {similarities[res]} points")
-        return [True, int(users.iloc[res]['ID'])]
+        logger.debug("Match with %s with %s points", user_id, similarities[res])
+        return [True, user_id]
     
-    print(f"[COMPLEX] No match, max score was {similarities[res]}, threshold was {threshold}")
+    logger.debug("No match, max score was %s, threshold was %s", similarities[res], threshold)
     return [False, -1]
 
+def find_best_candidate(users, user_data, candidates, context=None, similarities=None):
+    """
+    Finds the best match among the candidates of candidate blocking. Only the candidates are scored;
+    the threshold is the same as for exhaustive scoring, from the average score over all users.
+
+    Parameters:
+    users (FingerprintStore): All the stored users.
+    user_data (dict): The data of the user to compare against.
+    candidates (np.array): Positions of the candidates, see `FingerprintStore.candidates`.
+    context (ComparisonContext): Comparison context of the request, optional.
+    similarities (np.array): Scores of the candidates if they are already scored, optional.
+
+    Returns:
+    list: A list containing a boolean indicating if a match was found and the matching user ID.
+    """
+    store = as_store(users)
+    if len(candidates) == 0:
+        logger.debug("No match, no candidates out of %s users", len(store))
+        return [False, -1]
+
+    if similarities is None:
+        similarities = calculate_similarities(store, user_data, positions=candidates, context=context)
+    res = store.first(candidates[similarities == similarities.max()])
+    score = similarities.max()
+    threshold = dynamic_threshold(similarities, mean_similarity(store, user_data))
+    user_id = int(store.ids.values[res])
+
+    if score >= threshold:
+        logger.debug("Match with %s with %s points (%s candidates)", user_id, score, len(candidates))
+        return [True, user_id]
+
+    logger.debug("No match, max score was %s, threshold was %s (%s candidates)", score, threshold, len(candidates))
+    return [False, -1]
 
-def complex(users, user_data, farbling):
+def complex(users, user_data, farbling, similarities=None, context=None):
     """
     Main function of the complex algorithm that checks for similar users either by hash or attributes, 
     with adjustments for farbling (modifying values).
 
     Parameters:
-    users (DataFrame): The DataFrame containing all the users.
+    users (FingerprintStore or DataFrame): All the stored users.
     user_data (dict): The data of the user to compare against.
     farbling (list): Contains information if the user is modifying its data (farbling) and the modified values.
+    similarities (np.array): Scores from `calculate_similarities_many` for the first users of the store, optional.
+        Users stored after they were computed are scored here.
+    context (ComparisonContext): Comparison context of the request, optional.
 
     Returns:
     list: A list containing a boolean indicating if a match was found and the matching user ID if found.
     """
-    user_attributes = adjust_for_farbling(user_data["Attributes"], farbling)
+    users = as_store(users)
+    adjust_for_farbling(user_data["Attributes"], farbling)
 
     if farbling[0]:  # If farbling is detected
-        similarities = calculate_similarities(users, user_data)
-        return find_best_match(similarities, users)
+        if similarities is None:
+            # In large stores only the candidates of candidate blocking are scored
+            candidates = users.candidates(user_data)
+            if candidates is not None:
+                return find_best_candidate(users, user_data, candidates, context)
+        return complex_exhaustive(users, user_data, similarities, context)
     else:
         # Search for audio, geom/txt canvas match
         match = find_audio_and_canvas_match(users, user_data)
@@ -252,6 +313,63 @@ def complex(users, user_data, farbling):
 
     return [False, -1]
 
-# Function to get the index of the max similarity
-def find_max(similarities):
-    return np.argmax(similarities)
+def complex_exhaustive(users, user_data, similarities=None, context=None):
+    """
+    Scores the user against every stored user and finds the best match, the complex algorithm when farbling is detected.
+
+    Parameters:
+    users (FingerprintStore): All the stored users.
+    user_data (dict): The data of the user, with attributes already adjusted for farbling.
+    similarities (np.array): Scores from `calculate_similarities_many` for the first users of the store, optional.
+    context (ComparisonContext): Comparison context of the request, optional.
+
+    Returns:
+    list: A list containing a boolean indicating if a match was found and the matching user ID if found.
+    """
+    if similarities is None:
+        similarities = calculate_similarities(users, user_data, context=context)
+    elif len(similarities) < len(users):
+        similarities = np.concatenate([similarities, calculate_similarities(users, user_data, start=len(similarities))])
+    return find_best_match(similarities, users)
+
+def calculate_farbling_similarities(users, users_data, farblings):
+    """
+    Calculates the similarity scores of several users in one pass over the store, for those users the complex
+    algorithm scores (the ones with farbling detected). They are scored with their attributes adjusted for farbling,
+    as `complex` does, but the user data itself is left unchanged.
+
+    Parameters:
+    users (FingerprintStore or DataFrame): All the stored users.
+    users_data (list): The data of the users to compare against.
+    farblings (list): The result of `test_farbling` for every user.
+
+    Returns:
+    list: The similarity scores for every user, None for users without farbling.
+    """
+    farbled = []
+    for user_data, farbling in zip(users_data, farblings):
+        if farbling[0]:
+            attributes = dict(user_data["Attributes"])
+            attributes["Screen Width"], attributes["Screen Height"] = farbling[1][1]
+            farbled.append(dict(user_data, Attributes=attributes))
+    similarities = iter(calculate_similarities_many(users, farbled))
+    return [next(similarities) if farbling[0] else None for farbling in farblings]
+
+def complex_batch(users, users_data, farblings):
+    """
+    Complex matching of several users against the same stored users, with one scoring pass for all of them.
+
+    Parameters:
+    users (FingerprintStore or DataFrame): All the stored users.
+    users_data (list): The data of the users to compare against.
+    farblings (list): The result of `test_farbling` for every user.
+
+    Returns:
+    list: The result of the complex algorithm for every user.
+    """
+    users = as_store(users)
+    similarities = calculate_farbling_similarities(users, users_data, farblings)
+    return [
+        complex(users, user_data, farbling, scores)
+        for user_data, farbling, scores in zip(users_data, farblings, similarities)
+    ]
@@ -0,0 +1,19 @@
+import pytest
+
+"""
+conftest.py: Fixtures shared by the tests of the server.
+"""
+
+@pytest.fixture
+def receiver(tmp_path, monkeypatch):
+    """
+    The receiver module, loaded from an empty temporary directory. The tests replace its store.
+    """
+    # The receiver loads its store on import, from the working directory and without a snapshot
+    (tmp_path / "src").mkdir()
+    monkeypatch.chdir(tmp_path / "src")
+    monkeypatch.setenv("FP_SNAPSHOT", "")
+    monkeypatch.setenv("FP_STORAGE", "csv")
+    monkeypatch.delenv("FP_WRITER", raising=False)
+    import receiver
+    return receiver
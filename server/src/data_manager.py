@@ -1,7 +1,26 @@
 import csv
+import io
 import os
+import zlib
 import pandas as pd
 
+"""
+data_manager.py: This script handles storing fingerprint logs. Besides the helper functions for the CSV files,
+it provides the storage backends used by the fingerprint store. A backend has a `read` method returning all
+stored logs, a `write` method appending one log and a `close` method. Backends may also have a `write_many`
+method appending several logs at once, which the write-behind queue (write_behind.py) uses for its batches.
+Backends with a `checkpoint` method returning a marker of the logs stored so far, and a `read_since` method
+returning the logs stored after a marker, can back a snapshot of the fingerprint store (snapshot.py).
+
+Backends:
+- "csv": The fp_data.csv file (default).
+- "segments": Append-only segment files, see segment_store.py.
+- "sqlite": An SQLite database with indexed lookups, see sqlite_store.py.
+
+With FP_BLOBS set, any backend stores the Media Capabilities and Plugins payloads once in a blob directory
+and the logs reference them, see blob_store.py.
+"""
+
 # Standard fieldnames for the CSV structure
 fieldnames = [
     "ID", "Log", 
@@ -11,8 +30,17 @@ fieldnames = [
     "TXT Canvas"
 ]
 
+# Columns holding hashes of the fingerprint, these are indexed by the fingerprint store
+hash_fieldnames = [
+    "Audio", "Geom Canvas", "TXT Canvas",
+    "Fonts", "MediaHash", "PluginsHash"
+]
+
 FILEPATH = "../fp_data.csv"
 
+# Number of bytes before a CSV checkpoint whose checksum tells whether the file was rewritten
+CHECK_SIZE = 4096
+
 def user_from_string(line):
     """
     Parses a semicolon-separated key:value string into a dictionary.
@@ -71,14 +99,117 @@ def save_new_user(user_data):
     file_path = FILEPATH
     write_user_to_file(user_data, file_path)
 
-def load_users():
+def load_users(file_path=FILEPATH):
     """
     Loads all users from the CSV file, sorted by ID and Log.
     """
-    file_path = FILEPATH
     if not check_file_existance(file_path):
         return []
 
     users = pd.read_csv(file_path)
     users = users.sort_values(by=["ID", "Log"])
     return users
+
+class CsvBackend:
+    """
+    Storage backend keeping all logs in a single CSV file.
+    """
+
+    def __init__(self, file_path=FILEPATH):
+        self.file_path = file_path
+
+    def read(self):
+        """
+        Returns all stored logs sorted by ID and Log.
+        """
+        users = load_users(self.file_path)
+        if len(users) == 0:
+            return []
+        return users.to_dict("records")
+
+    def write(self, user_data):
+        """
+        Appends a log to the CSV file.
+        """
+        write_user_to_file(user_data, self.file_path)
+
+    def write_many(self, users):
+        """
+        Appends several logs to the CSV file, opening it once.
+        """
+        file_exists = check_file_existance(self.file_path)
+        with open(self.file_path, mode='a', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=fieldnames)
+            if not file_exists:
+                writer.writeheader()
+            writer.writerows(users)
+
+    def checkpoint(self):
+        """
+        Returns a marker of the logs stored so far: the size of the file, its inode and the checksum
+        of the bytes before the end, so a rewritten file does not match the marker.
+        """
+        if not os.path.isfile(self.file_path):
+            return {"backend": "csv", "size": 0}
+        with open(self.file_path, "rb") as file:
+            size = file.seek(0, os.SEEK_END)
+            file.seek(max(0, size - CHECK_SIZE))
+            check = zlib.crc32(file.read(size - file.tell()))
+            inode = os.fstat(file.fileno()).st_ino
+        return {"backend": "csv", "size": size, "inode": inode, "check": check}
+
+    def read_since(self, marker):
+        """
+        Returns the logs appended after a checkpoint, sorted by ID and Log.
+        All values except ID and Log are read as strings, as they were written.
+
+        Returns:
+        - list: The logs, or None if the file does not match the marker.
+        """
+        if marker.get("backend") != "csv":
+            return None
+        if marker["size"] == 0:
+            return self.read()
+        if not os.path.isfile(self.file_path):
+            return None
+        with open(self.file_path, "rb") as file:
+            size = file.seek(0, os.SEEK_END)
+            if os.fstat(file.fileno()).st_ino != marker["inode"] or size < marker["size"]:
+                return None
+            file.seek(max(0, marker["size"] - CHECK_SIZE))
+            if zlib.crc32(file.read(marker["size"] - file.tell())) != marker["check"]:
+                return None
+            tail = file.read()
+            if not tail:
+                return []
+            file.seek(0)
+            header = file.readline()
+        users = pd.read_csv(io.BytesIO(header + tail), dtype={key: str for key in fieldnames if key not in ("ID", "Log")})
+        return users.sort_values(by=["ID", "Log"]).to_dict("records")
+
+    def close(self):
+        pass
+
+def open_backend(storage=None, file_path=FILEPATH):
+    """
+    Opens a storage backend.
+
+    Parameters:
+        storage (str): "csv", "segments" or "sqlite". Defaults to the FP_STORAGE environment variable, or "csv".
+        file_path (str): Path of the CSV file for the "csv" backend.
+    """
+    storage = storage or os.environ.get("FP_STORAGE", "csv")
+    if storage == "csv":
+        backend = CsvBackend(file_path)
+    elif storage == "segments":
+        from segment_store import SegmentStore
+        backend = SegmentStore()
+    elif storage == "sqlite":
+        from sqlite_store import SqliteBackend
+        backend = SqliteBackend()
+    else:
+        raise ValueError(f"Unknown storage backend '{storage}'")
+
+    # Payloads are moved to the blob store if FP_BLOBS is set
+    from blob_store import from_env
+    return from_env(backend)
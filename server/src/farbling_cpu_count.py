@@ -7,6 +7,10 @@ commonly observed CPU core counts from real-world devices. If the count is not i
 it may indicate browser spoofing or farbling.
 """
 
+from log import get_logger
+
+logger = get_logger(__name__)
+
 # List of common CPU core counts observed in real devices
 common_cpu_count = [2, 4, 6, 8, 10, 11, 12, 14, 16, 20, 24, 32, 64, 96]
 
@@ -30,13 +34,13 @@ def test_cpu_count(user_cpu_count):
 
         # Return True if value is uncommon, suggesting possible farbling
         if user_cpu_count not in common_cpu_count:
-            print(f"[FARBLING] CPU - detected")
+            logger.debug("CPU - detected", extra={"fields": {"cpu": user_cpu_count}})
             return True
 
-        print(f"[FARBLING] CPU - not detected")
+        logger.debug("CPU - not detected")
         return False
 
     except (ValueError, TypeError):
         # Handle unexpected types or conversion errors gracefully
-        print(f"[FARBLING] CPU - invalid input ({user_cpu_count})")
+        logger.warning("CPU - invalid input (%s)", user_cpu_count)
         return False
@@ -12,6 +12,10 @@ browser might still return just `4` or `8`. As a result, detecting farbling base
 to flagging clearly incorrect values or undefined/malformed responses.
 """
 
+from log import get_logger
+
+logger = get_logger(__name__)
+
 # Based on documentation from Mozilla and known behavior of navigator.deviceMemory
 # Only these values are returned by supported browsers, in gigabytes.
 return_values = [0.25, 0.5, 1, 2, 4, 8]
@@ -31,20 +35,20 @@ def test_device_memory(user_memory):
         memory_str = user_memory.strip().split(' ')[0]
 
         if memory_str.lower() == 'undefined':
-            print(f"[FARBLING] MEMORY - not detected")
+            logger.debug("MEMORY - not detected")
             return False
 
         # Convert to float and validate against known acceptable values
         memory_value = float(memory_str)
 
         if memory_value not in return_values:
-            print(f"[FARBLING] MEMORY - detected")
+            logger.debug("MEMORY - detected", extra={"fields": {"memory": user_memory}})
             return True
 
-        print(f"[FARBLING] MEMORY - not detected")
+        logger.debug("MEMORY - not detected")
         return False
 
     except (ValueError, TypeError, AttributeError):
         # Catch cases where input is malformed
-        print(f"[FARBLING] MEMORY - invalid input ({user_memory})")
+        logger.warning("MEMORY - invalid input (%s)", user_memory)
         return False
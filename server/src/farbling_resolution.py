@@ -11,11 +11,23 @@ the code also checks against common resolutions divided by 2, to account for dev
 
 Common resolutions were chosen based on real-world usage data.
 
+The reference resolutions (common resolutions at both scales) are precomputed into arrays and a resolution is
+compared with all of them at once. Results are memoised in a bounded LRU cache keyed by (width, height), as
+screen sizes repeat heavily across visitors. `classify_resolutions` classifies a whole column of resolutions
+at once with the same engine, for analysis.
+
 Returns:
     - A boolean indicating if the resolution appears spoofed or unusual.
     - The closest matching resolution (if applicable).
 """
 
+from functools import lru_cache
+import numpy as np
+
+from log import get_logger
+
+logger = get_logger(__name__)
+
 common_resolutions = [
     [640, 480], [800, 600], [1024, 768], [1152, 864], [1176, 664],
     [1280, 720], [1280, 800], [1280, 960], [1360, 768], [1366, 768],
@@ -31,6 +43,63 @@ common_resolutions = [
 # This allows for some flexibility in matching, accounting for high-DPR devices and other variations.
 diff = 0.85
 
+# Scales of the reference resolutions, 0.5 accounts for high-DPR devices
+scales = [1, 0.5]
+
+# Reference resolutions in the order they are compared in: every common resolution at every scale
+reference_widths = np.array([resolution[0] * scale for resolution in common_resolutions for scale in scales], dtype=np.float64)
+reference_heights = np.array([resolution[1] * scale for resolution in common_resolutions for scale in scales], dtype=np.float64)
+reference_resolutions = [(int(width), int(height)) for width, height in zip(reference_widths, reference_heights)]
+
+# Number of distinct resolutions kept in the cache
+CACHE_SIZE = 4096
+
+def _classify(user_widths, user_heights):
+    """
+    Compares resolutions with all reference resolutions.
+
+    Parameters:
+        user_widths, user_heights (np.array): Positive integer widths and heights.
+
+    Returns:
+        tuple: For every resolution, the index of the first exact match (-1 if none)
+               and the index of the closest match within the tolerance (-1 if none).
+    """
+    width_ratios = user_widths[:, None] / reference_widths[None, :]
+    height_ratios = user_heights[:, None] / reference_heights[None, :]
+
+    # Check if the resolution is within the tolerance range
+    within = (diff < width_ratios) & (width_ratios < 1 + (1 - diff)) & (diff < height_ratios) & (height_ratios < 1 + (1 - diff))
+
+    # Check for exact match to avoid false positives
+    exact = within & (np.abs(width_ratios - 1) < 1e-5) & (np.abs(height_ratios - 1) < 1e-5)
+
+    # The closest match has the smallest distance, the first one in order on ties
+    distances = np.where(within, np.abs(1 - width_ratios * height_ratios), np.inf)
+
+    first_exact = np.where(exact.any(axis=1), exact.argmax(axis=1), -1)
+    closest = np.where(within.any(axis=1), distances.argmin(axis=1), -1)
+    return first_exact, closest
+
+def _result(user_width, user_height, first_exact, closest):
+    original_res = [user_width, user_height]
+    if first_exact >= 0:
+        logger.debug("Resolution - not detected")
+        return [False, list(reference_resolutions[first_exact])]
+
+    best_match = list(reference_resolutions[closest]) if closest >= 0 else None
+    if best_match and best_match != original_res:
+        logger.debug("Resolution - detected", extra={"fields": {"resolution": original_res, "closest": best_match}})
+        return [True, best_match]
+
+    logger.debug("Resolution - not detected")
+    return [False, original_res]
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _classify_one(user_width, user_height):
+    first_exact, closest = _classify(np.array([user_width], dtype=np.float64), np.array([user_height], dtype=np.float64))
+    return int(first_exact[0]), int(closest[0])
+
 def test_resolution(user_width, user_height):
     """
     Determines whether a screen resolution is common or possibly spoofed.
@@ -53,39 +122,43 @@ def test_resolution(user_width, user_height):
         if user_width <= 0 or user_height <= 0:
             raise ValueError("Width and height must be positive integers.")
 
-        original_res = [user_width, user_height]
-        best_match = None
-        min_distance = float('inf')
-
-        for resolution in common_resolutions:
-            for scale in [1, 0.5]:  # Account for high-DPR devices
-                ref_width = resolution[0] * scale
-                ref_height = resolution[1] * scale
-
-                width_ratio = user_width / ref_width
-                height_ratio = user_height / ref_height
-
-                # Check if the resolution is within the tolerance range
-                if diff < width_ratio < 1 + (1 - diff) and diff < height_ratio < 1 + (1 - diff):
-                    # Check for exact match to avoid false positives
-                    if abs(width_ratio - 1) < 1e-5 and abs(height_ratio - 1) < 1e-5:
-                        print("[FARBLING] Resolution - not detected")
-                        return [False, [int(ref_width), int(ref_height)]]
+        return _result(user_width, user_height, *_classify_one(user_width, user_height))
 
-                    # Calculate distance and update the best match
-                    distance = abs(1 - width_ratio * height_ratio)
-                    if distance < min_distance:
-                        min_distance = distance
-                        best_match = [int(ref_width), int(ref_height)]
+    except ValueError as e:
+        logger.warning("Invalid input: %s", e)
+        return [False, [user_width, user_height]]
 
-        if best_match and best_match != original_res:
-            # print(f"[FARBLING] Possible resolutions -> {best_match}")
-            print("[FARBLING] Resolution - detected")
-            return [True, best_match]
+def classify_resolutions(user_widths, user_heights):
+    """
+    Runs `test_resolution` for a whole column of resolutions at once.
 
-        print("[FARBLING] Resolution - not detected")
-        return [False, original_res]
+    Parameters:
+        user_widths, user_heights (iterable): Screen widths and heights as reported by the users.
 
-    except ValueError as e:
-        print(f"[ERROR] Invalid input: {e}")
-        return [False, [user_width, user_height]]
+    Returns:
+        list: The result of `test_resolution` for every resolution.
+    """
+    user_widths = list(user_widths)
+    user_heights = list(user_heights)
+
+    # Valid resolutions are classified together, the others get the result of test_resolution
+    valid = []
+    for index, (user_width, user_height) in enumerate(zip(user_widths, user_heights)):
+        try:
+            if user_width != 'undefined' and user_height != 'undefined' and int(user_width) > 0 and int(user_height) > 0:
+                valid.append(index)
+        except ValueError:
+            pass
+
+    results = [None] * len(user_widths)
+    if valid:
+        widths = np.array([int(user_widths[index]) for index in valid], dtype=np.float64)
+        heights = np.array([int(user_heights[index]) for index in valid], dtype=np.float64)
+        first_exact, closest = _classify(widths, heights)
+        for position, index in enumerate(valid):
+            results[index] = _result(int(user_widths[index]), int(user_heights[index]), int(first_exact[position]), int(closest[position]))
+
+    for index, result in enumerate(results):
+        if result is None:
+            results[index] = test_resolution(user_widths[index], user_heights[index])
+    return results
@@ -0,0 +1,636 @@
+import ast
+import math
+import threading
+import numpy as np
+import pandas as pd
+
+from columnar import AttributeMatrix, EncodedColumn, GrowableArray, HashIndex
+from data_manager import fieldnames, hash_fieldnames, prepare_user_data
+from log import get_logger
+import lsh
+import snapshot
+
+"""
+fingerprint_store.py: This script keeps the stored fingerprint logs resident in memory for the lifetime of the server.
+The storage backend (fp_data.csv by default) is read once when the store is loaded and every saved log is applied incrementally,
+so the matching algorithms and the user manager read from memory instead of re-reading fp_data.csv on every request.
+
+Rows are read back in the same shape `pd.read_csv` produces for fp_data.csv, so results do not depend on whether
+a log was loaded from the file or saved during the current run. The Attributes of every log are parsed once
+when the log is ingested and kept in an AttributeMatrix, so matching never calls `ast.literal_eval` per row.
+All other columns are dictionary-encoded as well, with hex hashes held as raw bytes.
+No row is kept as a dict: every distinct value is stored once, in the dictionary of its column, and a row
+is only a code per column in arrays. Rows are decoded when they are read (`row`, `rows`, `frame`); the Attributes
+string is rebuilt from the AttributeMatrix, and kept as it was only where the rebuilt string would differ.
+`python fingerprint_store.py` reports the memory used per stored log.
+Every hash column has an inverted index maintained on insert, so finding the logs with a given hash is O(1).
+Another index is keyed by the composite repeat key (AttributesHash and the canvas, audio, media and plugin hashes),
+so a browser sending a byte-identical fingerprint again is recognised with a single lookup.
+Optionally, the logs are indexed for candidate blocking (lsh.py), so the complex algorithm scores only
+the logs similar to the user in large stores.
+
+Rows are stored in the order they were ingested. Where the algorithms need "the first" of several rows,
+the store resolves it by (ID, Log), which is the order `load_users` returns.
+
+Every user ID has an Identity with its log count, latest log and row positions, read from an index of the ID
+column, and new IDs come from a monotonic allocator, so saving a log never has to scan the stored users.
+
+With a snapshot file (snapshot.py), `load` maps the store as it was saved and only ingests the logs the backend
+stored after it, so a restart does not parse the history again. The snapshot is rewritten on load when many logs
+had to be ingested, and `save_snapshot` writes it on shutdown.
+
+The columns of the store are read while they are not all of the same length during an ingest, so the store
+must not be matched against while a log is saved. The methods that save hold the `lock` of the store, and a
+caller matching while other threads may save (the receiver serves requests on several threads) holds it
+from the match to the save.
+
+Classes:
+- Identity: The logs stored for one user ID.
+- Identities: Mapping from the user IDs to their Identity.
+- Rows: Sequence of the decoded rows of a store.
+- FingerprintStore: Long-lived store of all fingerprint logs with incremental appends.
+
+Functions:
+- normalise_value: Converts a value to the form it has after a round trip through the CSV file.
+- normalise_row: Converts a user dictionary to a stored row.
+- parse_attributes: Parses the Attributes column of a stored row.
+- repeat_key: Returns the composite key of exact repeats of a fingerprint.
+- as_store: Returns a store for either a store or a DataFrame of users.
+"""
+
+logger = get_logger(__name__)
+
+# Columns of the composite key identifying an exact repeat of a fingerprint
+repeat_fieldnames = ["AttributesHash", "Audio", "Geom Canvas", "TXT Canvas", "MediaHash", "PluginsHash"]
+
+def normalise_value(key, value):
+    """
+    Converts a single value to the form it has after being written to and read back from the CSV file.
+
+    Parameters:
+    - key (str): The column name.
+    - value: The value to convert.
+
+    Returns:
+    - The stored representation (int for ID and Log, str for other columns, NaN for missing values).
+    """
+    if value is None or (isinstance(value, float) and math.isnan(value)) or value == "":
+        return float("nan")
+    if key in ("ID", "Log"):
+        return int(value)
+    if isinstance(value, str):
+        return value
+    return str(value)
+
+def normalise_row(user_data):
+    """
+    Converts a user dictionary to a stored row containing exactly the CSV columns.
+
+    Parameters:
+    - user_data (dict): The user data as prepared by `prepare_user_data`.
+
+    Returns:
+    - dict: The stored row.
+    """
+    return {key: normalise_value(key, user_data.get(key)) for key in fieldnames}
+
+def parse_attributes(value):
+    """
+    Parses the Attributes of a user or a stored row.
+
+    Parameters:
+    - value (dict, str or NaN): The Attributes value.
+
+    Returns:
+    - dict: The parsed attributes, or None if the string could not be parsed.
+    """
+    if isinstance(value, dict):
+        return value
+    if not isinstance(value, str):
+        return {}
+    try:
+        attributes = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return None
+    return attributes if isinstance(attributes, dict) else None
+
+def repeat_key(user_data):
+    """
+    Returns the composite key of exact repeats of a fingerprint.
+
+    Parameters:
+    - user_data (dict): The user data or a stored row.
+
+    Returns:
+    - tuple: The stored values of the repeat columns, or None if any of them is missing.
+    """
+    key = tuple(normalise_value(column, user_data.get(column)) for column in repeat_fieldnames)
+    if any(isinstance(value, float) for value in key):
+        return None
+    return key
+
+class Identity:
+    """
+    The logs stored for one user ID, read from the index of the ID column of a store when they are accessed.
+    """
+    __slots__ = ("store", "code")
+
+    def __init__(self, store, code):
+        self.store = store
+        self.code = code
+
+    @property
+    def count(self):
+        """
+        The number of logs of the user.
+        """
+        return int(self.store.id_index.counts.values[self.code])
+
+    @property
+    def latest_log(self):
+        """
+        The highest Log of the user.
+        """
+        latest_log = self.store.latest_logs.values[self.code]
+        return latest_log if math.isnan(latest_log) else int(latest_log)
+
+    @property
+    def positions(self):
+        """
+        The positions of the logs of the user, in ingest order.
+        """
+        return self.store.id_index.positions(self.code).tolist()
+
+    @property
+    def last_position(self):
+        """
+        The position of the log of the user ingested last.
+        """
+        return int(self.store.id_index.tails.values[self.code])
+
+class Identities:
+    """
+    Read-only mapping from the user IDs to their Identity, read from the index of the ID column of a store.
+    """
+    __slots__ = ("store",)
+
+    def __init__(self, store):
+        self.store = store
+
+    def get(self, user_id, default=None):
+        """
+        Returns the Identity of a user ID, or the default if no log of the user is stored.
+        """
+        counts = self.store.id_index.counts
+        code = self.store.columns["ID"].encode(user_id)
+        if not 0 <= code < len(counts) or counts.values[code] == 0:
+            return default
+        return Identity(self.store, code)
+
+    def __getitem__(self, user_id):
+        identity = self.get(user_id)
+        if identity is None:
+            raise KeyError(user_id)
+        return identity
+
+    def __contains__(self, user_id):
+        return self.store.id_index.count(user_id) > 0
+
+    def __len__(self):
+        return int(np.count_nonzero(self.store.id_index.counts.values))
+
+    def __iter__(self):
+        for code in np.flatnonzero(self.store.id_index.counts.values):
+            yield self.store.columns["ID"].decode(code)
+
+class Rows:
+    """
+    Read-only sequence of the rows of a store, decoded when they are accessed.
+    """
+    __slots__ = ("store",)
+
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self.store.row(index) for index in range(*position.indices(len(self)))]
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError("row position out of range")
+        return self.store.row(position)
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self.store.row(position)
+
+class FingerprintStore:
+    """
+    In-memory store of all fingerprint logs. It is loaded once from the CSV file and updated
+    on every save, so a request never has to re-parse the file.
+    """
+
+    def __init__(self, backend=None, order_by_key=True, blocking=None, snapshot_path=None):
+        """
+        Parameters:
+        - backend: Storage backend from `data_manager.open_backend`. Without a backend the store only lives in memory.
+        - order_by_key (bool): Resolve ties by (ID, Log) as `load_users` does. If False, ties resolve by ingest order.
+        - blocking (lsh.MinHashIndex): Index for candidate blocking, optional. Without it all logs are always scored.
+        - snapshot_path (str): Snapshot file the store is loaded from and saved to, optional (see snapshot.py).
+        """
+        self.backend = backend
+        self.order_by_key = order_by_key
+        self.blocking = blocking
+        self.snapshot_path = snapshot_path
+        # Held while the store changes, and by callers matching against it while other threads may save
+        self.lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self.rows = Rows(self)
+        self.ids = GrowableArray(np.float64, fill=np.nan)
+        self.logs = GrowableArray(np.float64, fill=np.nan)
+        self.attributes = AttributeMatrix()
+        # Attributes strings that differ from the repr of their decoded attributes, by position
+        self.attributes_text = {}
+        self.columns = {key: EncodedColumn() for key in fieldnames if key != "Attributes"}
+        self.hash_index = {key: HashIndex(self.columns[key], self._sort_key) for key in hash_fieldnames}
+        # The codes of the repeat columns of every row, packed into bytes
+        self.repeat_codes = EncodedColumn()
+        self.repeat_index = HashIndex(self.repeat_codes, self._sort_key)
+        if self.blocking is not None:
+            self.blocking.clear()
+        self.id_index = HashIndex(self.columns["ID"], self._sort_key)
+        # The highest Log of every code of the ID column
+        self.latest_logs = GrowableArray(np.float64, fill=np.nan)
+        self.identities = Identities(self)
+        self.next_id = 0
+        # The number of logs of the last snapshot loaded or saved, and the IDs of the snapshots the store begins with
+        self.snapshot_count = 0
+        self.snapshot_ids = set()
+        self._frame = None
+        self._users = None
+        self._order = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_frame(cls, users):
+        """
+        Builds a store from a DataFrame of users without touching any file. Rows keep the order of the DataFrame.
+
+        Parameters:
+        - users (pd.DataFrame): The stored user records.
+
+        Returns:
+        - FingerprintStore: The new store.
+        """
+        store = cls(order_by_key=False)
+        if len(users) > 0:
+            for row in users.to_dict("records"):
+                store.ingest(row)
+        return store
+
+    def load(self):
+        """
+        Loads all logs from the storage backend, replacing the current content of the store.
+        With a snapshot that matches the backend, the snapshot is mapped and only the logs stored after it are read.
+
+        Returns:
+        - FingerprintStore: The store itself.
+        """
+        with self.lock:
+            return self._load()
+
+    def _load(self):
+        self._reset()
+        if self.backend is None:
+            return self
+        rows = None
+        if self.snapshot_path is not None and hasattr(self.backend, "read_since"):
+            header = snapshot.load(self, self.snapshot_path)
+            if header is not None:
+                rows = self.backend.read_since(header["checkpoint"])
+                if rows is None:
+                    logger.warning("Snapshot %s does not match the storage backend, loading all logs", self.snapshot_path)
+                    self._reset()
+        if rows is None:
+            rows = self.backend.read()
+        for row in rows:
+            self.ingest(row)
+        if self.snapshot_path is not None and len(self) - self.snapshot_count >= snapshot.REFRESH_LOGS:
+            self.save_snapshot()
+        return self
+
+    def save_snapshot(self):
+        """
+        Writes the store to its snapshot file if logs were stored since the last snapshot.
+        Nothing is written if the backend cannot tell which logs the snapshot contains (see `snapshot.save`).
+
+        Returns:
+        - bool: Whether a snapshot was written.
+        """
+        if self.snapshot_path is None or self.backend is None or len(self) == self.snapshot_count:
+            return False
+        checkpoint = self.backend.checkpoint() if hasattr(self.backend, "checkpoint") else None
+        if checkpoint is None:
+            logger.info("The storage backend has no checkpoints, no snapshot is written")
+            return False
+        try:
+            snapshot.save(self, self.snapshot_path, checkpoint)
+        except (OSError, ValueError) as error:
+            logger.error("Failed to write snapshot %s: %s", self.snapshot_path, error)
+            return False
+        return True
+
+    def ingest(self, user_data):
+        """
+        Applies a single log to the in-memory structures without writing it to disk.
+
+        Parameters:
+        - user_data (dict): The user data including ID and Log.
+
+        Returns:
+        - int: The position of the new row in the store.
+        """
+        row = normalise_row(user_data)
+        attributes = parse_attributes(user_data.get("Attributes"))
+        if attributes is None:
+            logger.warning("Error parsing Attributes column for user %s", row['ID'])
+            attributes = {}
+
+        position = len(self)
+        self.ids.append(row["ID"])
+        self.logs.append(row["Log"])
+        self.attributes.append(attributes)
+        if repr(self.attributes.decode(position)) != row["Attributes"]:
+            self.attributes_text[position] = row["Attributes"]
+        codes = {column: encoded.append(row[column]) for column, encoded in self.columns.items()}
+        self.repeat_codes.append(self._repeat_codes([codes[column] for column in repeat_fieldnames]))
+
+        key = self._sort_key(position)
+        for index in self.hash_index.values():
+            index.add(position, key)
+        self.repeat_index.add(position, key)
+        self.id_index.add(position, key)
+        if self.blocking is not None:
+            self.blocking.add(position, lsh.tokens(attributes, row))
+
+        if not math.isnan(row["ID"]):
+            code = codes["ID"]
+            if len(self.latest_logs) <= code:
+                self.latest_logs.extend_fill(code + 1 - len(self.latest_logs))
+            if self.id_index.counts.values[code] == 1 or row["Log"] > self.latest_logs.values[code]:
+                self.latest_logs.values[code] = row["Log"]
+            self.next_id = max(self.next_id, int(row["ID"]) + 1)
+
+        self._frame = None
+        self._users = None
+        self._order = None
+        return position
+
+    @staticmethod
+    def _repeat_codes(codes):
+        """
+        Packs the codes of the repeat columns into the key of the repeat index, NaN if any of them is missing or unknown.
+        """
+        if min(codes) < 0:
+            return float("nan")
+        return np.asarray(codes, dtype=np.int32).tobytes()
+
+    def row(self, position):
+        """
+        Decodes the row at a position.
+
+        Returns:
+        - dict: The stored row, as `normalise_row` returns it.
+        """
+        return {
+            key: self.row_attributes(position) if key == "Attributes" else self.columns[key].value(position)
+            for key in fieldnames
+        }
+
+    def row_attributes(self, position):
+        """
+        Returns the Attributes string of the row at a position.
+        """
+        text = self.attributes_text.get(position)
+        return repr(self.attributes.decode(position)) if text is None else text
+
+    def append(self, user_data):
+        """
+        Saves a log to the storage backend and applies it to the store.
+
+        Parameters:
+        - user_data (dict): The user data including ID and Log.
+
+        Returns:
+        - int: The position of the new row in the store.
+        """
+        with self.lock:
+            if self.backend is not None:
+                self.backend.write(user_data)
+            return self.ingest(user_data)
+
+    def save_new_user(self, user_data):
+        """
+        Saves the first log of a new user under a newly allocated ID.
+
+        Parameters:
+        - user_data (dict): The user data without ID and Log.
+
+        Returns:
+        - dict: The saved user data including ID and Log.
+        """
+        with self.lock:
+            user_data = prepare_user_data(user_data, self.allocate_id(), 0)
+            self.append(user_data)
+        return user_data
+
+    def save_log(self, user_id, user_data):
+        """
+        Saves the next log of a returning user.
+
+        Parameters:
+        - user_id (int): The ID of the user.
+        - user_data (dict): The user data without ID and Log.
+
+        Returns:
+        - dict: The saved user data including ID and Log.
+        """
+        with self.lock:
+            user_data = prepare_user_data(user_data, user_id, self.next_log(user_id))
+            self.append(user_data)
+        return user_data
+
+    def sync(self):
+        """
+        Applies logs saved by other processes. A local store is the only writer, so there is nothing to apply.
+        """
+
+    def allocate_id(self):
+        """
+        Returns a new user ID. IDs are never handed out twice, even if no log is saved for them.
+        """
+        with self.lock:
+            user_id = self.next_id
+            self.next_id += 1
+        return user_id
+
+    def next_log(self, user_id):
+        """
+        Returns the log number for the next log of a user, which is the number of logs stored for the user.
+        """
+        return self.id_index.count(user_id)
+
+    def user_logs(self, user_id):
+        """
+        Returns all stored logs of a user as a DataFrame.
+        """
+        identity = self.identities.get(user_id)
+        positions = [] if identity is None else identity.positions
+        return pd.DataFrame([self.row(position) for position in positions], columns=fieldnames)
+
+    def _sort_key(self, position):
+        """
+        Returns the key the store orders rows by, with missing IDs and logs last as in `load_users`.
+        """
+        if not self.order_by_key:
+            return (position,)
+        user_id = self.ids.values[position]
+        log = self.logs.values[position]
+        return (
+            math.isnan(user_id), 0 if math.isnan(user_id) else user_id,
+            math.isnan(log), 0 if math.isnan(log) else log,
+            position
+        )
+
+    def lookup(self, column, value):
+        """
+        Returns the positions of all rows whose hash column equals the value.
+
+        Parameters:
+        - column (str): One of the hash columns.
+        - value: The hash to look up.
+
+        Returns:
+        - np.array: Positions of the matching rows in ingest order.
+        """
+        return self.hash_index[column].lookup(value)
+
+    def count(self, column, value):
+        """
+        Returns the number of rows whose hash column equals the value.
+        """
+        return self.hash_index[column].count(value)
+
+    def first_match(self, column, value):
+        """
+        Returns the position of the first row whose hash column equals the value, or None.
+        """
+        return self.hash_index[column].first(value)
+
+    def find_repeat(self, user_data):
+        """
+        Returns the position of the first row with the same repeat key as the user data, or None.
+
+        Parameters:
+        - user_data (dict): The user data.
+        """
+        repeat = repeat_key(user_data)
+        if repeat is None:
+            return None
+        codes = [self.columns[column].encode(value) for column, value in zip(repeat_fieldnames, repeat)]
+        return self.repeat_index.first(self._repeat_codes(codes))
+
+    def candidates(self, user_data):
+        """
+        Returns the positions of the logs similar enough to the user data to be scored,
+        or None if all logs are scored (no blocking index, or the store is below its minimum size).
+
+        Parameters:
+        - user_data (dict): The user data with parsed Attributes.
+        """
+        if self.blocking is None or len(self) < self.blocking.min_size:
+            return None
+        attributes = parse_attributes(user_data.get("Attributes")) or {}
+        return self.blocking.query(lsh.tokens(attributes, user_data))
+
+    def order(self):
+        """
+        Returns the positions of all rows in the order they are compared in: by (ID, Log),
+        or by ingest order if the store does not order by key.
+        """
+        if self._order is None:
+            positions = np.arange(len(self))
+            if self.order_by_key:
+                positions = np.lexsort((positions, self.logs.values, self.ids.values))
+            self._order = positions
+        return self._order
+
+    def first(self, positions):
+        """
+        Returns the first of the given row positions in the order of the store.
+
+        Parameters:
+        - positions (array-like): Row positions.
+
+        Returns:
+        - int: The first position, or None if there are no positions.
+        """
+        positions = np.asarray(positions)
+        if len(positions) == 0:
+            return None
+        if not self.order_by_key:
+            return int(positions.min())
+        return int(positions[np.lexsort((positions, self.logs.values[positions], self.ids.values[positions]))[0]])
+
+    def best(self, scores):
+        """
+        Returns the position of the highest score, resolving ties with `first`.
+        """
+        return self.first(np.flatnonzero(scores == scores.max()))
+
+    @property
+    def frame(self):
+        """
+        DataFrame view of the store in ingest order, so that row i of the view is position i of the store.
+        """
+        if self._frame is None:
+            data = {}
+            for key in fieldnames:
+                if key == "Attributes":
+                    data[key] = [self.row_attributes(position) for position in range(len(self))]
+                else:
+                    data[key] = self.columns[key].decode_all()
+            self._frame = pd.DataFrame(data, columns=fieldnames).infer_objects()
+        return self._frame
+
+    @property
+    def users(self):
+        """
+        DataFrame view of the store sorted by ID and Log, equivalent to `load_users()`.
+        The view is cached and only rebuilt after the store changes.
+        """
+        if self._users is None:
+            self._users = self.frame.iloc[self.order()].reset_index(drop=True)
+        return self._users
+
+def as_store(users):
+    """
+    Returns the given store, or builds a temporary store for a DataFrame of users.
+
+    Parameters:
+    - users (FingerprintStore or pd.DataFrame): The stored user records.
+
+    Returns:
+    - FingerprintStore: The store to match against.
+    """
+    if isinstance(users, FingerprintStore):
+        return users
+    return FingerprintStore.from_frame(users)
@@ -0,0 +1,43 @@
+import multiprocessing
+import os
+import secrets
+import subprocess
+import sys
+import time
+
+"""
+gunicorn.conf.py: Configuration for running the receiver with several gunicorn workers.
+
+Before the workers are started, the single writer process (writer.py) is launched. Every worker matches
+against its own in-memory store and sends all saves to the writer, so IDs and logs stay consistent.
+Unless FP_WRITER_KEY is set, a random key is generated for the writer and the workers to authenticate with.
+
+Usage:
+    gunicorn receiver:app
+"""
+
+bind = "0.0.0.0:5000"
+workers = multiprocessing.cpu_count()
+
+WRITER_ADDRESS = os.environ.setdefault("FP_WRITER", "../fp_writer.sock")
+# Inherited by the writer process and the workers
+os.environ.setdefault("FP_WRITER_KEY", secrets.token_hex(32))
+
+writer_process = None
+
+def on_starting(server):
+    global writer_process
+    if os.path.exists(WRITER_ADDRESS):
+        os.remove(WRITER_ADDRESS)
+    writer_process = subprocess.Popen([sys.executable, "writer.py"])
+
+    # Wait until the writer has loaded the store and listens
+    while not os.path.exists(WRITER_ADDRESS):
+        if writer_process.poll() is not None:
+            raise RuntimeError("The writer process exited during startup")
+        time.sleep(0.1)
+
+def on_exit(server):
+    if writer_process is not None:
+        writer_process.terminate()
+        writer_process.wait()
@@ -0,0 +1,101 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+
+"""
+log.py: This script configures the logging of the server. Every module logs through its own logger
+(`get_logger(__name__)`), all of them children of the "fp" logger, which is configured once.
+
+Records are put on a queue by the calling thread and formatted and written by a background thread as JSON
+lines, so logging never blocks a request on stdout. Records below the configured level are dropped before
+they are formatted, so disabled debug logging costs a single level check.
+
+Configuration (environment variables):
+- FP_LOG_LEVEL: Level of all modules, WARNING by default.
+- FP_LOG_LEVELS: Levels of single modules, e.g. "naive=DEBUG,user_manager=INFO".
+
+Extra fields of a record are passed as `extra={"fields": {...}}` and written as keys of the JSON line.
+
+Functions:
+- get_logger: Returns the logger of a module, configuring logging on first use.
+- setup: Configures logging.
+"""
+
+ROOT = "fp"
+
+_listener = None
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as a single JSON line.
+    """
+
+    def format(self, record):
+        line = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "module": record.name[len(ROOT) + 1:] or ROOT,
+            "message": record.getMessage(),
+        }
+        line.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            line["exception"] = self.formatException(record.exc_info)
+        return json.dumps(line, default=str)
+
+def _parse_levels(text):
+    levels = {}
+    for item in (text or "").split(","):
+        if "=" in item:
+            module, level = item.split("=", 1)
+            levels[module.strip()] = level.strip().upper()
+    return levels
+
+def setup(level=None, module_levels=None, stream=None):
+    """
+    Configures logging. Later calls replace the configuration.
+
+    Parameters:
+    - level (str): Level of all modules, FP_LOG_LEVEL or WARNING by default.
+    - module_levels (dict): Levels by module name, FP_LOG_LEVELS by default.
+    - stream: Stream the JSON lines are written to, stdout by default.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+
+    root = logging.getLogger(ROOT)
+    root.setLevel(level or os.environ.get("FP_LOG_LEVEL", "WARNING").upper())
+    root.propagate = False
+    for module, module_level in (module_levels if module_levels is not None else _parse_levels(os.environ.get("FP_LOG_LEVELS"))).items():
+        logging.getLogger(f"{ROOT}.{module}").setLevel(module_level)
+
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(JsonFormatter())
+
+    records = queue.SimpleQueue()
+    root.handlers = [logging.handlers.QueueHandler(records)]
+    _listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    _listener.start()
+
+def _shutdown():
+    # Writes the records still in the queue
+    if _listener is not None:
+        _listener.stop()
+
+atexit.register(_shutdown)
+
+def get_logger(name):
+    """
+    Returns the logger of a module.
+
+    Parameters:
+    - name (str): The module name (`__name__`).
+    """
+    if _listener is None:
+        setup()
+    return logging.getLogger(f"{ROOT}.{name.rsplit('.', 1)[-1]}")
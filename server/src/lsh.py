@@ -0,0 +1,203 @@
+import hashlib
+import os
+import numpy as np
+
+"""
+lsh.py: This script provides the candidate blocking of the complex algorithm for large stores.
+
+When farbling is detected, the complex algorithm scores the user against every stored log. With blocking,
+every stored log is indexed by the MinHash signature of its tokens (its attributes as name=value pairs and
+its scored hashes), split into bands. Logs sharing at least one band with the user are its candidates and
+only they are scored. Two fingerprints with a Jaccard similarity J of their tokens become candidates with
+probability 1 - (1 - J^rows)^bands, so more bands give higher recall and more rows per band fewer candidates.
+
+Blocking is off unless FP_LSH_BANDS is set, as it changes which logs are scored: computing the signatures
+costs every ingest and load, and candidates can miss a match exhaustive scoring finds. Once enabled, it is
+used when the store holds at least `min_size` logs; smaller stores are scored exhaustively.
+The recall against exhaustive scoring can be measured on the captured datasets with analysis/blocking.py.
+
+An index restored from a snapshot (snapshot.py) keeps the buckets of the snapshot in arrays: per band, the keys
+in ascending order and the positions of every key. Logs added later go to the dicts of buckets as usual.
+
+Configuration (environment variables):
+- FP_LSH_BANDS: Number of bands, e.g. 16. Unset, empty or 0 disables blocking (the default).
+- FP_LSH_ROWS: Number of rows per band, 4 by default.
+- FP_LSH_MIN_LOGS: Store size from which blocking is used, 50000 by default.
+
+Classes:
+- MinHashIndex: Banded MinHash index of the stored logs.
+
+Functions:
+- tokens: Returns the tokens of a fingerprint.
+- from_env: Returns the index configured by the environment, or None if blocking is disabled.
+"""
+
+# Largest prime below 2^32, the MinHash permutations are computed modulo it
+PRIME = 4294967291
+
+# Hash columns the complex algorithm scores, they are tokens besides the attributes
+token_columns = ["Geom Canvas", "TXT Canvas", "Fonts", "MediaHash"]
+
+def _missing(value):
+    return value is None or (isinstance(value, float) and value != value)
+
+def tokens(attributes, user_data):
+    """
+    Returns the tokens of a fingerprint.
+
+    Parameters:
+    - attributes (dict): The parsed attributes.
+    - user_data (dict): The user data or stored row with the hash columns.
+
+    Returns:
+    - set: One "name=value" token per attribute and per present hash column.
+    """
+    result = {f"{name}={value!r}" for name, value in attributes.items()}
+    for column in token_columns:
+        value = user_data.get(column)
+        if not _missing(value):
+            result.add(f"{column}={value}")
+    return result
+
+class MinHashIndex:
+    """
+    Banded MinHash index from the tokens of the stored logs to their positions.
+    """
+
+    def __init__(self, bands=16, rows=4, min_size=0, seed=0):
+        """
+        Parameters:
+        - bands (int): Number of bands.
+        - rows (int): Number of MinHash values per band.
+        - min_size (int): Store size from which the index is used.
+        - seed (int): Seed of the hash functions.
+        """
+        self.bands = bands
+        self.rows = rows
+        self.min_size = min_size
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        # Hash functions (a * x + b) mod PRIME; with x below 2^32 and a below 2^31 they do not overflow
+        self._a = rng.integers(1, 2 ** 31, size=bands * rows, dtype=np.uint64)
+        self._b = rng.integers(0, 2 ** 31, size=bands * rows, dtype=np.uint64)
+        self.clear()
+
+    def clear(self):
+        """
+        Removes all logs from the index.
+        """
+        self.buckets = [{} for _ in range(self.bands)]
+        self.base = None
+
+    def signature(self, token_set):
+        """
+        Returns the MinHash signature of a set of tokens, or None for an empty set.
+        """
+        if not token_set:
+            return None
+        values = np.fromiter(
+            (int.from_bytes(hashlib.blake2b(token.encode(), digest_size=4).digest(), "little") for token in token_set),
+            dtype=np.uint64, count=len(token_set)
+        )
+        return ((values[:, None] * self._a[None, :] + self._b[None, :]) % PRIME).min(axis=0)
+
+    def _keys(self, signature):
+        # The MinHash values are below 2^32, so the values of a band are packed exactly into one int
+        packed = signature.astype(np.uint32)
+        return [int.from_bytes(packed[band * self.rows:(band + 1) * self.rows].tobytes(), "little") for band in range(self.bands)]
+
+    def add(self, position, token_set):
+        """
+        Indexes a stored log. Logs without tokens are not indexed, as they are never candidates.
+        A bucket with a single log holds its position, a list is only made for the second one.
+
+        Parameters:
+        - position (int): The position of the log in the store.
+        - token_set (set): The tokens of the log, see `tokens`.
+        """
+        signature = self.signature(token_set)
+        if signature is None:
+            return
+        for bucket, key in zip(self.buckets, self._keys(signature)):
+            positions = bucket.get(key)
+            if positions is None:
+                bucket[key] = position
+            elif isinstance(positions, int):
+                bucket[key] = [positions, position]
+            else:
+                positions.append(position)
+
+    def query(self, token_set):
+        """
+        Returns the candidates for a set of tokens: the logs sharing at least one band with it.
+
+        Returns:
+        - np.array: Positions of the candidates in ascending order.
+        """
+        signature = self.signature(token_set)
+        if signature is None:
+            return np.zeros(0, dtype=np.int64)
+        keys = self._keys(signature)
+        found = [bucket.get(key) for bucket, key in zip(self.buckets, keys)]
+        found = [np.asarray(positions, dtype=np.int64).reshape(-1) for positions in found if positions is not None]
+        if self.base is not None:
+            found += [self._base_positions(band, key) for band, key in enumerate(keys)]
+        if not found:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(found))
+
+    def _base_positions(self, band, key):
+        """
+        Returns the positions of a bucket in the arrays restored from a snapshot.
+        """
+        keys, offsets, positions = self.base[band]
+        target = np.array(key.to_bytes(4 * self.rows, "little"), dtype=keys.dtype)
+        start = np.searchsorted(keys, target, side="left")
+        if start == np.searchsorted(keys, target, side="right"):
+            return np.zeros(0, dtype=np.int64)
+        return positions[offsets[start]:offsets[start + 1]].astype(np.int64)
+
+    def arrays(self):
+        """
+        Returns the buckets as arrays for a snapshot: per band the keys as bytes in ascending order
+        (`{band}.keys`), and the positions of key i at `{band}.positions[offsets[i]:offsets[i + 1]]`.
+        """
+        width = 4 * self.rows
+        arrays = {}
+        for band, bucket in enumerate(self.buckets):
+            keys = []
+            positions = []
+            for key, found in bucket.items():
+                if isinstance(found, int):
+                    found = [found]
+                keys += [key.to_bytes(width, "little")] * len(found)
+                positions += found
+            keys = np.array(keys, dtype=f"S{width}")
+            positions = np.array(positions, dtype=np.int32)
+            if self.base is not None:
+                base_keys, offsets, base_positions = self.base[band]
+                keys = np.concatenate([np.repeat(base_keys, np.diff(offsets)), keys])
+                positions = np.concatenate([base_positions, positions])
+            # Logs added since the snapshot come after its logs, so every bucket stays in ascending order
+            order = np.argsort(keys, kind="stable")
+            keys, starts = np.unique(keys[order], return_index=True)
+            arrays[f"{band}.keys"] = keys
+            arrays[f"{band}.offsets"] = np.append(starts, len(order)).astype(np.int64)
+            arrays[f"{band}.positions"] = positions[order]
+        return arrays
+
+    def restore(self, arrays):
+        """
+        Replaces the content of the index by the arrays of a snapshot.
+        """
+        self.clear()
+        self.base = [(arrays[f"{band}.keys"], arrays[f"{band}.offsets"], arrays[f"{band}.positions"]) for band in range(self.bands)]
+
+def from_env():
+    """
+    Returns the index configured by FP_LSH_BANDS, FP_LSH_ROWS and FP_LSH_MIN_LOGS, or None if blocking is disabled.
+    """
+    bands = int(os.environ.get("FP_LSH_BANDS") or 0)
+    if bands <= 0:
+        return None
+    return MinHashIndex(bands, int(os.environ.get("FP_LSH_ROWS", 4)), int(os.environ.get("FP_LSH_MIN_LOGS", 50_000)))
@@ -0,0 +1,142 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+"""
+metrics.py: This script keeps the metrics of the receiver and renders them in the Prometheus text format (/metrics).
+
+Metrics are kept in memory of the process; with several gunicorn workers every worker reports its own
+metrics. Recording a value is a few additions under a lock, so the instrumentation can stay on in production.
+
+Classes:
+- Histogram: Distribution of durations, by stage.
+- Counter: Monotonic counts, by a set of labels.
+- Gauge: Value read when the metrics are rendered.
+
+Functions:
+- stage: Context manager timing a stage of a request.
+- render: Returns all metrics in the Prometheus text format.
+"""
+
+# Upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, values)) + "}"
+
+class Histogram:
+    """
+    Distribution of observed values, kept separately for every value of one label.
+    """
+
+    def __init__(self, name, help, label, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = list(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        """
+        Records a value for a label value.
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                # Counts per bucket (the last one is +Inf), sum and count
+                series = self._series[label_value] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {label_value: (list(counts), total, count) for label_value, (counts, total, count) in self._series.items()}
+        for label_value, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ["+Inf"], counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{self.label}="{label_value}",le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{self.label}="{label_value}"}} {total}')
+            lines.append(f'{self.name}_count{{{self.label}="{label_value}"}} {count}')
+        return lines
+
+class Counter:
+    """
+    Monotonic counts, kept separately for every combination of label values.
+    """
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        """
+        Increments the count of a combination of label values.
+        """
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            lines.append(f"{self.name}{_labels(self.labels, label_values)} {value}")
+        return lines
+
+class Gauge:
+    """
+    Value read from a function when the metrics are rendered.
+    """
+
+    def __init__(self, name, help, function=None):
+        self.name = name
+        self.help = help
+        self.function = function
+
+    def render(self):
+        if self.function is None:
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.function()}"]
+
+stage_seconds = Histogram("fp_stage_duration_seconds", "Duration of the stages of a request.", "stage")
+requests_total = Counter("fp_requests_total", "Processed requests by endpoint.", ["endpoint"])
+fingerprints_total = Counter("fp_fingerprints_total", "Evaluated fingerprints by match outcome.", ["naive", "complex"])
+tier_decisions_total = Counter("fp_tier_decisions_total", "Fingerprints by the matching tier that decided.", ["tier"])
+budget_exhausted_total = Counter("fp_budget_exhausted_total", "Matching stages skipped or cut short because the request budget was spent.", ["stage", "action"])
+repeats_total = Counter("fp_exact_repeats_total", "Lookups of exact repeats of a stored fingerprint by outcome.", ["outcome"])
+disk_writes_total = Counter("fp_disk_writes_total", "Logs written to disk.")
+store_size = Gauge("fp_store_logs", "Number of logs in the in-memory store.")
+write_queue_size = Gauge("fp_write_queue_logs", "Number of logs waiting in the write-behind queue.")
+
+registry = [stage_seconds, requests_total, fingerprints_total, tier_decisions_total, budget_exhausted_total, repeats_total, disk_writes_total, store_size, write_queue_size]
+
+@contextmanager
+def stage(name):
+    """
+    Times the enclosed block as a stage of a request.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(name, time.perf_counter() - start)
+
+def render():
+    """
+    Returns all metrics in the Prometheus text format.
+    """
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
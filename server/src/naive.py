@@ -1,7 +1,11 @@
+import numpy as np
 import pandas as pd
 import ast
 import json
 
+from fingerprint_store import as_store, parse_attributes
+from log import get_logger
+
 """
 naive.py: This script implements a naive approach for identifying users based on attribute matching. 
 It compares the current user's attributes against a stored set of known users in a DataFrame, looking for the most similar match. 
@@ -12,10 +16,15 @@ If no match is found at all, the user is considered new.
 
 Functions:
 - count_similar_columns: Compares a user's attributes with the current user and counts the number of matching columns.
+- score_columns: Vectorised count_similar_columns over all users in the store.
+- score_columns_many: score_columns for several users in one pass over the store.
 - naive_search: Compares the current user against stored users, and returns the most similar user or indicates a new user.
 - naive: The main entry point that performs the naive search.
+- naive_batch: Performs the naive search for several users at once.
 """
 
+logger = get_logger(__name__)
+
 # Constants
 # MAX_MATCH: Defines the maximum number of matching columns required for a user to be considered the same.
 MAX_MATCH = 36
@@ -45,21 +54,80 @@ def count_similar_columns(row, test_user):
                     if k in test_attrs and row_attrs[k] == test_attrs[k]:
                         count += 1
             except (ValueError, SyntaxError) as e:
-                print(f"[Naive] Error parsing Attributes column for user {row.get('ID', 'Unknown')}: {e}")
+                logger.warning("Error parsing Attributes column for user %s: %s", row.get('ID', 'Unknown'), e)
         else:
             if pd.notna(row[col]) and row[col] == test_user.get(col):
                 count += 1
 
     return count
 
-def naive_search(users, user_to_test):
+def _test_attributes(user_to_test):
+    test_attrs = parse_attributes(user_to_test.get("Attributes"))
+    if test_attrs is None:
+        logger.warning("Error parsing Attributes of the tested user")
+        test_attrs = {}
+    return test_attrs
+
+def score_columns(store, user_to_test, start=0, context=None):
+    """
+    Vectorised version of `count_similar_columns` over the whole store.
+    Counts for every stored log how many columns, and how many attributes inside the 'Attributes' column,
+    are equal to the tested user.
+
+    Parameters:
+    - store (FingerprintStore): The store with all stored user records.
+    - user_to_test (dict): The current user data as a dictionary.
+    - start (int): Only logs from this position on are scored.
+    - context (ComparisonContext): Comparison context of the request, optional. It is used for the logs it covers.
+
+    Returns:
+    - np.array: The number of matching columns for every stored log, in store order.
+    """
+    if context is not None and start == 0:
+        similarities = context.match_count(_test_attributes(user_to_test))
+        for col in store.columns:
+            similarities += context.column_equal(col, user_to_test.get(col))
+        if len(context) < len(store):
+            similarities = np.concatenate([similarities, score_columns(store, user_to_test, start=len(context))])
+        return similarities
+
+    similarities = store.attributes.match_count(_test_attributes(user_to_test), start=start)
+    for col, column in store.columns.items():
+        similarities += column.equal(user_to_test.get(col), start=start)
+    return similarities
+
+def score_columns_many(store, users_to_test):
+    """
+    `score_columns` for several users, scoring each column of the store once for all of them.
+
+    Parameters:
+    - store (FingerprintStore): The store with all stored user records.
+    - users_to_test (list): The users as dictionaries.
+
+    Returns:
+    - np.array: Matrix with one row per user and one column per stored log.
+    """
+    similarities = store.attributes.match_count_many([_test_attributes(user) for user in users_to_test])
+    for col, column in store.columns.items():
+        similarities += column.equal_many([user.get(col) for user in users_to_test])
+    return similarities
+
+def naive_search(users, user_to_test, similarities=None, context=None):
     """
     Compares a given user against a list of known users using a naive approach based on column matching.
     Returns the most similar known user if it meets the matching criteria.
 
+    The stored users are visited from the most similar one and the first user that has a full match,
+    matches on an important key or has more than THRESHOLD matches is returned. This is the same as returning
+    the most similar user among those meeting one of the criteria, so no sorting is needed.
+    Ties are resolved by the order of the store.
+
     Parameters:
-    - users (pd.DataFrame): A DataFrame containing all stored user records.
+    - users (FingerprintStore or pd.DataFrame): All stored user records.
     - user_to_test (dict): The current user data as a dictionary.
+    - similarities (np.array): Scores from `score_columns_many` for the first logs of the store, optional.
+      Logs stored after they were computed are scored here.
+    - context (ComparisonContext): Comparison context of the request, optional.
 
     Returns:
     - list: A list containing:
@@ -68,60 +136,78 @@ def naive_search(users, user_to_test):
         - int: The ID of the matched user (0 if new).
         - int: The log index of the matched user (0 if new).
     """
-
-    max_match_couter = 0
-
-    # Convert the test user to a Series for comparison
-    user_to_test = pd.Series(user_to_test, index=users.columns)
+    store = as_store(users)
 
     # Calculate number of matching columns for each stored user
-    similarities = users.apply(count_similar_columns, axis=1, test_user=user_to_test)
+    if similarities is None:
+        similarities = score_columns(store, user_to_test, context=context)
+    elif len(similarities) < len(store):
+        similarities = np.concatenate([similarities, score_columns(store, user_to_test, start=len(similarities))])
 
-    # Sort users by similarity (descending order)
-    sorted_similarities = similarities.sort_values(ascending=False)
-    sorted_users = users.loc[sorted_similarities.index]
-
-    # Keys considered important for identifying the user even if full match is not achieved
+    # Keys considered important for identifying the user even if full match is not achieved,
+    # rows matching on them are read from the hash indexes of the store
     important_keys = ["Audio", "Geom Canvas", "TXT Canvas"]
+    important_matches = {}
+    for key in important_keys:
+        important_matches[key] = np.zeros(len(store), dtype=bool)
+        important_matches[key][store.lookup(key, user_to_test.get(key))] = True
 
-    for index, user in sorted_users.iterrows():
-        match_count = sorted_similarities[index]
-        user_id = int(user["ID"])
-        log_id = int(user["Log"])
-
-        if match_count > max_match_couter:
-            max_match_couter = match_count
-
-        # Case 1: Full match found
-        if match_count == MAX_MATCH:
-            print(f"[NAIVE] Returning user {user_id} with {match_count} matches")
-            return [True, int(match_count), user_id, log_id]
-
-        # Case 2: Match based on at least one key attribute
-        for key in important_keys:
-            if key in user and user[key] == user_to_test.get(key):
-                print(f"[NAIVE] Returning user {user_id} with {match_count} matches (matched on {key})")
-                return [True, int(match_count), user_id, log_id]
-        
-        # Case 3: User does not match any important keys but has some other matches
-        if match_count > THRESHOLD:
-            print(f"[NAIVE] Returning user {user_id} with {match_count} matches (no important keys matched)")
-            return [True, int(match_count), user_id, log_id]
-
+    # Users meeting at least one of the criteria (Case 1 - 3)
+    candidates = (similarities == MAX_MATCH) | (similarities > THRESHOLD)
+    for key in important_keys:
+        candidates |= important_matches[key]
 
     # Case 4: No matches found
-    print(f"[NAIVE] New user - maximum {max_match_couter} matches")
-    return [False, 0, 0, 0]
+    if not candidates.any():
+        logger.debug("New user - maximum %s matches", similarities.max())
+        return [False, 0, 0, 0]
+
+    # The most similar candidate is the first one the search would reach
+    candidate_similarities = np.where(candidates, similarities, -1)
+    index = store.best(candidate_similarities)
+    match_count = int(similarities[index])
+    user_id = int(store.ids.values[index])
+    log_id = int(store.logs.values[index])
+
+    # Case 1: Full match found
+    if match_count == MAX_MATCH:
+        logger.debug("Returning user %s with %s matches", user_id, match_count)
+        return [True, match_count, user_id, log_id]
+
+    # Case 2: Match based on at least one key attribute
+    for key in important_keys:
+        if important_matches[key][index]:
+            logger.debug("Returning user %s with %s matches (matched on %s)", user_id, match_count, key)
+            return [True, match_count, user_id, log_id]
+
+    # Case 3: User does not match any important keys but has some other matches
+    logger.debug("Returning user %s with %s matches (no important keys matched)", user_id, match_count)
+    return [True, match_count, user_id, log_id]
 
 def naive(users, curr_user):
     """
     Entry point function for naive matching strategy.
 
     Parameters:
-    - users (pd.DataFrame): All stored users.
+    - users (FingerprintStore or pd.DataFrame): All stored users.
     - curr_user (dict): The current user being checked.
 
     Returns:
     - list: Result of the naive search.
     """
     return naive_search(users, curr_user)
+
+def naive_batch(users, curr_users):
+    """
+    Naive matching of several users against the same stored users, with one scoring pass for all of them.
+
+    Parameters:
+    - users (FingerprintStore or pd.DataFrame): All stored users.
+    - curr_users (list): The users being checked.
+
+    Returns:
+    - list: Result of the naive search for every user.
+    """
+    store = as_store(users)
+    similarities = score_columns_many(store, curr_users)
+    return [naive_search(store, user, row) for user, row in zip(curr_users, similarities)]
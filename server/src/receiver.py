@@ -1,13 +1,23 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
+import atexit
+import copy
+import os
 import pandas as pd
 
-from naive import naive                      # Basic fingerprint similarity detection
-from complex import complex                  # Advanced fingerprint analysis
+from naive import score_columns_many          # Basic fingerprint similarity detection
+from complex import calculate_farbling_similarities  # Advanced fingerprint analysis
+from cascade import Cascade                  # Tiered matching within a latency budget per request
 from data_manager import *                   # Utilities for loading and saving data
+from fingerprint_store import FingerprintStore  # In-memory store of all fingerprint logs
+from writer import SharedStore               # Store of a worker saving through the single writer process
+import lsh                                   # Candidate blocking of the complex algorithm in large stores
+import snapshot                              # Binary snapshot of the store for a fast start
+from write_behind import WriteBehindBackend, WriteBehindQueue  # Background persistence off the request path
 from farbling import test_farbling           # Tests for fingerprint noise injection (e.g., Canvas spoofing)
-from timestamp import get_curr_time          # Provides current timestamp for logging
-from user_manager import handle_saving_user  # Logic for saving new or updated user fingerprint data
+from user_manager import handle_saving_user, handle_saving_repeat  # Logic for saving new or updated user fingerprint data
+import metrics                               # Per-stage timings and counters for /metrics
+from log import get_logger                   # Leveled, non-blocking JSON logging
 
 """
 receiver.py
@@ -17,16 +27,51 @@ in the context of a fingerprinting detection test suite. It provides endpoints t
 - Retrieve HTTP request headers.
 - Retrieve client IP addresses.
 - Receive and process fingerprint data, using naive and complex detection methods along with a farbling test.
+  Matching runs as a cascade of tiers within a latency budget (see cascade.py), from a single lookup for exact
+  repeats of a stored fingerprint to scoring the whole store; the response tells which tier decided.
+- Receive and process many fingerprints at once, scoring each block of them against the store in one pass.
 - Store user fingerprint data.
+- Expose per-stage latencies, match outcomes and the store size in the Prometheus text format.
 - Serve as a logging and response system to evaluate potential browser randomization or spoofing techniques.
 
 Imported modules handle fingerprint analysis, farbling detection, data saving/loading, and user management.
 """
 
+logger = get_logger(__name__)
+
 # Initialize the Flask app and enable CORS
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)
 
+# Logs are written to disk by a background thread, so responses never wait for the disk.
+# Queued logs are written on shutdown.
+persistence = WriteBehindQueue()
+atexit.register(persistence.close)
+
+# Number of fingerprints of a batch scored against the store in one pass
+BATCH_BLOCK = 256
+
+# Matching tiers and latency budget, configured by FP_TIERS and FP_BUDGET_MS
+pipeline = Cascade()
+
+# Load the stored fingerprints once at startup; saved logs are applied to the store incrementally.
+# The store is mapped from its snapshot (FP_SNAPSHOT) and only the logs stored after it are read.
+# With several workers (FP_WRITER is set, see gunicorn.conf.py) all saves go through the writer process.
+if os.environ.get("FP_WRITER"):
+    store = SharedStore(os.environ["FP_WRITER"], blocking=lsh.from_env(), snapshot_path=snapshot.from_env()).load()
+else:
+    store = FingerprintStore(
+        WriteBehindBackend(open_backend(), persistence), blocking=lsh.from_env(), snapshot_path=snapshot.from_env()
+    ).load()
+    if hasattr(store.backend, "start_compaction"):
+        store.backend.start_compaction()
+    atexit.register(store.backend.close)
+    # Registered last, so it runs first: the snapshot is written while the backend is still open
+    atexit.register(store.save_snapshot)
+
+metrics.store_size.function = lambda: len(store)
+metrics.write_queue_size.function = lambda: len(persistence)
+
 # Endpoint for retrieving Accept headers sent by the browser
 @app.route('/get-accept-headers', methods=['GET'])
 def get_accept_headers():
@@ -44,40 +89,41 @@ def get_ip():
     ip = request.headers.get('X-Forwarded-For', request.remote_addr)
     return jsonify({"ip": ip})
 
-# Main endpoint that processes and evaluates submitted fingerprint data
-@app.route('/check', methods=['POST'])
-def get_data():
+def check_user(user_data, farbling, naive_user=None, naive_scores=None, complex_scores=None, budget=None):
+    """
+    Evaluates a single fingerprint against the store and saves it.
 
-    users = load_users() # Load existing user fingerprints stored in fp_data.csv
+    Parameters:
+    - user_data (dict): The submitted fingerprint, without Name.
+    - farbling (list): The result of `test_farbling` for the fingerprint.
+    - naive_user (dict): The fingerprint as the naive algorithm sees it (before the farbling adjustment), optional.
+    - naive_scores, complex_scores (np.array): Scores precomputed for a batch, optional.
+    - budget (cascade.Budget): The latency budget of the request, a new one by default.
 
-    user_data = request.json
-    user_attributes = user_data["Attributes"]
-    
-    # Save data to CSV if user is identified
-    if user_data['Name'] != "Not available":
-        file_path = "../data/" + user_data['Name'] + ".csv"
-        del user_data["Name"]
-        save_user_data(user_data, file_path)
-    
-    # Run farbling detection on fingerprint attributes
-    farbling = test_farbling(user_attributes)
+    Returns:
+    - list: The results summary returned to the client.
+    """
     res_farbling = farbling[1][0]
     cpu_farbling = farbling[2]
     mem_farbling = farbling[3]
 
-    # Run naive and complex detection algorithms if user database is available
-    if len(users) > 0:
-        res_naive = naive(users, user_data)
-        res_complex = complex(users, user_data, farbling)
-        found_naive = res_naive[0]
-        found_complex = res_complex[0]
-    else:
-        res_naive = [False]
-        res_complex = [False]
-        found_naive = False
-        found_complex = False
-
-    handle_saving_user(users, user_data, res_naive, res_complex)
+    # Requests are served on several threads: no other request may save to the store between the match and the save
+    with store.lock:
+        # Run the matching tiers against the in-memory store, from the exact repeat lookup to the exhaustive scans
+        match = pipeline.match(store, user_data, farbling, budget, naive_user, naive_scores, complex_scores)
+
+        with metrics.stage("save"):
+            if match.repeat is not None:
+                handle_saving_repeat(store, user_data, match.repeat)
+            elif match.conclusive:
+                handle_saving_user(store, user_data, match.naive, match.complex, match.context)
+            else:
+                # The skipped stages might have matched a returning user, saving a new user would split it
+                metrics.budget_exhausted_total.inc("save", "skipped")
+                logger.info("Budget spent before any tier matched, the fingerprint is not saved")
+    found_naive = match.found_naive
+    found_complex = match.found_complex
+    metrics.fingerprints_total.inc(str(bool(found_naive)).lower(), str(bool(found_complex)).lower())
 
     # Prepare results summary
     results = [
@@ -86,24 +132,103 @@ def get_data():
         {"Complex": found_complex}, 
         {"Resolution modified": res_farbling},
         {"CPU modified": cpu_farbling},
-        {"Memory modified": mem_farbling}
+        {"Memory modified": mem_farbling},
+        {"Tier": match.tier}
     ]
 
-    # Log results with timestamp
-    print(f"[RECEIVER][{get_curr_time()}] {results}")
-    
+    # Log results, the logger adds the timestamp
+    logger.info("%s", results, extra={"fields": {"success": found_naive or found_complex}})
+    return results
+
+def save_named_user(user_data):
+    """
+    Queues the data to be saved to CSV if user is identified, and removes the Name from the data.
+    The queued copy is deep, as matching adjusts the Attributes of the request for farbling before it is written.
+    """
+    if user_data['Name'] != "Not available":
+        file_path = "../data/" + user_data['Name'] + ".csv"
+        del user_data["Name"]
+        persistence.save_user_data(copy.deepcopy(user_data), file_path)
+
+# Main endpoint that processes and evaluates submitted fingerprint data
+@app.route('/check', methods=['POST'])
+def get_data():
+    metrics.requests_total.inc("check")
+
+    with metrics.stage("request"):
+        with metrics.stage("load"):
+            store.sync() # Apply logs saved by other workers
+
+        with metrics.stage("parse"):
+            user_data = request.json
+        budget = pipeline.budget() # The budget covers matching, not loading and parsing
+        save_named_user(user_data)
+
+        # Run farbling detection on fingerprint attributes
+        with metrics.stage("farbling"):
+            farbling = test_farbling(user_data["Attributes"])
+
+        return jsonify(check_user(user_data, farbling, budget=budget))
+
+# Endpoint that processes many fingerprints at once, e.g. replayed traffic or bulk uploads.
+# Returns the results of /check for every fingerprint, in order. The fingerprints are evaluated and saved
+# one after another as with /check, but each block of them is scored against the store in one pass.
+@app.route('/check-batch', methods=['POST'])
+def get_batch_data():
+    metrics.requests_total.inc("check-batch")
+
+    with metrics.stage("load"):
+        store.sync() # Apply logs saved by other workers
+
+    results = []
+    with metrics.stage("parse"):
+        users_data = request.json
+    for start in range(0, len(users_data), BATCH_BLOCK):
+        block = users_data[start:start + BATCH_BLOCK]
+        for user_data in block:
+            save_named_user(user_data)
+        with metrics.stage("farbling"):
+            farblings = [test_farbling(user_data["Attributes"]) for user_data in block]
+
+        # Naive sees the attributes before the farbling adjustment made for complex
+        naive_users = [dict(user_data, Attributes=dict(user_data["Attributes"])) for user_data in block]
+
+        # The store does not change from the scoring of the block to its last save, see check_user
+        with store.lock:
+            # Only the exhaustive tier scores the whole store. Exact repeats of stored fingerprints
+            # are not scored, they stay repeats as the store only grows
+            scored = []
+            if "exhaustive" in pipeline.tiers:
+                scored = [i for i, user_data in enumerate(block) if "exact" not in pipeline.tiers or store.find_repeat(user_data) is None]
+            naive_scores = [None] * len(block)
+            complex_scores = [None] * len(block)
+            with metrics.stage("batch_scoring"):
+                for i, scores in zip(scored, score_columns_many(store, [naive_users[i] for i in scored])):
+                    naive_scores[i] = scores
+                for i, scores in zip(scored, calculate_farbling_similarities(store, [block[i] for i in scored], [farblings[i] for i in scored])):
+                    complex_scores[i] = scores
+
+            # Logs saved by earlier fingerprints of the block are scored by the matching functions
+            for i, user_data in enumerate(block):
+                results.append(check_user(user_data, farblings[i], naive_users[i], naive_scores[i], complex_scores[i]))
+
     return jsonify(results)
 
+# Endpoint exposing the metrics of this process in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 # Endpoint to manually upload specific user fingerprint data
 @app.route('/save-user', methods=['POST'])
 def get_specific_data():
     user_data = request.json
-    print(f"[RECEIVER] Adding data from {user_data['Name']}")
+    logger.info("Adding data from %s", user_data['Name'])
     
     file_path = "../" + user_data['Name'] + ".csv"
     del user_data["Name"]
 
-    save_user_data(user_data, file_path)
+    persistence.save_user_data(user_data, file_path)
     
     return jsonify(True)
     
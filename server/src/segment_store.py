@@ -0,0 +1,406 @@
+import argparse
+import csv
+import json
+import math
+import os
+import struct
+import threading
+import time
+import zlib
+
+from data_manager import fieldnames, load_users
+from log import get_logger
+
+"""
+segment_store.py: This script implements an append-only storage engine for fingerprint logs.
+Logs are appended to segment files instead of reopening fp_data.csv for every save, so the cost of a write
+does not depend on how much is already stored.
+
+Every segment starts with a small file header (magic, version and the range of segment numbers it covers).
+Every record is a binary header (payload length and CRC32) followed by the log encoded as JSON. Nested fields
+such as Attributes or Media Capabilities keep their structure, so reading a log never re-tokenizes Python reprs.
+
+When the active segment grows over its size limit it is sealed and a new one is started. Sealed segments are
+merged by compaction, which can run in a background thread. A compacted segment records the range of segments
+it replaced, so a crash in the middle of compaction never duplicates logs.
+
+Durability is controlled by the fsync policy:
+- "always": every record is flushed and fsynced before `write` returns.
+- "interval": records are flushed immediately and fsynced at most every `fsync_interval` seconds.
+- "never": records are flushed immediately and fsync is left to the operating system.
+
+The current CSV schema can still be exported for the notebooks (`export_csv`).
+
+Classes:
+- SegmentStore: Append-only segmented storage backend with compaction.
+
+Usage:
+    python segment_store.py import ../fp_data.csv
+    python segment_store.py export ../fp_data.csv
+    python segment_store.py compact
+"""
+
+logger = get_logger(__name__)
+
+SEGMENT_DIR = "../fp_segments"
+
+MAGIC = b"FPSEG"
+VERSION = 1
+
+# Segment header: magic, version, first and last segment number covered by the segment
+SEGMENT_HEADER = struct.Struct("<5sHII")
+
+# Record header: payload length and CRC32 of the payload
+RECORD_HEADER = struct.Struct("<II")
+
+FSYNC_POLICIES = ("always", "interval", "never")
+
+def _encode(user_data):
+    """
+    Encodes a log as a JSON payload. Missing values (NaN) are stored as null.
+    """
+    record = {}
+    for key in fieldnames:
+        value = user_data.get(key)
+        if isinstance(value, float) and math.isnan(value):
+            value = None
+        record[key] = value
+    return json.dumps(record, separators=(",", ":"), default=str).encode("utf-8")
+
+def _segment_name(number):
+    return f"segment-{number:08d}.log"
+
+class SegmentStore:
+    """
+    Append-only storage backend made of segment files. It provides the same `read` / `write`
+    interface as the CSV backend of `data_manager`.
+    """
+
+    def __init__(self, directory=SEGMENT_DIR, fsync="interval", fsync_interval=1.0,
+                 max_segment_bytes=64 * 1024 * 1024, compact_threshold=8):
+        """
+        Parameters:
+        - directory (str): Directory holding the segment files.
+        - fsync (str): The fsync policy, one of FSYNC_POLICIES.
+        - fsync_interval (float): Maximal time in seconds between two fsyncs with the "interval" policy.
+        - max_segment_bytes (int): Size after which the active segment is sealed.
+        - compact_threshold (int): Number of sealed segments that triggers background compaction.
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy '{fsync}', expected one of {FSYNC_POLICIES}")
+
+        self.directory = directory
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.max_segment_bytes = max_segment_bytes
+        self.compact_threshold = compact_threshold
+
+        self._lock = threading.Lock()
+        self._compaction_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._compactor = None
+        self._active = None
+        self._active_size = 0
+        self._last_fsync = time.monotonic()
+
+        os.makedirs(directory, exist_ok=True)
+        self.segments = self._recover()
+        self._open_active()
+
+    def _path(self, number):
+        return os.path.join(self.directory, _segment_name(number))
+
+    def _read_header(self, path):
+        """
+        Returns the (first, last) segment numbers covered by a segment file.
+        """
+        with open(path, "rb") as file:
+            header = file.read(SEGMENT_HEADER.size)
+        if len(header) < SEGMENT_HEADER.size:
+            return None
+        magic, version, first, last = SEGMENT_HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a fingerprint segment")
+        return first, last
+
+    def _recover(self):
+        """
+        Lists the segments on disk. Segments replaced by a finished compaction are deleted,
+        and a torn record at the end of the newest segment is truncated.
+
+        Returns:
+        - list: Sorted (first, last) ranges of the live segments.
+        """
+        ranges = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".tmp"):
+                os.remove(os.path.join(self.directory, name))
+                continue
+            if not (name.startswith("segment-") and name.endswith(".log")):
+                continue
+            path = os.path.join(self.directory, name)
+            covered = self._read_header(path)
+            if covered is None:
+                os.remove(path)
+                continue
+            ranges.append(covered)
+
+        ranges.sort()
+        segments = []
+        for first, last in ranges:
+            if segments and first <= segments[-1][1]:
+                # Left behind by a compaction that already covers it
+                os.remove(self._path(first))
+                continue
+            segments.append((first, last))
+
+        if segments:
+            self._truncate_torn_tail(self._path(segments[-1][0]))
+        return segments
+
+    def _truncate_torn_tail(self, path):
+        """
+        Cuts an incomplete or corrupted record from the end of a segment, left there by a crash during a write.
+        """
+        valid = SEGMENT_HEADER.size
+        for _, end in self._scan(path, strict=False):
+            valid = end
+        if valid < os.path.getsize(path):
+            logger.warning("Truncating torn record at the end of %s", path)
+            with open(path, "r+b") as file:
+                file.truncate(valid)
+
+    def _scan(self, path, strict=True):
+        """
+        Reads the records of a segment.
+
+        Parameters:
+        - path (str): Path of the segment.
+        - strict (bool): Raise on a corrupted record. If False, stop at the first corrupted record.
+
+        Yields:
+        - tuple: The payload (bytes) and the offset after the record.
+        """
+        with open(path, "rb") as file:
+            data = file.read()
+        offset = SEGMENT_HEADER.size
+        while offset < len(data):
+            if offset + RECORD_HEADER.size > len(data):
+                break
+            length, checksum = RECORD_HEADER.unpack_from(data, offset)
+            start = offset + RECORD_HEADER.size
+            payload = data[start:start + length]
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                if strict:
+                    raise ValueError(f"Corrupted record at offset {offset} of {path}")
+                return
+            offset = start + length
+            yield payload, offset
+
+    def _new_segment(self, path, first, last):
+        file = open(path, "wb")
+        file.write(SEGMENT_HEADER.pack(MAGIC, VERSION, first, last))
+        return file
+
+    def _open_active(self):
+        """
+        Opens the active segment. The newest segment is reused if it is neither compacted nor full,
+        otherwise a fresh segment is started after the existing ones.
+        """
+        if self.segments:
+            first, last = self.segments[-1]
+            path = self._path(first)
+            size = os.path.getsize(path)
+            if first == last and size < self.max_segment_bytes:
+                self._active = open(path, "ab")
+                self._active_size = size
+                return
+
+        number = self.segments[-1][1] + 1 if self.segments else 1
+        self._active = self._new_segment(self._path(number), number, number)
+        self._active.flush()
+        self._active_size = SEGMENT_HEADER.size
+        self.segments.append((number, number))
+
+    def _sync(self, force=False):
+        self._active.flush()
+        now = time.monotonic()
+        if force or self.fsync == "always" or (self.fsync == "interval" and now - self._last_fsync >= self.fsync_interval):
+            os.fsync(self._active.fileno())
+            self._last_fsync = now
+
+    def write(self, user_data):
+        """
+        Appends a log to the active segment.
+
+        Parameters:
+        - user_data (dict): The user data including ID and Log.
+        """
+        self.write_many([user_data])
+
+    def write_many(self, users):
+        """
+        Appends several logs to the active segment, applying the fsync policy once for all of them.
+
+        Parameters:
+        - users (list): The user data of every log, including ID and Log.
+        """
+        records = []
+        for user_data in users:
+            payload = _encode(user_data)
+            records.append(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+
+        with self._lock:
+            for record in records:
+                if self._active_size + len(record) > self.max_segment_bytes and self._active_size > SEGMENT_HEADER.size:
+                    self._sync(force=True)
+                    self._active.close()
+                    self._open_active()
+                self._active.write(record)
+                self._active_size += len(record)
+            self._sync()
+
+    def read(self):
+        """
+        Returns all stored logs in the order they were written.
+
+        Returns:
+        - list: The logs as dictionaries.
+        """
+        with self._compaction_lock:
+            with self._lock:
+                self._active.flush()
+                segments = list(self.segments)
+
+            users = []
+            for first, _ in segments:
+                for payload, _ in self._scan(self._path(first)):
+                    users.append(json.loads(payload))
+        return users
+
+    def flush(self):
+        """
+        Flushes and fsyncs the active segment regardless of the fsync policy.
+        """
+        with self._lock:
+            self._sync(force=True)
+
+    def compact(self):
+        """
+        Merges all sealed segments into one. If several records have the same ID and Log,
+        only the last one is kept.
+
+        Returns:
+        - int: The number of segments that were merged.
+        """
+        with self._compaction_lock:
+            with self._lock:
+                sealed = self.segments[:-1]
+            if len(sealed) < 2:
+                return 0
+
+            records = {}
+            for first, _ in sealed:
+                for index, (payload, _) in enumerate(self._scan(self._path(first))):
+                    user = json.loads(payload)
+                    if user["ID"] is None or user["Log"] is None:
+                        key = (first, index)
+                    else:
+                        key = (user["ID"], user["Log"])
+                    records.pop(key, None)
+                    records[key] = payload
+
+            first, last = sealed[0][0], sealed[-1][1]
+            tmp_path = self._path(first) + ".tmp"
+            with self._new_segment(tmp_path, first, last) as file:
+                for payload in records.values():
+                    file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+                file.flush()
+                os.fsync(file.fileno())
+
+            # The header of the new segment covers the whole range, so once it replaces the first
+            # segment the remaining ones are stale even if the process stops before deleting them
+            os.replace(tmp_path, self._path(first))
+            with self._lock:
+                self.segments = [(first, last)] + self.segments[len(sealed):]
+            for number, _ in sealed[1:]:
+                os.remove(self._path(number))
+
+            logger.info("Compacted %s segments into %s", len(sealed), _segment_name(first))
+            return len(sealed)
+
+    def _compaction_loop(self, interval):
+        while not self._stop.wait(interval):
+            if len(self.segments) - 1 >= self.compact_threshold:
+                self.compact()
+
+    def start_compaction(self, interval=60.0):
+        """
+        Starts background compaction. Sealed segments are merged once there are at least `compact_threshold` of them.
+
+        Parameters:
+        - interval (float): Seconds between two checks.
+        """
+        if self._compactor is None:
+            self._compactor = threading.Thread(target=self._compaction_loop, args=(interval,), daemon=True)
+            self._compactor.start()
+
+    def close(self):
+        """
+        Stops background compaction and closes the active segment.
+        """
+        self._stop.set()
+        if self._compactor is not None:
+            self._compactor.join()
+            self._compactor = None
+        with self._lock:
+            if self._active is not None and not self._active.closed:
+                self._sync(force=True)
+                self._active.close()
+
+    def import_csv(self, file_path):
+        """
+        Appends all logs of a CSV file in the fp_data.csv schema.
+
+        Returns:
+        - int: The number of imported logs.
+        """
+        users = load_users(file_path)
+        if len(users) == 0:
+            return 0
+        for user in users.to_dict("records"):
+            self.write(user)
+        self.flush()
+        return len(users)
+
+    def export_csv(self, file_path):
+        """
+        Writes all stored logs to a CSV file with the `data_manager.fieldnames` schema.
+        Nested values are written the same way `write_user_to_file` writes them.
+
+        Returns:
+        - int: The number of exported logs.
+        """
+        users = self.read()
+        with open(file_path, mode="w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=fieldnames)
+            writer.writeheader()
+            for user in users:
+                writer.writerow(user)
+        return len(users)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintenance of the segmented fingerprint store.")
+    parser.add_argument("command", choices=["import", "export", "compact"])
+    parser.add_argument("csv", nargs="?", default="../fp_data.csv", help="CSV file to import from or export to")
+    parser.add_argument("--dir", default=SEGMENT_DIR, help="Directory of the segment files")
+    args = parser.parse_args()
+
+    store = SegmentStore(args.dir)
+    if args.command == "import":
+        print(f"Imported {store.import_csv(args.csv)} logs")
+    elif args.command == "export":
+        print(f"Exported {store.export_csv(args.csv)} logs")
+    else:
+        print(f"Merged {store.compact()} segments")
+    store.close()
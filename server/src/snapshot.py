@@ -0,0 +1,280 @@
+import argparse
+import json
+import math
+import mmap
+import os
+import sys
+import tempfile
+import time
+import uuid
+import numpy as np
+
+from columnar import GrowableArray
+from log import get_logger
+
+"""
+snapshot.py: This script saves the in-memory fingerprint store to a binary file and maps it back at startup,
+so restarting the server, or starting another gunicorn worker, does not parse the stored history again.
+
+A snapshot holds every structure of the store as raw NumPy arrays: the code columns and their dictionaries,
+the parsed Attributes, the hash, repeat and ID indexes, the ID/Log counters and the candidate blocking buckets.
+Loading maps the file copy-on-write (`mmap.ACCESS_COPY`) and wraps the arrays without reading them, so it takes
+milliseconds at any store size; pages are read from disk as they are used, shared between the processes
+mapping the same file, and copied only when a process changes them.
+
+Every snapshot records the checkpoint of the storage backend it was taken at (e.g. the size of fp_data.csv).
+After loading, the store ingests the logs the backend stored after the checkpoint (`read_since`). A snapshot
+that does not match its backend (e.g. the CSV file was rewritten), was written by another version of this
+format or Python, or with other store settings, is ignored and the store loads all logs as without it.
+
+File layout:
+- 8 bytes: MAGIC.
+- 8 bytes: Length of the header (little endian).
+- Header: JSON with the version, settings, counters and the dtype, shape and offset of every array.
+- Arrays, each starting at a multiple of ALIGNMENT bytes.
+
+Configuration (environment variables):
+- FP_SNAPSHOT: Snapshot file of the server, SNAPSHOT_PATH by default. Empty disables snapshots.
+
+Functions:
+- save: Writes a store to a snapshot file.
+- load: Restores a store from a snapshot file.
+- read_header: Returns the header of a snapshot file.
+- from_env: Returns the snapshot file configured by the environment.
+
+Usage:
+    python snapshot.py build
+    python snapshot.py info
+"""
+
+logger = get_logger(__name__)
+
+SNAPSHOT_PATH = "../fp_snapshot.bin"
+
+MAGIC = b"FPSNAP\r\n"
+
+# Version of the file layout, a snapshot of another version is ignored
+VERSION = 1
+
+ALIGNMENT = 64
+
+# Number of logs ingested on top of a snapshot from which `FingerprintStore.load` rewrites it
+REFRESH_LOGS = 10_000
+
+# The marshal format of the dictionary values is only guaranteed within one Python version
+PYTHON = "%d.%d" % sys.version_info[:2]
+
+def _prefixed(prefix, arrays):
+    return {f"{prefix}.{name}": array for name, array in arrays.items()}
+
+def _group(arrays):
+    """
+    Splits named arrays by the part of their name before the first dot.
+    """
+    groups = {}
+    for name, array in arrays.items():
+        group, _, rest = name.partition(".")
+        groups.setdefault(group, {})[rest] = array
+    return groups
+
+def _blocking_settings(blocking):
+    return None if blocking is None else {"bands": blocking.bands, "rows": blocking.rows, "seed": blocking.seed}
+
+def save(store, path, checkpoint):
+    """
+    Writes a store to a snapshot file. The file is written next to the target and renamed over it,
+    so a process loading the snapshot never sees a partial file.
+
+    Parameters:
+    - store (FingerprintStore): The store.
+    - path (str): The snapshot file.
+    - checkpoint (dict): The checkpoint of the storage backend, whose logs up to it must be exactly the logs of the store.
+
+    Returns:
+    - str: The ID of the new snapshot.
+
+    Raises:
+    - ValueError: If a stored value cannot be serialised.
+    """
+    start = time.perf_counter()
+    arrays = {"ids": store.ids.values, "logs": store.logs.values, "latest_logs": store.latest_logs.values}
+    for key, column in store.columns.items():
+        arrays.update(_prefixed(f"columns.{key}", column.arrays()))
+    for key, index in store.hash_index.items():
+        arrays.update(_prefixed(f"hash_index.{key}", index.arrays()))
+    arrays.update(_prefixed("repeat_codes", store.repeat_codes.arrays()))
+    arrays.update(_prefixed("repeat_index", store.repeat_index.arrays()))
+    arrays.update(_prefixed("id_index", store.id_index.arrays()))
+    arrays.update(_prefixed("attributes", store.attributes.arrays()))
+    if store.blocking is not None:
+        arrays.update(_prefixed("blocking", store.blocking.arrays()))
+
+    snapshot_id = uuid.uuid4().hex
+    header = {
+        "version": VERSION,
+        "python": PYTHON,
+        "id": snapshot_id,
+        "created": time.time(),
+        "count": len(store),
+        "checkpoint": checkpoint,
+        "order_by_key": store.order_by_key,
+        "next_id": store.next_id,
+        "columns": list(store.columns),
+        "blocking": _blocking_settings(store.blocking),
+        # NaN (no Attributes) is written as null
+        "attributes_text": [[position, text if isinstance(text, str) else None] for position, text in store.attributes_text.items()],
+        "arrays": {},
+    }
+    # The offsets are relative to the end of the header, whose length depends on them
+    offset = 0
+    for name, array in arrays.items():
+        header["arrays"][name] = [array.dtype.str, list(array.shape), offset]
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    encoded = json.dumps(header).encode()
+    data_start = -(-(len(MAGIC) + 8 + len(encoded)) // ALIGNMENT) * ALIGNMENT
+
+    directory = os.path.dirname(os.path.abspath(path))
+    descriptor, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, "wb") as file:
+            file.write(MAGIC + len(encoded).to_bytes(8, "little") + encoded)
+            for name, array in arrays.items():
+                file.seek(data_start + header["arrays"][name][2])
+                file.write(np.ascontiguousarray(array).data)
+            file.truncate(data_start + offset)
+            file.flush()
+            os.fsync(file.fileno())
+        # mkstemp creates the file readable by its owner only
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    store.snapshot_count = len(store)
+    store.snapshot_ids.add(snapshot_id)
+    logger.info("Saved snapshot %s of %s logs to %s in %.2f s", snapshot_id, len(store), path, time.perf_counter() - start)
+    return snapshot_id
+
+def _map(path):
+    """
+    Maps a snapshot file copy-on-write and parses its header.
+
+    Returns:
+    - tuple: The mapping, the header and the offset of the first array.
+    """
+    with open(path, "rb") as file:
+        mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+    if mapping[:len(MAGIC)] != MAGIC:
+        raise ValueError("not a snapshot file")
+    length = int.from_bytes(mapping[len(MAGIC):len(MAGIC) + 8], "little")
+    header = json.loads(mapping[len(MAGIC) + 8:len(MAGIC) + 8 + length])
+    data_start = -(-(len(MAGIC) + 8 + length) // ALIGNMENT) * ALIGNMENT
+    return mapping, header, data_start
+
+def read_header(path):
+    """
+    Returns the header of a snapshot file, without the table of arrays.
+    """
+    _, header, _ = _map(path)
+    del header["arrays"]
+    return header
+
+def _mismatch(store, header):
+    """
+    Returns why a snapshot cannot be restored into a store, or None if it can.
+    """
+    if header.get("version") != VERSION:
+        return f"version {header.get('version')} instead of {VERSION}"
+    if header["python"] != PYTHON:
+        return f"written by Python {header['python']}"
+    if header["order_by_key"] != store.order_by_key or header["columns"] != list(store.columns):
+        return "other store settings"
+    if store.blocking is not None and header["blocking"] != _blocking_settings(store.blocking):
+        # Without the buckets of the snapshot the candidates would miss its logs
+        return "other candidate blocking settings"
+    return None
+
+def load(store, path):
+    """
+    Restores a store from a snapshot file, replacing its content. The arrays are mapped, not read.
+
+    Parameters:
+    - store (FingerprintStore): The store, empty.
+    - path (str): The snapshot file.
+
+    Returns:
+    - dict: The header of the snapshot (with its "checkpoint"), or None if there is no snapshot that fits the store.
+    """
+    if not os.path.isfile(path):
+        logger.info("No snapshot at %s", path)
+        return None
+    start = time.perf_counter()
+    try:
+        mapping, header, data_start = _map(path)
+    except (OSError, ValueError) as error:
+        logger.warning("Ignoring snapshot %s: %s", path, error)
+        return None
+    reason = _mismatch(store, header)
+    if reason is not None:
+        logger.warning("Ignoring snapshot %s: %s", path, reason)
+        return None
+
+    arrays = {}
+    for name, (dtype, shape, offset) in header["arrays"].items():
+        dtype = np.dtype(dtype)
+        arrays[name] = np.frombuffer(mapping, dtype=dtype, count=math.prod(shape), offset=data_start + offset).reshape(shape)
+    groups = _group(arrays)
+
+    store.ids = GrowableArray.restore(arrays["ids"], np.nan)
+    store.logs = GrowableArray.restore(arrays["logs"], np.nan)
+    store.latest_logs = GrowableArray.restore(arrays["latest_logs"], np.nan)
+    columns = _group(groups["columns"])
+    for key, column in store.columns.items():
+        column.restore(columns[key])
+    indexes = _group(groups["hash_index"])
+    for key, index in store.hash_index.items():
+        index.restore(indexes[key])
+    store.repeat_codes.restore(groups["repeat_codes"])
+    store.repeat_index.restore(groups["repeat_index"])
+    store.id_index.restore(groups["id_index"])
+    store.attributes.restore(groups["attributes"])
+    if store.blocking is not None:
+        store.blocking.restore(groups["blocking"])
+    store.attributes_text = {position: float("nan") if text is None else text for position, text in header["attributes_text"]}
+    store.next_id = header["next_id"]
+    store.snapshot_count = header["count"]
+    store.snapshot_ids.add(header["id"])
+
+    logger.info("Loaded snapshot %s of %s logs from %s in %.1f ms", header["id"], header["count"], path, (time.perf_counter() - start) * 1e3)
+    return header
+
+def from_env():
+    """
+    Returns the snapshot file configured by FP_SNAPSHOT, or None if snapshots are disabled.
+    """
+    return os.environ.get("FP_SNAPSHOT", SNAPSHOT_PATH) or None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or inspect the snapshot of the fingerprint store.")
+    parser.add_argument("command", choices=["build", "info"])
+    parser.add_argument("--path", default=from_env() or SNAPSHOT_PATH, help="Snapshot file")
+    args = parser.parse_args()
+
+    if args.command == "info":
+        print(json.dumps(read_header(args.path), indent=2))
+    else:
+        import lsh
+        from data_manager import open_backend
+        from fingerprint_store import FingerprintStore
+
+        backend = open_backend()
+        if not hasattr(backend, "checkpoint"):
+            sys.exit("The storage backend has no checkpoints, no snapshot can be written")
+        start = time.perf_counter()
+        store = FingerprintStore(backend, blocking=lsh.from_env()).load()
+        loaded = time.perf_counter()
+        save(store, args.path, backend.checkpoint())
+        print(f"Loaded {len(store)} logs in {loaded - start:.2f} s, wrote {args.path} "
+              f"({os.path.getsize(args.path)} bytes) in {time.perf_counter() - loaded:.2f} s")
+        backend.close()
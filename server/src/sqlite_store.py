@@ -0,0 +1,244 @@
+import argparse
+import glob
+import json
+import math
+import os
+import sqlite3
+import sys
+import threading
+import pandas as pd
+
+from data_manager import fieldnames, hash_fieldnames, load_users
+from fingerprint_store import parse_attributes
+
+"""
+sqlite_store.py: This script implements an SQLite storage backend for fingerprint logs.
+It offers the same `read` / `write` / `checkpoint` interface as the CSV backend of `data_manager`, so it can back the
+fingerprint store and its snapshot, and adds indexed queries that do not need the full table.
+
+The database runs in WAL mode, so any number of readers (other workers, notebooks) can read while the server writes.
+ID and Log, and every hash column, are indexed. Attributes, Media Capabilities and Plugins are stored as JSON.
+
+Two tables share the same columns:
+- logs: the fingerprints stored by the server (the content of fp_data.csv).
+- captures: labelled captures from data/browser_data, with the name of the source file. They have no IDs,
+  so they are kept apart from the logs the server matches against.
+
+Classes:
+- SqliteBackend: SQLite storage backend with indexed lookups.
+
+Migrating refuses a database that already holds logs or captures, as importing them twice would duplicate
+every (ID, Log); `--replace` deletes them first.
+
+Usage:
+    python sqlite_store.py migrate --csv ../fp_data.csv --captures "../../data/browser_data/*.csv"
+    python sqlite_store.py migrate --replace
+"""
+
+DB_PATH = "../fp_data.db"
+
+TABLES = ("logs", "captures")
+
+# Columns holding nested structures, stored as JSON
+JSON_FIELDS = ["Attributes", "Media Capabilities", "Plugins"]
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+def _encode(key, value):
+    """
+    Converts a value to its SQLite representation.
+    """
+    if _is_missing(value):
+        return None
+    if key in ("ID", "Log"):
+        return int(value)
+    if key == "Attributes":
+        attributes = parse_attributes(value)
+        return json.dumps(value if attributes is None else attributes)
+    if key in JSON_FIELDS:
+        return json.dumps(value)
+    return value if isinstance(value, str) else str(value)
+
+def _decode(key, value):
+    """
+    Converts an SQLite value back to the value that was written.
+    """
+    if value is None:
+        return float("nan")
+    if key in JSON_FIELDS:
+        return json.loads(value)
+    return value
+
+class SqliteBackend:
+    """
+    Storage backend keeping all logs in an SQLite database.
+    """
+
+    def __init__(self, path=DB_PATH):
+        """
+        Parameters:
+        - path (str): Path of the database file.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self._create_schema()
+
+    def _create_schema(self):
+        columns = ", ".join(f"{_quote(key)} {'INTEGER' if key in ('ID', 'Log') else 'TEXT'}" for key in fieldnames)
+        with self.connection:
+            for table in TABLES:
+                source = ", source TEXT" if table == "captures" else ""
+                self.connection.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} (seq INTEGER PRIMARY KEY AUTOINCREMENT, {columns}{source})"
+                )
+                self.connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_id_log ON {table} (ID, Log)")
+                for key in ["AttributesHash"] + hash_fieldnames:
+                    index = f"{table}_{key.replace(' ', '_').lower()}"
+                    self.connection.execute(f"CREATE INDEX IF NOT EXISTS {index} ON {table} ({_quote(key)})")
+
+    def _insert(self, table, users, source=None):
+        keys = list(fieldnames) + (["source"] if table == "captures" else [])
+        statement = f"INSERT INTO {table} ({', '.join(_quote(key) for key in keys)}) VALUES ({', '.join('?' * len(keys))})"
+        rows = []
+        for user in users:
+            row = [_encode(key, user.get(key)) for key in fieldnames]
+            if table == "captures":
+                row.append(source)
+            rows.append(row)
+        with self._lock, self.connection:
+            self.connection.executemany(statement, rows)
+        return len(rows)
+
+    def _select(self, where="", parameters=(), table="logs"):
+        columns = ", ".join(_quote(key) for key in fieldnames)
+        with self._lock:
+            cursor = self.connection.execute(f"SELECT {columns} FROM {table} {where}", parameters)
+            rows = cursor.fetchall()
+        return [{key: _decode(key, value) for key, value in zip(fieldnames, row)} for row in rows]
+
+    def read(self):
+        """
+        Returns all stored logs sorted by ID and Log.
+        """
+        return self._select("ORDER BY ID, Log, seq")
+
+    def write(self, user_data):
+        """
+        Appends a log in its own transaction.
+        """
+        self._insert("logs", [user_data])
+
+    def write_many(self, users):
+        """
+        Appends several logs in one transaction.
+        """
+        self._insert("logs", users)
+
+    def checkpoint(self):
+        """
+        Returns a marker of the logs stored so far: the highest sequence number and the number of logs.
+        """
+        with self._lock:
+            seq, count = self.connection.execute("SELECT COALESCE(MAX(seq), 0), COUNT(*) FROM logs").fetchone()
+        return {"backend": "sqlite", "seq": seq, "count": count}
+
+    def read_since(self, marker):
+        """
+        Returns the logs stored after a checkpoint, sorted by ID and Log.
+
+        Returns:
+        - list: The logs, or None if the logs up to the marker are not the ones it was taken of.
+        """
+        if marker.get("backend") != "sqlite":
+            return None
+        with self._lock:
+            count, = self.connection.execute("SELECT COUNT(*) FROM logs WHERE seq <= ?", (marker["seq"],)).fetchone()
+        if count != marker["count"]:
+            return None
+        return self._select("WHERE seq > ? ORDER BY ID, Log, seq", (marker["seq"],))
+
+    def count(self, table="logs"):
+        """
+        Returns the number of rows of a table.
+        """
+        with self._lock:
+            return self.connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+    def clear(self, table="logs"):
+        """
+        Deletes all rows of a table. The sequence numbers are not reused, so earlier checkpoints stop matching.
+        """
+        with self._lock, self.connection:
+            self.connection.execute(f"DELETE FROM {table}")
+
+    def lookup(self, column, value, table="logs"):
+        """
+        Returns all logs whose column equals the value, using the index of the column.
+
+        Parameters:
+        - column (str): ID, Log, AttributesHash or one of the hash columns.
+        - value: The value to look for.
+        - table (str): "logs" or "captures".
+
+        Returns:
+        - list: The matching logs as dictionaries.
+        """
+        if column not in ["ID", "Log", "AttributesHash"] + hash_fieldnames:
+            raise ValueError(f"Column '{column}' is not indexed")
+        return self._select(f"WHERE {_quote(column)} = ? ORDER BY ID, Log, seq", (value,), table)
+
+    def load_users(self, table="logs"):
+        """
+        Returns a table as a DataFrame in the schema of fp_data.csv, for analysis.
+        """
+        order = "ORDER BY ID, Log, seq" if table == "logs" else "ORDER BY seq"
+        return pd.DataFrame(self._select(order, table=table), columns=fieldnames)
+
+    def import_csv(self, file_path, table="logs", source=None):
+        """
+        Imports all logs of a CSV file in the fp_data.csv schema.
+
+        Returns:
+        - int: The number of imported logs.
+        """
+        users = load_users(file_path)
+        if len(users) == 0:
+            return 0
+        return self._insert(table, users.to_dict("records"), source)
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate CSV fingerprint data into the SQLite store.")
+    parser.add_argument("command", choices=["migrate"])
+    parser.add_argument("--db", default=DB_PATH, help="Path of the database file")
+    parser.add_argument("--csv", default="../fp_data.csv", help="CSV file with the server's logs")
+    parser.add_argument("--captures", default="../../data/browser_data/*.csv", help="Glob of labelled capture files")
+    parser.add_argument("--replace", action="store_true", help="Delete the logs and captures already in the database")
+    args = parser.parse_args()
+
+    backend = SqliteBackend(args.db)
+    stored = {table: backend.count(table) for table in TABLES}
+    if any(stored.values()):
+        if not args.replace:
+            backend.close()
+            sys.exit(f"{args.db} already holds {stored['logs']} logs and {stored['captures']} captures, "
+                     "use --replace to delete them and migrate again")
+        for table in TABLES:
+            backend.clear(table)
+        print(f"Deleted {stored['logs']} logs and {stored['captures']} captures")
+    if os.path.isfile(args.csv):
+        print(f"Imported {backend.import_csv(args.csv)} logs from {args.csv}")
+    for file_path in sorted(glob.glob(args.captures)):
+        source = os.path.splitext(os.path.basename(file_path))[0]
+        print(f"Imported {backend.import_csv(file_path, 'captures', source)} captures from {file_path}")
+    backend.close()
@@ -0,0 +1,51 @@
+from benchmark import synthetic_user
+from fingerprint_store import FingerprintStore, parse_attributes
+
+"""
+test_check_batch.py: Checks that /check-batch gives the results of one /check per fingerprint and stores the same logs.
+
+Usage:
+    cd server/src
+    python -m pytest test_check_batch.py
+"""
+
+def fingerprints():
+    """
+    Returns returning users, exact repeats and new users, with the resolution of some of them farbled.
+    """
+    users = []
+    for visit in range(3):
+        for user_id in range(6):
+            user = synthetic_user(user_id)
+            if (user_id + visit + 1) % 2:
+                user["Attributes"]["Screen Width"] = 2497 + visit
+                user["Attributes"]["Screen Height"] = 1334
+            if visit == 2 and user_id % 3 == 0:
+                user["Audio"] = f"audio {user_id}"
+            users.append(user)
+    users.append(synthetic_user(100))
+    return users
+
+def run(receiver, check):
+    """
+    Checks the fingerprints with `check` against an empty store that only lives in memory.
+
+    Returns:
+    - tuple: The results and the stored (ID, Log, Attributes).
+    """
+    receiver.store = FingerprintStore()
+    results = check(receiver.app.test_client(), fingerprints())
+    rows = [(row["ID"], row["Log"], parse_attributes(row["Attributes"])) for row in receiver.store.rows]
+    return results, rows
+
+def test_batch_equals_sequential(receiver):
+    sequential = run(receiver, lambda client, users: [client.post("/check", json=user).json for user in users])
+    batch = run(receiver, lambda client, users: client.post("/check-batch", json=users).json)
+    assert batch == sequential
+
+def test_empty_store_keeps_attributes(receiver):
+    users = fingerprints()
+    results, rows = run(receiver, lambda client, users: client.post("/check-batch", json=users[:1]).json)
+    assert results[0][0] == {"Success": False}
+    # Nothing is matched against an empty store, so the attributes are stored as submitted
+    assert rows[0][2] == users[0]["Attributes"]
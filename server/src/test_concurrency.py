@@ -0,0 +1,67 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmark import synthetic_user
+from fingerprint_store import FingerprintStore
+from naive import naive
+
+"""
+test_concurrency.py: Checks that requests served on several threads never match against a store that another
+thread is saving to.
+
+Usage:
+    cd server/src
+    python -m pytest test_concurrency.py
+"""
+
+THREADS = 8
+
+def test_concurrent_checks(receiver):
+    receiver.store = FingerprintStore()
+    users = []
+    for visit in range(4):
+        for user_id in range(50):
+            user = synthetic_user(user_id)
+            # Not an exact repeat, so every visit is scored against the whole store
+            user["AttributesHash"] = f"visit {visit}"
+            users.append(user)
+
+    def check(user):
+        response = receiver.app.test_client().post("/check", json=user)
+        return response.status_code
+
+    with ThreadPoolExecutor(THREADS) as pool:
+        statuses = list(pool.map(check, users))
+
+    assert statuses == [200] * len(users)
+    assert len(receiver.store) == len(users)
+    # IDs and logs are allocated under the lock, so no log is created twice
+    keys = [(row["ID"], row["Log"]) for row in receiver.store.rows]
+    assert len(set(keys)) == len(keys)
+    assert len({user_id for user_id, _ in keys}) == 50
+
+def test_match_while_saving():
+    store = FingerprintStore()
+    for user_id in range(20):
+        store.save_new_user(synthetic_user(user_id))
+    errors = []
+
+    def save():
+        for user_id in range(20, 520):
+            store.save_new_user(synthetic_user(user_id))
+
+    def match():
+        for user_id in range(200):
+            try:
+                with store.lock:
+                    naive(store, synthetic_user(user_id % 20))
+            except Exception as error:
+                errors.append(error)
+
+    threads = [threading.Thread(target=save)] + [threading.Thread(target=match) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(store) == 520
@@ -0,0 +1,78 @@
+from write_behind import WriteBehindBackend, WriteBehindQueue
+
+"""
+test_write_behind.py: Checks that the write-behind queue writes every log, also when writes fail.
+
+Usage:
+    cd server/src
+    python -m pytest test_write_behind.py
+"""
+
+class FlakySink:
+    """
+    Sink whose first `failures` writes raise, with a checkpoint of the logs written so far.
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.written = []
+
+    def write_many(self, users):
+        if self.failures > 0:
+            self.failures -= 1
+            raise OSError("No space left on device")
+        self.written.extend(users)
+
+    def write(self, user_data):
+        self.write_many([user_data])
+
+    def checkpoint(self):
+        return {"count": len(self.written)}
+
+    def close(self):
+        pass
+
+def logs(count):
+    return [{"ID": i, "Log": 0} for i in range(count)]
+
+def test_failed_writes_are_retried():
+    sink = FlakySink(failures=3)
+    write_queue = WriteBehindQueue(batch_size=4, flush_interval=0.01)
+    for user_data in logs(10):
+        write_queue.put(sink, user_data)
+    write_queue.close()
+    assert sink.written == logs(10)
+    assert write_queue.failed == 0
+
+def test_retry_keeps_the_order_of_a_sink():
+    sink = FlakySink(failures=1)
+    other = FlakySink(failures=0)
+    write_queue = WriteBehindQueue(batch_size=8, flush_interval=0.01)
+    for user_data in logs(6):
+        write_queue.put(sink, user_data)
+        write_queue.put(other, user_data)
+    write_queue.close()
+    assert sink.written == logs(6)
+    assert other.written == logs(6)
+
+def test_no_checkpoint_while_logs_are_missing():
+    sink = FlakySink(failures=10 ** 9)
+    backend = WriteBehindBackend(sink, WriteBehindQueue(flush_interval=0.01))
+    for user_data in logs(3):
+        backend.write(user_data)
+    assert backend.checkpoint() is None
+    assert backend.queue.failed == 3
+    assert len(backend.queue) == 3
+    sink.failures = 0
+    backend.close()
+    assert sink.written == logs(3)
+    assert backend.queue.failed == 0
+
+def test_logs_lost_on_close_are_counted():
+    sink = FlakySink(failures=10 ** 9)
+    write_queue = WriteBehindQueue(flush_interval=0.01)
+    for user_data in logs(4):
+        write_queue.put(sink, user_data)
+    write_queue.close()
+    assert sink.written == []
+    assert write_queue.failed == 4
@@ -1,133 +1,135 @@
-from data_manager import prepare_user_data, save_new_user, save_user_data
-from naive import count_similar_columns
+from comparison import ComparisonContext
+from fingerprint_store import as_store
+from naive import score_columns
+from log import get_logger
 
 """
 user_manager.py: This script is responsible for managing user data within the system. It handles user logs, saving new users, and updating existing users based on their fingerprints and attributes. 
 The script uses naive and complex matching results to determine if a user is new or returning, and it handles log saving accordingly.
 
 Functions:
-- get_next_log: Determines the next available log number for a given user by checking their existing logs.
+- get_next_log: Determines the next available log number for a given user from the store's log counters.
 - handle_user_log_saving: Handles saving user data for a specific log entry.
 - handle_saving_user: Decides whether the user is new or returning, and saves the user data accordingly.
+- handle_saving_repeat: Saves an exact repeat of a stored fingerprint as the next log of its user.
 """
 
-FILEPATH = "../fp_data.csv"
+logger = get_logger(__name__)
 
 def get_next_log(users, user, id):
     """
-    Determines the next log number and the index of the user in the users list.
-    It checks how many logs a user has and returns the next log number and the index of the user.
+    Determines the next log number and the position of the user's latest log in the store.
+    The number of logs of every user is kept by the store, so no stored user is visited.
 
     Parameters:
-    - users (pd.DataFrame): A DataFrame containing all stored user records.
+    - users (FingerprintStore or pd.DataFrame): All stored user records.
     - user (dict): The current user data to be processed.
     - id (int): The ID of the user to find the next log number for.
 
     Returns:
-    - tuple: A tuple containing the log number (int) and the index of the user in the DataFrame (int).
+    - tuple: A tuple containing the log number (int) and the position after the user's latest log (int).
     """
-    log_counter = 0
-    index_counter = 0
-    flag = False
-            
-    # Loop through the users to find the user with the given ID and count their logs
-    for index, user in users.iterrows():
-        if flag and user["ID"] != id:
-            break
-        
-        index_counter += 1
-        if user["ID"] != id:
-            continue
-        if user["ID"] == id:
-            log_counter += 1
-            flag = True
+    store = as_store(users)
+    identity = store.identities.get(id)
+    if identity is None:
+        return 0, len(store)
     
-    return log_counter, index_counter
+    return identity.count, identity.last_position + 1
 
-def handle_user_log_saving(users, user_data, id):
+def handle_user_log_saving(store, user_data, id):
     """
     Handles the saving of user data for a specific log entry. This involves preparing the data and calling the save function.
     
     Parameters:
-    - users (pd.DataFrame): A DataFrame containing all stored user records.
+    - store (FingerprintStore): The store containing all stored user records.
     - user_data (dict): The current user data to be saved.
     - id (int): The ID of the user for whom the log is being created.
     """
-    log_counter, index_counter = get_next_log(users, user_data, id)
-    log = log_counter
-    
-    print(f"[RECEIVER] Creating Log:{log} for UID:{id}")
-    user_data = prepare_user_data(user_data, id, log)
-    save_user_data(user_data, FILEPATH)
+    # The store assigns the next log number (get_next_log) and saves it in one step,
+    # so concurrent workers sharing a writer never create the same log twice
+    user_data = store.save_log(id, user_data)
+    logger.info("Creating Log:%s for UID:%s", user_data['Log'], id)
 
-def handle_saving_user(users, user_data, res_naive, res_complex):
+def handle_saving_user(store, user_data, res_naive, res_complex, context=None):
     """
     Handles saving a new or returning user based on the results of naive and complex matching.
     If the user is new, their data is saved. If they are returning, their log is updated.
     
     Parameters:
-    - users (pd.DataFrame): A DataFrame containing all stored user records.
+    - store (FingerprintStore): The store containing all stored user records.
     - user_data (dict): The current user data to be processed.
     - res_naive (list): The result of the naive matching process.
     - res_complex (list): The result of the complex matching process.
+    - context (ComparisonContext): Comparison context of the request, optional.
     """
     res = False
-    if len(users) > 0:
+    if len(store) > 0:
         res = (res_naive[0] or res_complex[0])
     
     # New user case
     if not res:
-        print("[RECEIVER] SAVE NEW USER")
+        logger.info("Save new user")
         
-        # Assign ID based on the last user ID in the database
-        if len(users) > 0:
-            id = int(users.iloc[len(users)-1]["ID"]) + 1
-        else:
-            id = 0
-            
-        user_data = prepare_user_data(user_data, id, 0)
-        save_new_user(user_data)
+        # Assign the next free ID, following the last user ID in the database
+        store.save_new_user(user_data)
 
     # Exact match found
     elif res_naive[0] and res_naive[1] == 8:
-        print(f"[RECEIVER] Exact match with ID:{res_naive[2]}, Log:{res_naive[3]}")  
+        logger.info("Exact match with ID:%s, Log:%s", res_naive[2], res_naive[3])  
 
     # Returning user with a change in fingerprint (4 possible states)
     elif res_naive[0] and res_complex[0] and res_naive[2] == res_complex[1]:
-        print(f"[RECEIVER] match with - {res_naive[2]}")
-        handle_user_log_saving(users, user_data, res_naive[2])
+        logger.info("Match with - %s", res_naive[2])
+        handle_user_log_saving(store, user_data, res_naive[2])
         
     elif res_naive[0] and res_complex[0] and res_naive[2] != res_complex[1]:
-        print(f"[RECEIVER] Naive and Complex mismatch - {res_naive[2]} {res_complex[1]}")
-        
-        # Handle discrepancy between naive and complex results
-        naive_founds = users[users["ID"] == res_naive[2]]
-        complex_founds = users[users["ID"] == res_complex[1]]
+        logger.info("Naive and Complex mismatch - %s %s", res_naive[2], res_complex[1])
         
-        naive_similarities = naive_founds.apply(count_similar_columns, axis=1, test_user=user_data)
-        complex_similarities = complex_founds.apply(count_similar_columns, axis=1, test_user=user_data)
+        # Handle discrepancy between naive and complex results: the column matches
+        # of every log of both users are read from the comparisons of the request
+        if context is None:
+            context = ComparisonContext(store)
+        similarities = score_columns(store, user_data, context=context)
+        naive_similarities = similarities[store.identities[res_naive[2]].positions]
+        complex_similarities = similarities[store.identities[res_complex[1]].positions]
         
         # Compare similarities to decide which matching method is more accurate
-        naive_sorted_similarities = naive_similarities.sort_values(ascending=False)
-        complex_sorted_similarities = complex_similarities.sort_values(ascending=False)
-        
-        if naive_sorted_similarities.iloc[0] >= complex_sorted_similarities.iloc[0]:
-            print("[RECEIVER] Naive was more accurate!")
-            id = int(naive_sorted_similarities.index[0])
+        if naive_similarities.max() >= complex_similarities.max():
+            logger.info("Naive was more accurate")
+            id = res_naive[2]
         else:
-            print("[RECEIVER] Complex was more accurate!")
-            id = int(complex_sorted_similarities.index[0, 1])
+            logger.info("Complex was more accurate")
+            id = res_complex[1]
         
-        handle_user_log_saving(users, user_data, id)
+        handle_user_log_saving(store, user_data, id)
         
     # Naive found a match but complex didn't
     elif res_naive[0] and not res_complex[0]:
-        print(f"[RECEIVER] Naive found match with - {res_naive[2]}")
+        logger.info("Naive found match with - %s", res_naive[2])
         id = res_naive[2]
-        handle_user_log_saving(users, user_data, id)        
+        handle_user_log_saving(store, user_data, id)        
         
     # Complex found a match but naive didn't
     elif res_complex[0] and not res_naive[0]:
-        print(f"[RECEIVER] Complex found match with - {res_naive[2]}")
+        logger.info("Complex found match with - %s", res_complex[1])
         id = res_complex[1]
-        handle_user_log_saving(users, user_data, id)
+        handle_user_log_saving(store, user_data, id)
+
+def handle_saving_repeat(store, user_data, position):
+    """
+    Saves an exact repeat of a stored fingerprint (see `FingerprintStore.find_repeat`) as the next log of its user,
+    as a match of both algorithms with that user would be saved.
+
+    Parameters:
+    - store (FingerprintStore): The store containing all stored user records.
+    - user_data (dict): The current user data to be saved.
+    - position (int): The position of the stored log repeated by the user data.
+
+    Returns:
+    - tuple: The ID and the log of the repeated stored log.
+    """
+    id = int(store.ids.values[position])
+    log = int(store.logs.values[position])
+    logger.info("Exact repeat of ID:%s, Log:%s", id, log)
+    handle_user_log_saving(store, user_data, id)
+    return id, log
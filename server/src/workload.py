@@ -0,0 +1,283 @@
+import argparse
+import ast
+import csv
+import glob
+import hashlib
+import json
+import math
+import os
+import random
+import re
+
+from data_manager import fieldnames
+
+"""
+workload.py: Generator of synthetic fingerprint workloads for load tests, learned from the captured datasets.
+
+Every capture in data/browser_data is one browser profile on one machine, visited repeatedly. From each capture
+the generator learns how often every attribute and every hash column changes between two consecutive visits,
+and which values it takes. This captures the farbling of the browsers: Brave gives new canvas, audio and plugin
+hashes on every visit, Firefox in aggressive mode new canvas hashes, while Tor reports the same resolution everywhere.
+
+A synthetic visitor starts from a random row of a random capture (its device and browser profile) and gets its
+own IP and its own device hashes, shared with the other visitors of the same device class. On every further visit
+each attribute and hash changes with the rate learned for its profile: randomised hashes are replaced by new unique
+ones, randomised attributes are drawn again from the values observed in the capture.
+
+Visits of different visitors are interleaved and every visitor has a geometric number of visits. The output is
+deterministic for a given seed.
+
+Output formats:
+- "json": One /check request body per line. The labels (visitor, visit, profile) are written to `<output>.labels.csv`.
+- "csv": The storage CSV (fp_data.csv) schema with ID = visitor, Log = visit and the profile as Name.
+
+Classes:
+- Profile: The behaviour learned from one capture.
+- WorkloadGenerator: Generates labelled synthetic visits.
+
+Usage:
+    python workload.py --visits 1000000 --seed 0 --format json --output workload.jsonl
+    python workload.py --visits 100000 --format csv --output workload.csv
+"""
+
+DATA_PATTERN = "../../data/browser_data/*.csv"
+
+# Columns with hashes, regenerated for randomised profiles
+hash_columns = ["AttributesHash", "Audio", "Fonts", "Geom Canvas", "MediaHash", "PluginsHash", "TXT Canvas"]
+
+# Columns with nested values, sent as objects to /check and stored as Python reprs
+nested_columns = ["Media Capabilities", "Plugins"]
+
+# A value that changes on more than this share of visits is considered randomised by the browser
+RANDOMISED = 0.5
+
+def _parse(text):
+    """
+    Parses a nested value of a capture, None if it cannot be parsed.
+    """
+    if not text:
+        return None
+    try:
+        return ast.literal_eval(re.sub(r"\bnull\b", "None", text))
+    except (ValueError, SyntaxError):
+        return None
+
+def _hash(*parts):
+    return hashlib.sha256("-".join(str(part) for part in parts).encode()).hexdigest()
+
+def _change_rate(values):
+    changes = sum(a != b for a, b in zip(values, values[1:]))
+    return changes / (len(values) - 1) if len(values) > 1 else 0.0
+
+class Profile:
+    """
+    The behaviour learned from one capture: its rows and, for every attribute and column,
+    how often it changes between consecutive visits and which values it takes.
+    """
+
+    def __init__(self, name, rows):
+        """
+        Parameters:
+        - name (str): Name of the capture.
+        - rows (list): Rows of the capture with parsed Attributes, Media Capabilities and Plugins.
+        """
+        self.name = name
+        self.rows = rows
+
+        names = list(rows[0]["Attributes"])
+        self.attribute_rates = {}
+        self.attribute_values = {}
+        for attribute in names:
+            values = [row["Attributes"].get(attribute) for row in rows]
+            self.attribute_rates[attribute] = _change_rate([repr(value) for value in values])
+            self.attribute_values[attribute] = values
+
+        self.column_rates = {column: _change_rate([row[column] for row in rows]) for column in hash_columns + nested_columns}
+
+    @classmethod
+    def from_csv(cls, file_path):
+        """
+        Learns a profile from a capture file. Returns None if the file has no usable rows.
+        """
+        rows = []
+        with open(file_path, newline="") as file:
+            for row in csv.DictReader(file):
+                attributes = _parse(row.get("Attributes"))
+                if not isinstance(attributes, dict):
+                    continue
+                row["Attributes"] = attributes
+                for column in nested_columns:
+                    row[column] = _parse(row.get(column))
+                rows.append(row)
+        if not rows:
+            return None
+        return cls(os.path.splitext(os.path.basename(file_path))[0], rows)
+
+class WorkloadGenerator:
+    """
+    Generates labelled synthetic visits from the learned profiles.
+    """
+
+    def __init__(self, profiles, seed=0, mean_visits=3.0, device_classes=1000):
+        """
+        Parameters:
+        - profiles (list): The learned profiles.
+        - seed (int): Seed of the generator.
+        - mean_visits (float): Mean number of visits of a visitor.
+        - device_classes (int): Number of device classes per profile; visitors of a class share their device hashes.
+        """
+        self.profiles = profiles
+        self.weights = [len(profile.rows) for profile in profiles]
+        self.seed = seed
+        self.mean_visits = mean_visits
+        self.device_classes = device_classes
+        self.rng = random.Random(seed)
+
+    def _value(self, visitor, column, value):
+        """
+        Returns the visitor's own version of a stable hash, shared by its device class.
+        """
+        return _hash(self.seed, visitor["profile"].name, visitor["device"], column, value)
+
+    def _visit_count(self):
+        """
+        Draws the number of visits of a new visitor from a geometric distribution with mean `mean_visits`.
+        """
+        if self.mean_visits <= 1:
+            return 1
+        return 1 + int(math.log(1 - self.rng.random()) / math.log(1 - 1 / self.mean_visits))
+
+    def _new_visitor(self, number):
+        rng = self.rng
+        profile = rng.choices(self.profiles, self.weights)[0]
+        row = rng.choice(profile.rows)
+        visitor = {
+            "number": number,
+            "profile": profile,
+            "device": rng.randrange(self.device_classes),
+            "visits": 0,
+            "remaining": self._visit_count(),
+        }
+
+        attributes = dict(row["Attributes"])
+        if "IP" in attributes:
+            attributes["IP"] = f"{rng.randrange(1, 224)}.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}"
+        fingerprint = {"Attributes": attributes}
+        for column in hash_columns:
+            fingerprint[column] = self._value(visitor, column, row[column])
+        for column in nested_columns:
+            fingerprint[column] = row[column]
+        visitor["fingerprint"] = fingerprint
+        return visitor
+
+    def _revisit(self, visitor):
+        """
+        Applies the changes of a further visit to a visitor's fingerprint.
+        """
+        rng = self.rng
+        profile = visitor["profile"]
+        fingerprint = visitor["fingerprint"]
+        attributes = dict(fingerprint["Attributes"])
+        for attribute, rate in profile.attribute_rates.items():
+            if attribute != "IP" and rate > 0 and rng.random() < rate:
+                attributes[attribute] = rng.choice(profile.attribute_values[attribute])
+        fingerprint = dict(fingerprint, Attributes=attributes)
+
+        for column in hash_columns:
+            rate = profile.column_rates[column]
+            if rate > 0 and rng.random() < rate:
+                if rate > RANDOMISED:
+                    fingerprint[column] = _hash(self.seed, visitor["number"], visitor["visits"], column)
+                else:
+                    fingerprint[column] = self._value(visitor, column, rng.choice(profile.rows)[column])
+        for column in nested_columns:
+            rate = profile.column_rates[column]
+            if rate > 0 and rng.random() < rate:
+                fingerprint[column] = rng.choice(profile.rows)[column]
+        visitor["fingerprint"] = fingerprint
+
+    def visits(self, count):
+        """
+        Generates visits.
+
+        Parameters:
+        - count (int): The number of visits.
+
+        Yields:
+        - tuple: The visitor number, the visit number, the profile name and the fingerprint in the /check shape.
+        """
+        rng = self.rng
+        active = []
+        visitors = 0
+        for _ in range(count):
+            # A new visitor arrives at the rate that keeps the mean number of visits per visitor
+            if not active or rng.random() < 1 / self.mean_visits:
+                visitor = self._new_visitor(visitors)
+                visitors += 1
+                index = len(active)
+                active.append(visitor)
+            else:
+                index = rng.randrange(len(active))
+                visitor = active[index]
+                self._revisit(visitor)
+
+            fingerprint = dict(visitor["fingerprint"], Name="Not available")
+            yield visitor["number"], visitor["visits"], visitor["profile"].name, fingerprint
+
+            visitor["visits"] += 1
+            if visitor["visits"] >= visitor["remaining"]:
+                active[index] = active[-1]
+                active.pop()
+
+def load_profiles(pattern=DATA_PATTERN):
+    """
+    Learns the profiles of all capture files matching the pattern.
+    """
+    profiles = [Profile.from_csv(file_path) for file_path in sorted(glob.glob(pattern))]
+    return [profile for profile in profiles if profile is not None]
+
+def write_json(visits, output):
+    """
+    Writes the visits as /check request bodies, one per line, and their labels to `<output>.labels.csv`.
+    """
+    with open(output, "w") as file, open(output + ".labels.csv", "w", newline="") as labels_file:
+        labels = csv.writer(labels_file)
+        labels.writerow(["Line", "ID", "Log", "Profile"])
+        for line, (visitor, visit, profile, fingerprint) in enumerate(visits):
+            file.write(json.dumps(fingerprint) + "\n")
+            labels.writerow([line, visitor, visit, profile])
+
+def write_csv(visits, output):
+    """
+    Writes the visits in the storage CSV schema with the visitor as ID, the visit as Log and the profile as Name.
+    """
+    with open(output, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=fieldnames)
+        writer.writeheader()
+        for visitor, visit, profile, fingerprint in visits:
+            row = dict(fingerprint, ID=visitor, Log=visit, Name=profile)
+            for column in ["Attributes"] + nested_columns:
+                row[column] = repr(row[column])
+            writer.writerow(row)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic fingerprint workload from the captured datasets.")
+    parser.add_argument("--visits", type=int, default=100_000, help="Number of visits to generate")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mean-visits", type=float, default=3.0, help="Mean number of visits per visitor")
+    parser.add_argument("--device-classes", type=int, default=1000, help="Device classes per profile")
+    parser.add_argument("--data", default=DATA_PATTERN, help="Glob pattern of the capture files")
+    parser.add_argument("--format", choices=["json", "csv"], default="json")
+    parser.add_argument("--output", default="workload.jsonl")
+    args = parser.parse_args()
+
+    profiles = load_profiles(args.data)
+    print(f"[WORKLOAD] Learned {len(profiles)} profiles from {sum(len(profile.rows) for profile in profiles)} rows")
+
+    generator = WorkloadGenerator(profiles, args.seed, args.mean_visits, args.device_classes)
+    visits = generator.visits(args.visits)
+    if args.format == "json":
+        write_json(visits, args.output)
+    else:
+        write_csv(visits, args.output)
+    print(f"[WORKLOAD] Wrote {args.visits} visits to {args.output}")
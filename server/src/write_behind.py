@@ -0,0 +1,254 @@
+import queue
+import threading
+import time
+
+import metrics
+from data_manager import CsvBackend
+from log import get_logger
+
+"""
+write_behind.py: This script moves persistence off the request path. Logs are put on a bounded queue and
+written by a background thread, so /check returns as soon as the match decision is made and its latency
+does not depend on the latency of the disk.
+
+The in-memory store is updated as soon as a log is queued, so matching always sees every saved log, even if it
+has not reached the disk yet.
+
+The background thread writes in batches. A batch is written once it holds `batch_size` logs, or `flush_interval`
+seconds after its first log was queued. Consecutive logs for the same destination are handed over in one call
+(`write_many` where the backend has it), so e.g. the CSV file is opened once per batch instead of once per log.
+
+When the queue is full, `put` blocks until there is room (backpressure). If there is still no room after
+`put_timeout` seconds, the log is written synchronously by the caller instead.
+
+When a write fails (e.g. the disk is full), its logs are kept and written again every `flush_interval` seconds,
+before any later log for the same destination, until the write succeeds. `failed` is the number of logs waiting
+for a retry. Logs that still cannot be written after CLOSE_RETRIES more attempts when the queue is closed are lost;
+they are logged as errors.
+A write that failed halfway may have stored some of its logs, which are then stored twice.
+
+Classes:
+- WriteBehindQueue: Bounded queue of logs with a background writer thread.
+- WriteBehindBackend: Storage backend whose writes go through a WriteBehindQueue.
+"""
+
+logger = get_logger(__name__)
+
+# Marks the end of the queue for the background thread
+_STOP = object()
+
+# Number of retries of failed writes when the queue is closed
+CLOSE_RETRIES = 5
+
+class WriteBehindQueue:
+    """
+    Bounded queue of logs written by a background thread in batches.
+    """
+
+    def __init__(self, maxsize=1024, batch_size=64, flush_interval=0.5, put_timeout=5.0):
+        """
+        Parameters:
+        - maxsize (int): The maximum number of queued logs.
+        - batch_size (int): The maximum number of logs written in one batch.
+        - flush_interval (float): The maximum number of seconds a log waits before its batch is written.
+        - put_timeout (float): Seconds `put` waits for room before writing synchronously. None waits forever.
+        """
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        # Number of logs whose write failed and that wait for a retry
+        self.failed = 0
+        self._pending = []
+        self._queue = queue.Queue(maxsize)
+        self._files = {}
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return self._queue.qsize() + self.failed
+
+    def put(self, sink, user_data):
+        """
+        Queues a log to be written to a sink.
+
+        Parameters:
+        - sink: An object with a `write` method, e.g. a storage backend.
+        - user_data (dict): The log to write. It must not be modified after it is queued.
+        """
+        if not self._thread.is_alive():
+            raise RuntimeError("The write-behind queue is closed")
+        try:
+            self._queue.put((sink, user_data), timeout=self.put_timeout)
+        except queue.Full:
+            logger.warning("Queue full for %ss, writing synchronously", self.put_timeout)
+            with metrics.stage("disk_write"):
+                sink.write(user_data)
+            metrics.disk_writes_total.inc()
+
+    def save_user_data(self, user_data, file_path):
+        """
+        Queues a log to be appended to a CSV file, see `data_manager.save_user_data`.
+        """
+        if file_path not in self._files:
+            self._files[file_path] = CsvBackend(file_path)
+        self.put(self._files[file_path], user_data)
+
+    def _next_batch(self):
+        """
+        Waits for the next batch. Returns the queued items and whether the queue was stopped.
+        While logs wait for a retry, an empty batch is returned after `flush_interval` seconds without logs.
+        """
+        try:
+            item = self._queue.get(timeout=self.flush_interval if self._pending else None)
+        except queue.Empty:
+            return [], False
+        if item is _STOP:
+            return [], True
+
+        batch = [item]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _write_batch(self, batch):
+        """
+        Writes the logs waiting for a retry, then a batch. The logs of a failed write are kept for the next retry,
+        together with all later logs for the same sink, so every sink gets its logs in the order they were queued.
+        """
+        batch = self._pending + batch
+        self._pending = []
+        failed_sinks = []
+        start = 0
+        while start < len(batch):
+            sink = batch[start][0]
+            end = start
+            while end < len(batch) and batch[end][0] is sink:
+                end += 1
+            users = [user_data for _, user_data in batch[start:end]]
+            if any(sink is failed_sink for failed_sink in failed_sinks):
+                self._pending.extend(batch[start:end])
+                start = end
+                continue
+            try:
+                with metrics.stage("disk_write"):
+                    if hasattr(sink, "write_many"):
+                        sink.write_many(users)
+                    else:
+                        for user_data in users:
+                            sink.write(user_data)
+                metrics.disk_writes_total.inc(amount=len(users))
+            except Exception as error:
+                self._pending.extend(batch[start:end])
+                failed_sinks.append(sink)
+                logger.error("Failed to write %s logs, retrying in %ss: %s", len(users), self.flush_interval, error)
+            start = end
+        self.failed = len(self._pending)
+
+    def _run(self):
+        stopped = False
+        while not stopped:
+            batch, stopped = self._next_batch()
+            try:
+                self._write_batch(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+        for _ in range(CLOSE_RETRIES):
+            if not self._pending:
+                break
+            time.sleep(self.flush_interval)
+            self._write_batch([])
+        if self._pending:
+            logger.error("%s logs could not be written and are lost", len(self._pending))
+        self._queue.task_done()
+
+    def flush(self):
+        """
+        Blocks until every queued log has been written, or its write failed and it waits for a retry (see `failed`).
+        """
+        if self._thread.is_alive():
+            self._queue.join()
+
+    def close(self):
+        """
+        Writes all queued logs and stops the background thread. Logs waiting for a retry are tried CLOSE_RETRIES more times.
+        """
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+class WriteBehindBackend:
+    """
+    Storage backend that queues its writes on a WriteBehindQueue. Reads first wait for all queued logs,
+    so they always return every written log. Other attributes (e.g. `start_compaction`) are those of the wrapped backend.
+    """
+
+    def __init__(self, backend, write_queue=None):
+        """
+        Parameters:
+        - backend: Storage backend from `data_manager.open_backend`.
+        - write_queue (WriteBehindQueue): The queue to write through. A new queue is created by default.
+        """
+        self.backend = backend
+        self.queue = WriteBehindQueue() if write_queue is None else write_queue
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def read(self):
+        """
+        Returns all stored logs, including the ones still queued.
+        """
+        self.queue.flush()
+        return self.backend.read()
+
+    def write(self, user_data):
+        """
+        Queues a log to be appended to the wrapped backend.
+        """
+        self.queue.put(self.backend, user_data)
+
+    def checkpoint(self):
+        """
+        Returns the checkpoint of the wrapped backend once every queued log has been written, or None
+        if it has no checkpoints or a log could not be written (the backend then lacks logs the store has).
+        """
+        self.queue.flush()
+        if self.queue.failed or not hasattr(self.backend, "checkpoint"):
+            return None
+        return self.backend.checkpoint()
+
+    def read_since(self, marker):
+        """
+        Returns the logs stored after a checkpoint, including the ones still queued, or None if the wrapped backend
+        has no checkpoints or does not match the marker.
+        """
+        self.queue.flush()
+        if not hasattr(self.backend, "read_since"):
+            return None
+        return self.backend.read_since(marker)
+
+    def flush(self):
+        """
+        Blocks until every queued log has been written to the wrapped backend.
+        """
+        self.queue.flush()
+        if hasattr(self.backend, "flush"):
+            self.backend.flush()
+
+    def close(self):
+        """
+        Writes all queued logs, then closes the wrapped backend.
+        """
+        self.queue.close()
+        self.backend.close()
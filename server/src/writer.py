@@ -0,0 +1,226 @@
+import os
+import signal
+import sys
+import threading
+from multiprocessing.connection import Client, Listener
+
+from data_manager import open_backend
+from fingerprint_store import FingerprintStore
+from write_behind import WriteBehindBackend
+from log import get_logger
+import lsh
+import snapshot
+
+"""
+writer.py: This script runs the single writer process used when several server workers (gunicorn) share one store.
+
+Matching runs in every worker against its own in-memory FingerprintStore. All mutations - allocating IDs,
+numbering logs and appending them to the storage backend - are sent to one writer process over a local socket
+and executed one at a time, so two workers can never hand out the same ID or the same log of a user.
+
+The writer keeps every log in its own FingerprintStore, in the order it was stored. Workers ask for the logs
+they have not seen yet before every match (`SharedStore.sync`), so a log saved by one worker is visible to all
+others on their next request.
+
+The writer owns the snapshot of the store (snapshot.py): it loads from it on start and writes it on exit.
+A worker maps the same snapshot and only asks the writer for the logs after it, once the writer confirms
+that its store begins with the logs of that snapshot, so starting a worker does not copy the whole history.
+
+Workers authenticate to the writer with a shared key from FP_WRITER_KEY, and the socket is only accessible
+to the user running the server. gunicorn.conf.py generates a random key for every start, which the writer
+and the workers inherit.
+
+Configuration (environment variables):
+- FP_WRITER: Path of the Unix socket of the writer.
+- FP_WRITER_KEY: Key the workers authenticate with, required.
+
+Classes:
+- Writer: Serialises all mutations of the store.
+- SharedStore: FingerprintStore of a worker that saves through the writer.
+
+Functions:
+- authkey: Returns the key shared by the writer and the workers.
+- serve: Runs the writer process.
+
+Usage:
+    FP_WRITER_KEY=... python writer.py
+"""
+
+logger = get_logger(__name__)
+
+WRITER_ADDRESS = os.environ.get("FP_WRITER", "../fp_writer.sock")
+
+def authkey():
+    """
+    Returns the key shared by the writer and the workers, from FP_WRITER_KEY.
+
+    Raises:
+    - RuntimeError: If FP_WRITER_KEY is not set.
+    """
+    key = os.environ.get("FP_WRITER_KEY")
+    if not key:
+        raise RuntimeError("FP_WRITER_KEY is not set, the writer and its workers need a shared key")
+    return key.encode()
+
+class Writer:
+    """
+    Owner of the storage backend. Every request is executed under one lock.
+    """
+
+    def __init__(self, backend, blocking=None, snapshot_path=None):
+        """
+        Parameters:
+        - backend: Storage backend from `data_manager.open_backend`.
+        - blocking (lsh.MinHashIndex): Candidate blocking index of the workers, so that the snapshot has its buckets.
+        - snapshot_path (str): Snapshot file of the store, optional.
+        """
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.store = FingerprintStore(backend, blocking=blocking, snapshot_path=snapshot_path).load()
+
+    def handle(self, request):
+        """
+        Executes a single request of a worker.
+
+        Requests:
+        - ("sync", position): Returns all logs stored after the given position.
+        - ("save_new", user_data): Saves the first log of a new user, returns the saved log.
+        - ("save_log", id, user_data): Saves the next log of a user, returns the saved log.
+        - ("append", user_data): Saves a log with its own ID and Log, returns the saved log.
+        - ("allocate",): Returns a new user ID.
+        - ("snapshot", snapshot_id): Returns whether the store begins with the logs of the snapshot, in its order.
+        """
+        operation = request[0]
+        with self.lock:
+            if operation == "sync":
+                return self.store.rows[request[1]:]
+            if operation == "save_new":
+                return self.store.save_new_user(request[1])
+            if operation == "save_log":
+                return self.store.save_log(request[1], request[2])
+            if operation == "append":
+                self.store.append(request[1])
+                return request[1]
+            if operation == "allocate":
+                return self.store.allocate_id()
+            if operation == "snapshot":
+                return request[1] in self.store.snapshot_ids
+        raise ValueError(f"Unknown writer request '{operation}'")
+
+    def close(self):
+        """
+        Writes the snapshot and closes the storage backend.
+        """
+        with self.lock:
+            self.store.save_snapshot()
+            self.backend.close()
+
+    def _serve_connection(self, connection):
+        with connection:
+            while True:
+                try:
+                    request = connection.recv()
+                except EOFError:
+                    return
+                try:
+                    response = self.handle(request)
+                except Exception as error:
+                    response = error
+                connection.send(response)
+
+def serve(address=WRITER_ADDRESS, backend=None):
+    """
+    Runs the writer process: accepts worker connections and serves each in its own thread.
+
+    Parameters:
+    - address (str): Path of the Unix socket.
+    - backend: Storage backend, the one configured by FP_STORAGE by default. Its writes go through a write-behind queue.
+    """
+    key = authkey()
+    if os.path.exists(address):
+        os.remove(address)
+    writer = Writer(WriteBehindBackend(backend or open_backend()), lsh.from_env(), snapshot.from_env())
+    if hasattr(writer.backend, "start_compaction"):
+        writer.backend.start_compaction()
+    logger.info("Serving %s logs on %s", len(writer.store), address)
+    try:
+        with Listener(address, family="AF_UNIX", authkey=key) as listener:
+            os.chmod(address, 0o600)
+            while True:
+                connection = listener.accept()
+                threading.Thread(target=writer._serve_connection, args=(connection,), daemon=True).start()
+    finally:
+        writer.close()
+
+class SharedStore(FingerprintStore):
+    """
+    FingerprintStore of a worker process. Logs are read from and saved through the writer process.
+    """
+
+    def __init__(self, address=WRITER_ADDRESS, order_by_key=True, blocking=None, snapshot_path=None):
+        """
+        Parameters:
+        - address (str): Path of the writer's Unix socket.
+        - order_by_key (bool): See FingerprintStore.
+        - blocking (lsh.MinHashIndex): See FingerprintStore.
+        - snapshot_path (str): Snapshot file written by the writer, optional. The worker never writes it.
+        """
+        super().__init__(backend=None, order_by_key=order_by_key, blocking=blocking, snapshot_path=snapshot_path)
+        self.connection = Client(address, family="AF_UNIX", authkey=authkey())
+        self._connection_lock = threading.Lock()
+
+    def _call(self, *request):
+        with self._connection_lock:
+            self.connection.send(request)
+            response = self.connection.recv()
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def _load(self):
+        """
+        Loads all logs known to the writer. The logs of the snapshot are mapped if the writer's store begins with them,
+        then only the logs after them are read from the writer.
+        """
+        self._reset()
+        if self.snapshot_path is not None:
+            header = snapshot.load(self, self.snapshot_path)
+            if header is not None and not self._call("snapshot", header["id"]):
+                logger.info("Snapshot %s is not a prefix of the writer's store, reading all logs", header["id"])
+                self._reset()
+        self.sync()
+        return self
+
+    def sync(self):
+        """
+        Applies all logs saved since the last sync, by this or any other worker.
+        """
+        with self.lock:
+            for row in self._call("sync", len(self)):
+                self.ingest(row)
+
+    def append(self, user_data):
+        with self.lock:
+            self._call("append", user_data)
+            self.sync()
+            return len(self) - 1
+
+    def save_new_user(self, user_data):
+        with self.lock:
+            user_data = self._call("save_new", user_data)
+            self.sync()
+        return user_data
+
+    def save_log(self, user_id, user_data):
+        with self.lock:
+            user_data = self._call("save_log", user_id, user_data)
+            self.sync()
+        return user_data
+
+    def allocate_id(self):
+        return self._call("allocate")
+
+if __name__ == "__main__":
+    # Stopping the writer (SIGTERM from gunicorn.conf.py) still writes all queued logs
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    serve()